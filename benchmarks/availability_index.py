@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+"""
+benchmark of the piece availability index of the piece picker against the list-backed priority buckets it replaced,
+on torrents of 10k and 100k pieces. a swarm of peers connects with their bitfields, then sends have messages, and the
+rarest piece a peer has is looked up for each of them. the old buckets are too slow to run in full on large torrents,
+their bitfield cost is extrapolated from _OLD_SAMPLE random pieces of each bitfield.
+usage: python benchmarks/availability_index.py
+"""
+
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import List, Dict
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+_SIZES = (10_000, 100_000)
+_PEERS = 20
+_SHARE = 0.5  # part of the pieces each peer has
+_HAVES = 2000
+_LOOKUPS = 200
+_OLD_SAMPLE = 500  # pieces of a bitfield timed with the old buckets
+
+
+@dataclass
+class PiecePos:
+    """
+    the piece of the old buckets, as it was
+    """
+    piece_index: int
+    peer_count: int = 0
+
+
+class PriorityBucket:
+    """
+    the old priority bucket, as it was: a list of PiecePos sharing the same availability, with class-level keys
+    """
+    keys: List[int] = []
+    buckets: List = []
+
+    def __init__(self, pieces_list: List[PiecePos] = None) -> None:
+        PriorityBucket.buckets.append(self)
+        if pieces_list:
+            self.pieces_list: List[PiecePos] = pieces_list
+            self.length = len(pieces_list)
+            self.priority = pieces_list[0].peer_count
+            PriorityBucket.keys.append(self.priority)
+            PriorityBucket.keys.sort()
+        else:
+            self.pieces_list: List[PiecePos] = []
+            self.length = 0
+            self.priority = None
+
+    def add_piece(self, piece: PiecePos):
+        self.length += 1
+        if self.priority is None:
+            self.priority = piece.peer_count
+            PriorityBucket.keys.append(piece.peer_count)
+            PriorityBucket.keys.sort()
+        self.pieces_list.append(piece)
+
+    def remove(self, piece: PiecePos):
+        self.pieces_list.remove(piece)
+        self.length -= 1
+
+
+class OldPicker:
+    """
+    the parts of the old piece picker that used the buckets
+    """
+    def __init__(self, num_pieces: int) -> None:
+        PriorityBucket.keys.clear()
+        PriorityBucket.buckets.clear()
+        self.pieces_map: Dict[int, PiecePos] = {index: PiecePos(index) for index in range(num_pieces)}
+        self.buckets_dict: Dict[int, PriorityBucket] = defaultdict(PriorityBucket)
+        self.buckets_dict[0] = PriorityBucket(list(self.pieces_map.values()))
+        self.buckets_dict[0].priority = 0
+
+    def change_availability(self, piece_index: int, difference: int) -> None:
+        piece = self.pieces_map[piece_index]
+        bucket = self.buckets_dict[piece.peer_count]
+        if piece in bucket.pieces_list:
+            bucket.remove(piece)
+            piece.peer_count += difference
+            self.buckets_dict[piece.peer_count].add_piece(piece)
+
+    def rarest(self, have_mask: np.ndarray):
+        for key in PriorityBucket.keys:
+            for piece in self.buckets_dict[key].pieces_list:
+                if have_mask[piece.piece_index]:
+                    return piece.piece_index
+        return None
+
+
+def run(num_pieces: int) -> None:
+    from RaBit.download.piece_picker import AvailabilityIndex
+
+    rng = np.random.default_rng(0)
+    random.seed(0)
+    bitfields = [rng.random(num_pieces) < _SHARE for _ in range(_PEERS)]
+    haves = [random.randrange(num_pieces) for _ in range(_HAVES)]
+
+    # the old buckets. a bitfield is a have message for each of its pieces
+    old = OldPicker(num_pieces)
+    begin = time.perf_counter()
+    sampled = 0
+    for bitfield in bitfields:
+        for piece_index in rng.choice(np.flatnonzero(bitfield), _OLD_SAMPLE, replace=False).tolist():
+            old.change_availability(piece_index, 1)
+            sampled += 1
+    old_bitfield = (time.perf_counter() - begin) / sampled * bitfields[0].sum()
+    begin = time.perf_counter()
+    for piece_index in haves:
+        old.change_availability(piece_index, 1)
+    old_have = (time.perf_counter() - begin) / _HAVES
+    begin = time.perf_counter()
+    for bitfield in bitfields * (_LOOKUPS // _PEERS):
+        old.rarest(bitfield)
+    old_rarest = (time.perf_counter() - begin) / _LOOKUPS
+
+    # the availability index, the way the piece picker uses it
+    index = AvailabilityIndex(num_pieces, range(num_pieces))
+    begin = time.perf_counter()
+    for bitfield in bitfields:
+        index.add_bitfield(bitfield)
+    index.rarest(bitfields[0])  # the pieces are sorted lazily, on the first ordered operation
+    new_bitfield = (time.perf_counter() - begin) / _PEERS
+    begin = time.perf_counter()
+    for piece_index in haves:
+        index.increment(piece_index)
+    new_have = (time.perf_counter() - begin) / _HAVES
+    begin = time.perf_counter()
+    for bitfield in bitfields * (_LOOKUPS // _PEERS):
+        index.rarest(bitfield)
+    new_rarest = (time.perf_counter() - begin) / _LOOKUPS
+
+    print(f'{num_pieces} pieces, {_PEERS} peers')
+    print(f'  bitfield  old {old_bitfield * 1e3:10.1f} ms (extrapolated)   new {new_bitfield * 1e3:8.3f} ms')
+    print(f'  have      old {old_have * 1e6:10.1f} us                  new {new_have * 1e6:8.3f} us')
+    print(f'  rarest    old {old_rarest * 1e6:10.1f} us                  new {new_rarest * 1e6:8.3f} us')
+
+
+def main():
+    for num_pieces in _SIZES:
+        run(num_pieces)
+
+
+if __name__ == '__main__':
+    main()
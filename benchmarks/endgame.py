@@ -0,0 +1,153 @@
+#!/usr/bin/python
+
+"""
+benchmark of the last 1% of a download, where the piece picker is in endgame mode.
+a swarm of simulated seeds serves the requests of the real piece picker in virtual time, every seed uploads at its own
+rate and honours the cancels of requests it has not served yet. one of the seeds is nearly stalled, so without
+duplicate requests the last blocks wait for it. the download runs with the endgame redundancy of the piece picker,
+and again with every block requested from a single peer.
+prints the virtual time of the last 1%, the data wasted on duplicate blocks and the cpu time of the piece picker per
+endgame request.
+usage: python benchmarks/endgame.py
+"""
+
+import asyncio
+import os
+import random
+import struct
+import sys
+import time
+
+import bitstring
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+_PIECES = 1000
+_PIECE_LENGTH = 256 * 1024
+_RATES = [400] * 19 + [5]  # KiB/s of every seed, the last one is nearly stalled
+_PIPELINE = 10  # requests of a seed before endgame
+_STEP = 0.01  # seconds of virtual time
+_TIMEOUT = 3600  # seconds of virtual time
+
+
+class Connection:
+    """
+    the connection to a simulated seed. the requests it received wait in its queue until it has the bandwidth to
+    serve them, a cancel removes a request that is still queued
+    """
+    def __init__(self, rate: float) -> None:
+        self.rate = rate * 1024
+        self.budget = 0.0
+        self.queue = []
+
+    def write(self, data: bytes) -> None:
+        _, _, index, begin, length = struct.unpack('>IBIII', data)  # only cancels are written, requests are queued
+        self.queue = [block for block in self.queue if not block.is_equal(index, begin, length)]
+
+    def wake(self) -> None:
+        pass
+
+
+class Session:
+    downloaded = wasted = 0
+
+    def __init__(self) -> None:
+        from RaBit.bandwidth import RateEstimator
+        self.downloading = RateEstimator()
+
+
+async def download(redundancy: int) -> None:
+    import RaBit.download.piece_picker as piece_picker_module
+    from RaBit.download.piece_picker import PiecePicker
+    from RaBit.download.data_structures import Block
+    from RaBit.peer.peer_object import Peer
+    from RaBit.torrent.torrent_object import Torrent
+
+    random.seed(0)
+    np.random.seed(0)
+    piece_picker_module._ENDGAME_REDUNDANCY = redundancy
+    torrent = Torrent(info={b'piece length': _PIECE_LENGTH}, info_hash=bytes([redundancy]) * 20, piece_hashes=[b''] * _PIECES,
+                      multi_file=False, peer_id=b'b' * 20, length=_PIECES * _PIECE_LENGTH)
+    Peer.peer_instances[torrent.info_hash] = []
+    peers = []
+    for number, rate in enumerate(_RATES):
+        peer = Peer(Connection(rate), torrent, (f'10.0.0.{number}', 6881), None)
+        peer.outbox.flush_threshold = 0  # cancels reach the seed right away
+        peer.have_pieces[:] = True
+        peer.is_choked = False
+        Peer.peer_instances[torrent.info_hash].append(peer)
+        peers.append(peer)
+    piece_picker = PiecePicker(torrent, Session(), bitstring.BitArray(_PIECES))
+    for peer in peers:
+        piece_picker.add_peer_bitfield(peer.have_pieces)
+    file_status = PiecePicker.FILE_STATUS[torrent.info_hash]
+
+    now, last_percent_begin, done = 0.0, None, 0
+    endgame_requests, endgame_time = 0, 0.0
+    while now < _TIMEOUT:
+        for peer in peers:
+            connection = peer.writer
+            # send requests, like the connection loop does
+            if not piece_picker.is_in_endgame:
+                while len(peer.pipelined_requests) < _PIPELINE and isinstance((block := await piece_picker.get_block(peer)), Block):
+                    connection.queue.append(block)
+                    peer.pipelined_requests[block.key] = (block, now)
+            else:
+                begin = time.perf_counter()
+                while len(peer.pipelined_requests) < peer.MAX_ENDGAME_REQUESTS and isinstance((block := piece_picker.get_endgame_block(peer)), Block):
+                    connection.queue.append(block)
+                    peer.pipelined_requests[block.key] = (block, now)
+                    endgame_requests += 1
+                endgame_time += time.perf_counter() - begin
+
+            # the seed serves its queue
+            connection.budget += connection.rate * _STEP
+            while connection.queue and connection.budget >= connection.queue[0].length:
+                block = connection.queue.pop(0)
+                connection.budget -= block.length
+                if peer.pipelined_requests.pop(block.key, None) is None:
+                    peer.cancelled_requests.pop(block.key, None)  # the cancel came too late
+                begin = time.perf_counter()
+                await piece_picker.report_block(block, (bytes(block.length), peer.address), peer)
+                if piece_picker.is_in_endgame:
+                    endgame_time += time.perf_counter() - begin
+            if not connection.queue:
+                connection.budget = 0
+
+        # the disk IO manager saves the completed pieces
+        while not piece_picker.results_queue.empty():
+            piece = piece_picker.results_queue.get_nowait()
+            if not file_status[piece.index]:
+                file_status[piece.index] = True
+                piece_picker.num_of_pieces_left -= 1
+                done += 1
+            piece.reset()
+            piece.release()
+
+        if last_percent_begin is None and done >= 0.99 * _PIECES:
+            last_percent_begin = now
+        if done == _PIECES:
+            break
+        now += _STEP
+
+    Peer.peer_instances.pop(torrent.info_hash)
+    name = f'redundancy {redundancy}'
+    if done < _PIECES:
+        print(f'{name}: not completed after {_TIMEOUT} s')
+        return
+    print(f'{name}: last 1% in {now - last_percent_begin:.2f} s, total {now:.2f} s, '
+          f'wasted {piece_picker.session.wasted / 2 ** 20:.2f} MiB, '
+          f'{endgame_time / max(endgame_requests, 1) * 1e6:.1f} us of picker cpu per endgame request ({endgame_requests} requests)')
+
+
+def main():
+    from RaBit.download.piece_picker import _ENDGAME_REDUNDANCY
+
+    print(f'{_PIECES} pieces of {_PIECE_LENGTH // 1024} KiB, {len(_RATES)} seeds, {_RATES[-1]} KiB/s stalled seed')
+    for redundancy in (_ENDGAME_REDUNDANCY, 1):
+        asyncio.run(download(redundancy))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+"""
+loopback benchmark of the time to the first block. _PEERS connections run tcp_wire_communication against a remote
+process that has every piece but unchokes a connection only _UNCHOKE_AFTER seconds after the handshake, e.g. at its
+next choking round. with the fast extension the remote sends have all and allows _ALLOWED_FAST pieces, which it serves
+while choking; without it the remote sends a bitfield and serves nothing until the unchoke.
+prints the median and max time from the handshake to the first block served, the blocks served and the requests rejected.
+usage: python benchmarks/first_block.py [number of peers]
+"""
+
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import os
+import statistics
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+_PEERS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+_UNCHOKE_AFTER = 2  # seconds
+_RUN = 5  # seconds, the connections start about a second late, after trying utp
+_PIECE_LENGTH = 256 * 1024
+_PIECES = 2000
+_ALLOWED_FAST = range(0, _PIECES, 200)
+_INFO_HASH = b'f' * 20
+_PORT = 47501
+
+
+def remote(fast: bool, results: multiprocessing.Queue) -> None:
+    from RaBit.peer.message_types import Bitfield, Unchoke, Piece, HaveAll, AllowedFast, RejectRequest, REQUEST, FAST_EXTENSION
+    import numpy as np
+
+    stats = []
+
+    async def handle(reader, writer):
+        begin = time.perf_counter()
+        await reader.readexactly(68)
+        writer.write(struct.pack('>B19sQ20s20s', 19, b'BitTorrent protocol', FAST_EXTENSION if fast else 0, _INFO_HASH, os.urandom(20)))
+        if fast:
+            writer.write(HaveAll.encode())
+            for index in _ALLOWED_FAST:
+                writer.write(AllowedFast.encode(index))
+        else:
+            writer.write(Bitfield.encode(np.ones(_PIECES, dtype=bool)))
+        await writer.drain()
+        choked = [True]
+
+        def unchoke() -> None:
+            choked[0] = False
+            if not writer.is_closing():
+                writer.write(Unchoke.encode())
+        asyncio.get_running_loop().call_later(_UNCHOKE_AFTER, unchoke)
+
+        first, served, rejected = None, 0, 0
+        try:
+            while True:
+                length = struct.unpack('>I', await reader.readexactly(4))[0]
+                body = await reader.readexactly(length)
+                if body and body[0] == REQUEST:
+                    index, offset, size = struct.unpack('>III', body[1:])
+                    if choked[0] and not (fast and index in _ALLOWED_FAST):
+                        if fast:
+                            writer.write(RejectRequest.encode(index, offset, size))
+                            rejected += 1
+                        continue
+                    if first is None:
+                        first = time.perf_counter() - begin
+                    writer.write(Piece.encode(index, offset, bytes(size)))
+                    served += 1
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        stats.append((first, served, rejected))
+        if len(stats) == _PEERS:
+            results.put(stats.copy())  # pickled later, by the feeder thread of the queue
+            stats.clear()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', _PORT)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
+
+
+class Session:
+    downloaded = wasted = corrupted = uploaded = 0
+
+    def __init__(self, TorrentData) -> None:
+        from RaBit.bandwidth import RateEstimator
+        from RaBit.download.metadata import Metadata
+        self.TorrentData = TorrentData
+        self.metadata = Metadata(TorrentData.info_hash, TorrentData.info)
+        self.downloading = RateEstimator()
+        self.uploading = RateEstimator()
+
+
+class ChokingManager:
+    async def report_interested(self, peer):
+        pass
+
+    async def report_uninterested(self, peer):
+        pass
+
+
+async def client() -> None:
+    import bitstring
+    from RaBit.download.piece_picker import PiecePicker
+    from RaBit.download.upload_scheduler import UploadScheduler
+    from RaBit.peer.peer_communication import tcp_wire_communication
+    from RaBit.peer.peer_object import Peer
+    from RaBit.torrent.torrent_object import Torrent
+
+    torrent = Torrent(info={b'piece length': _PIECE_LENGTH}, info_hash=_INFO_HASH, piece_hashes=[b''] * _PIECES,
+                      multi_file=False, peer_id=b'c' * 20, length=_PIECES * _PIECE_LENGTH)
+    Peer.peer_instances[_INFO_HASH] = []
+    session = Session(torrent)
+    piece_picker = PiecePicker(torrent, session, bitstring.BitArray(_PIECES))
+
+    async def save_pieces():
+        while True:
+            piece = await piece_picker.results_queue.get()
+            piece.reset()
+            piece.release()
+
+    tasks = [asyncio.create_task(save_pieces())]
+    tasks += [asyncio.create_task(tcp_wire_communication((('127.0.0.1', _PORT), None, 0), torrent, session, None, piece_picker,
+                                                         ChokingManager(), UploadScheduler(None, session))) for _ in range(_PEERS)]
+    await asyncio.sleep(_RUN)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    Peer.peer_instances.pop(_INFO_HASH)
+
+
+def main():
+    print(f'{_PEERS} peers, unchoked {_UNCHOKE_AFTER} s after the handshake')
+    for name, fast in (('bitfield', False), ('fast extension', True)):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=remote, args=(fast, results), daemon=True)
+        process.start()
+        time.sleep(0.5)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):  # the connections print their state
+                asyncio.run(client())
+            stats = results.get(timeout=30)
+        finally:
+            process.terminate()
+            process.join()
+        firsts = sorted(first for first, _, _ in stats if first is not None)
+        print(f'  {name:14s} time to first block median {statistics.median(firsts) * 1000:5.0f} ms, max {firsts[-1] * 1000:5.0f} ms, '
+              f'{sum(served for _, served, _ in stats)} blocks served, {sum(rejected for _, _, rejected in stats)} requests rejected')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+
+"""
+throughput benchmark of the peer wire framing on a recorded stream of mixed Piece, Have and Request messages.
+the stream is cut in reads of 4 KiB and 64 KiB, and parsed:
+- by the former bytes buffer, which was appended to on every read and sliced on every message (framing only)
+- by MessageBuffer, the framing layer of the connections (framing only)
+- by PeerConnection, the way the event loop feeds it, with the download decoder and a consumer calling receive()
+usage: python benchmarks/framing.py
+"""
+
+import asyncio
+import os
+import random
+import struct
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+_PIECES = 2000  # piece messages of the stream, each followed by have and request messages
+_HAVES = 20
+_REQUESTS = 5
+_NUM_PIECES = 10 ** 5  # pieces of the torrent
+_READ_SIZES = (2 ** 12, 2 ** 16)
+_REPEAT = 3
+
+
+def record() -> List[bytes]:
+    """
+    :return: the messages of the stream
+    """
+    from RaBit.peer.message_types import Have, Piece, Request, BLOCK_SIZE
+
+    random.seed(0)
+    messages = []
+    for index in range(_PIECES):
+        messages.append(Piece.encode(index, 0, os.urandom(BLOCK_SIZE)))
+        messages += [Have.encode(random.randrange(_NUM_PIECES)) for _ in range(_HAVES)]
+        messages += [Request.encode(index, 0, BLOCK_SIZE) for _ in range(_REQUESTS)]
+    return messages
+
+
+def bytes_framing(stream: bytes, read_size: int) -> int:
+    """
+    the former framing: an immutable bytes buffer
+    """
+    count = 0
+    buffer = b''
+    for offset in range(0, len(stream), read_size):
+        buffer += stream[offset:offset + read_size]
+        while len(buffer) >= 4:
+            length = struct.unpack('>I', buffer[0:4])[0] + 4
+            if len(buffer) < length:
+                break
+            msg = buffer[:length]
+            buffer = buffer[length:]
+            count += 1
+    return count
+
+
+def message_buffer_framing(stream: bytes, read_size: int) -> int:
+    from RaBit.peer.framing import MessageBuffer
+
+    count = 0
+    messages = MessageBuffer()
+    view = memoryview(stream)
+    for offset in range(0, len(stream), read_size):
+        data = view[offset:offset + read_size]
+        messages.get_free_space(len(data))[:len(data)] = data
+        messages.commit(len(data))
+        while messages.next_message() is not None:
+            count += 1
+    return count
+
+
+class Transport:
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+
+def connection_framing(stream: bytes, read_size: int) -> int:
+    from RaBit.peer.connection import PeerConnection
+    from RaBit.peer.message_types import build_decoder
+    from RaBit.peer.peer_communication import _SUPPORTED_MESSAGES
+
+    async def main() -> int:
+        count = 0
+        connection = PeerConnection(build_decoder(_SUPPORTED_MESSAGES, _NUM_PIECES))
+        connection.connection_made(Transport())
+        connection.is_framing = True
+        view = memoryview(stream)
+        for offset in range(0, len(stream), read_size):
+            # what the event loop does when data arrives
+            data = view[offset:offset + read_size]
+            connection.get_buffer(len(data))[:len(data)] = data
+            connection.buffer_updated(len(data))
+            while connection.inbox:
+                await connection.receive()
+                count += 1
+        return count
+
+    return asyncio.run(main())
+
+
+def main():
+    messages = record()
+    stream = b''.join(messages)
+    print(f'{len(messages)} messages, {len(stream) / 2 ** 20:.1f} MiB: {_PIECES} Piece, {_PIECES * _HAVES} Have, {_PIECES * _REQUESTS} Request')
+    for read_size in _READ_SIZES:
+        for name, parse in (('bytes buffer', bytes_framing), ('MessageBuffer', message_buffer_framing), ('PeerConnection', connection_framing)):
+            elapsed = float('inf')
+            for _ in range(_REPEAT):
+                begin = time.perf_counter()
+                assert parse(stream, read_size) == len(messages)
+                elapsed = min(elapsed, time.perf_counter() - begin)
+            print(f'  reads of {read_size // 1024:2d} KiB, {name:15s} {len(stream) / elapsed / 2 ** 20:8.0f} MiB/s {len(messages) / elapsed / 1e6:6.2f}M msg/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+"""
+loopback swarm benchmark of request pipelining under latency. a remote process runs a seed for every round trip time
+in _RTTS, each on its own port. a seed delays every request by its round trip time, then sends the block at _RATE.
+the client downloads from all of them with tcp_wire_communication, one connection per seed.
+prints, for every seed, the throughput from _WARMUP seconds until the end of the connection, the time until it first reached 90% of its rate,
+and the median pipeline and latency of the connection over the second half of the run.
+usage: python benchmarks/latency_swarm.py [rtt ms,rtt ms,...]
+"""
+
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import os
+import statistics
+import struct
+import sys
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+_RTTS = [float(rtt) / 1000 for rtt in (sys.argv[1] if len(sys.argv) > 1 else '20,50,100,200,300').split(',')]
+_RATE = 4 * 2 ** 20  # upload rate of every seed, bytes per second
+_RUN = 12  # seconds
+_WARMUP = 4  # seconds
+_PIECE_LENGTH = 256 * 1024
+_PIECES = 20000
+_INFO_HASH = b'l' * 20
+_PORT = 47401
+
+
+def seeds(results: multiprocessing.Queue) -> None:
+    from RaBit.peer.message_types import Bitfield, Unchoke, Piece, REQUEST
+    import numpy as np
+
+    sent: Dict[int, List[float]] = {}  # seed -> times its blocks were sent
+    closed = []
+
+    def serve(number: int, rtt: float):
+        async def handle(reader, writer):
+            loop = asyncio.get_running_loop()
+            await reader.readexactly(68)
+            writer.write(struct.pack('>B19sQ20s20s', 19, b'BitTorrent protocol', 0, _INFO_HASH, os.urandom(20)))
+            writer.write(Bitfield.encode(np.ones(_PIECES, dtype=bool)))
+            writer.write(Unchoke.encode())
+            await writer.drain()
+            begin, last_send = time.perf_counter(), 0.0
+            times = sent.setdefault(number, [])
+
+            def send(index: int, offset: int, size: int) -> None:
+                if not writer.is_closing():
+                    writer.write(Piece.encode(index, offset, bytes(size)))
+                    times.append(time.perf_counter() - begin)
+
+            try:
+                while True:
+                    length = struct.unpack('>I', await reader.readexactly(4))[0]
+                    body = await reader.readexactly(length)
+                    if body and body[0] == REQUEST:
+                        index, offset, size = struct.unpack('>III', body[1:])
+                        now = time.perf_counter()
+                        # the request reaches the seed after half a round trip, the block leaves at the upload rate
+                        # and travels the other half
+                        last_send = max(now + rtt, last_send + size / _RATE)
+                        loop.call_later(last_send - now, send, index, offset, size)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            closed.append(number)
+            if len(closed) == len(_RTTS):
+                results.put(sent)
+        return handle
+
+    async def main():
+        for number, rtt in enumerate(_RTTS):
+            await asyncio.start_server(serve(number, rtt), '127.0.0.1', _PORT + number)
+        await asyncio.Future()
+    asyncio.run(main())
+
+
+class Session:
+    downloaded = wasted = corrupted = uploaded = 0
+
+    def __init__(self, TorrentData) -> None:
+        from RaBit.bandwidth import RateEstimator
+        from RaBit.download.metadata import Metadata
+        self.TorrentData = TorrentData
+        self.metadata = Metadata(TorrentData.info_hash, TorrentData.info)
+        self.downloading = RateEstimator()
+        self.uploading = RateEstimator()
+
+
+class ChokingManager:
+    async def report_interested(self, peer):
+        pass
+
+    async def report_uninterested(self, peer):
+        pass
+
+
+async def client() -> Dict[int, List]:
+    """
+    :return: seed -> samples of (pipeline, latency) of its connection, every 0.5 s
+    """
+    import bitstring
+    from RaBit.download.piece_picker import PiecePicker
+    from RaBit.download.upload_scheduler import UploadScheduler
+    from RaBit.peer.peer_communication import tcp_wire_communication
+    from RaBit.peer.peer_object import Peer
+    from RaBit.torrent.torrent_object import Torrent
+
+    torrent = Torrent(info={b'piece length': _PIECE_LENGTH}, info_hash=_INFO_HASH, piece_hashes=[b''] * _PIECES,
+                      multi_file=False, peer_id=b'c' * 20, length=_PIECES * _PIECE_LENGTH)
+    Peer.peer_instances[_INFO_HASH] = []
+    session = Session(torrent)
+    piece_picker = PiecePicker(torrent, session, bitstring.BitArray(_PIECES))
+    samples: Dict[int, List] = {}
+
+    async def save_pieces():
+        while True:
+            piece = await piece_picker.results_queue.get()
+            piece.reset()
+            piece.release()
+
+    async def sample():
+        while True:
+            await asyncio.sleep(0.5)
+            for peer in Peer.peer_instances[_INFO_HASH]:
+                samples.setdefault(peer.address[1] - _PORT, []).append((peer.MAX_PIPELINE_SIZE, peer.latency))
+
+    tasks = [asyncio.create_task(save_pieces()), asyncio.create_task(sample())]
+    tasks += [asyncio.create_task(tcp_wire_communication((('127.0.0.1', _PORT + number), None, 0), torrent, session, None, piece_picker,
+                                                         ChokingManager(), UploadScheduler(None, session))) for number in range(len(_RTTS))]
+    await asyncio.sleep(_RUN)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return samples
+
+
+def main():
+    from RaBit.download.data_structures import BLOCK_SIZE
+
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=seeds, args=(results,), daemon=True)
+    process.start()
+    time.sleep(0.5)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):  # the connections print their state
+            samples = asyncio.run(client())
+        sent = results.get(timeout=30)
+    finally:
+        process.terminate()
+
+    total = 0
+    print(f'{len(_RTTS)} seeds of {_RATE / 2 ** 20:.0f} MiB/s each')
+    for number, rtt in enumerate(_RTTS):
+        times = sent.get(number, [0.0])
+        end = max(times)  # the connection ends a bit before the run, it is made after the client started
+        rate = sum(1 for sent_at in times if _WARMUP <= sent_at < end) * BLOCK_SIZE / (end - _WARMUP) / 2 ** 20
+        total += rate
+        # one second of blocks reaches 90% of the upload rate
+        ramp_up = next((sent_at for sent_at in times if sum(1 for other in times if sent_at - 1 <= other < sent_at) * BLOCK_SIZE >= 0.9 * _RATE), None)
+        steady = samples.get(number, [])[len(samples.get(number, [])) // 2:]
+        pipeline = statistics.median(size for size, _ in steady) if steady else 0
+        latency = statistics.median(latency for _, latency in steady if latency) * 1000 if steady else 0
+        print(f'  rtt {rtt * 1000:4.0f} ms (bdp {_RATE * rtt / BLOCK_SIZE:3.0f} blocks): {rate:5.2f} MiB/s, '
+              f'90% after {"-" if ramp_up is None else f"{ramp_up:.1f} s"}, pipeline {pipeline:4.0f}, latency {latency:4.0f} ms')
+    print(f'  total {total:.2f} MiB/s of {len(_RTTS) * _RATE / 2 ** 20:.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+"""
+micro-benchmark of the peer wire codec: encode and decode throughput of every message type. decoding goes through the
+decoder that a downloading connection builds, the dispatch column also hands the message to the dispatch table.
+usage: python benchmarks/message_codec.py
+"""
+
+import asyncio
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+_PIECES = 2000  # pieces of the torrent, the length of a bitfield
+_NUMBER = 200000  # messages per measurement
+_REPEAT = 3
+
+
+def main():
+    from RaBit.peer.message_types import (Choke, Unchoke, Interested, NotInterested, Have, Bitfield, Request, Piece,
+                                          Cancel, Port, HaveAll, HaveNone, RejectRequest, AllowedFast, Extended,
+                                          FAST_MESSAGES, EXTENDED, build_decoder, build_dispatcher, BLOCK_SIZE)
+    from RaBit.peer.peer_communication import _SUPPORTED_MESSAGES
+
+    bitfield = np.arange(_PIECES) % 2 == 0
+    block = bytes(BLOCK_SIZE)
+    cases = [
+        ('Choke', Choke.encode, ()),
+        ('Unchoke', Unchoke.encode, ()),
+        ('Interested', Interested.encode, ()),
+        ('NotInterested', NotInterested.encode, ()),
+        ('Have', Have.encode, (123456,)),
+        (f'Bitfield({_PIECES})', Bitfield.encode, (bitfield,)),
+        ('Request', Request.encode, (1, BLOCK_SIZE, BLOCK_SIZE)),
+        ('Piece(16 KiB)', Piece.encode, (1, BLOCK_SIZE, block)),
+        ('Cancel', Cancel.encode, (1, BLOCK_SIZE, BLOCK_SIZE)),
+        ('Port', Port.encode, (6881,)),
+        ('HaveAll', HaveAll.encode, ()),
+        ('HaveNone', HaveNone.encode, ()),
+        ('RejectRequest', RejectRequest.encode, (1, BLOCK_SIZE, BLOCK_SIZE)),
+        ('AllowedFast', AllowedFast.encode, (7,)),
+        ('Extended', Extended.encode, (1, b'd1:md6:ut_pexi1eee')),
+    ]
+    decode = build_decoder(_SUPPORTED_MESSAGES + FAST_MESSAGES + (EXTENDED,), _PIECES)
+    dispatch = build_dispatcher({msg_id: lambda msg: None for msg_id in range(256)})
+    loop = asyncio.new_event_loop()
+
+    def dispatch_all(msg: memoryview, number: int) -> None:
+        async def run():
+            for _ in range(number):
+                await dispatch(decode(msg))
+        loop.run_until_complete(run())
+
+    print(f'{"message":16s}{"encode":>12s}{"decode":>12s}{"dispatch":>12s}   million messages/s')
+    for name, encode, args in cases:
+        msg = memoryview(encode(*args))
+        number = _NUMBER // 4 if len(msg) > 1000 else _NUMBER
+        encode_time = min(timeit.repeat(lambda: encode(*args), number=number, repeat=_REPEAT)) / number
+        decode_time = min(timeit.repeat(lambda: decode(msg), number=number, repeat=_REPEAT)) / number
+        dispatch_time = min(timeit.repeat(lambda: dispatch_all(msg, number), number=1, repeat=_REPEAT)) / number
+        print(f'{name:16s}{1 / encode_time / 1e6:12.2f}{1 / decode_time / 1e6:12.2f}{1 / dispatch_time / 1e6:12.2f}')
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+"""
+loopback benchmark of 200 peer wire connections, measuring the cpu the client process spends per connection.
+a separate process accepts the connections, and either keeps them idle or sends _PER_CONNECTION bytes of piece
+messages on each as fast as it can. the client receives through PeerConnection, or through a StreamReader polled with
+asyncio.wait_for(read(), 0.5) like the connections did before.
+idle: microseconds of client cpu per connection per second. full speed: milliseconds of client cpu per MiB received.
+usage: python benchmarks/peer_connections.py
+"""
+
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+_CONNECTIONS = 200
+_PER_CONNECTION = 4 * 2 ** 20  # bytes sent on every connection at full speed
+_IDLE_TIME = 10  # seconds
+_PORT = 47201
+_NUM_PIECES = 1000
+
+
+def sender(mode: str) -> None:
+    from RaBit.peer.message_types import Piece, BLOCK_SIZE
+
+    chunk = Piece.encode(0, 0, bytes(BLOCK_SIZE)) * 16
+
+    async def handle(reader, writer):
+        if mode == 'idle':
+            await reader.read()  # until the client closes the connection
+        else:
+            for _ in range(_PER_CONNECTION // len(chunk)):
+                writer.write(chunk)
+                await writer.drain()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', _PORT, backlog=_CONNECTIONS)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
+
+
+async def polling_client(count: List[int]) -> None:
+    """
+    the former receiving loop: a read of up to 64 KiB, given up every 0.5 s
+    """
+    from RaBit.peer.framing import MessageBuffer, _READ_SIZE
+    from RaBit.peer.message_types import build_decoder
+    from RaBit.peer.peer_communication import _SUPPORTED_MESSAGES
+
+    decode = build_decoder(_SUPPORTED_MESSAGES, _NUM_PIECES)
+    reader, writer = await asyncio.open_connection('127.0.0.1', _PORT)
+    messages = MessageBuffer()
+    try:
+        while True:
+            try:
+                data = await asyncio.wait_for(reader.read(_READ_SIZE), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            if not data:
+                break
+            messages.feed(data)
+            while (msg := messages.next_message()) is not None:
+                decode(msg)
+                count[0] += 1
+    finally:
+        writer.close()
+
+
+async def connection_client(count: List[int]) -> None:
+    from RaBit.peer.connection import open_peer_connection
+    from RaBit.peer.message_types import build_decoder
+    from RaBit.peer.peer_communication import _SUPPORTED_MESSAGES
+
+    connection = await open_peer_connection(('127.0.0.1', _PORT), build_decoder(_SUPPORTED_MESSAGES, _NUM_PIECES))
+    try:
+        while True:
+            if await connection.receive() is not None:
+                count[0] += 1
+    except StopAsyncIteration:
+        pass
+    finally:
+        connection.close()
+
+
+async def run(client, mode: str) -> str:
+    count = [0]
+    tasks = [asyncio.create_task(client(count)) for _ in range(_CONNECTIONS)]
+    if mode == 'idle':
+        await asyncio.sleep(1)
+        cpu = time.process_time()
+        await asyncio.sleep(_IDLE_TIME)
+        cpu = time.process_time() - cpu
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return f'{cpu / _IDLE_TIME / _CONNECTIONS * 1e6:.1f} us cpu per connection per second'
+
+    cpu, begin = time.process_time(), time.perf_counter()
+    await asyncio.gather(*tasks)
+    cpu, elapsed = time.process_time() - cpu, time.perf_counter() - begin
+    mib = _CONNECTIONS * _PER_CONNECTION / 2 ** 20
+    return f'{cpu / mib * 1e3:.2f} ms cpu per MiB, {mib / elapsed:.0f} MiB/s aggregate, {count[0]} messages'
+
+
+def main():
+    for mode in ('idle', 'full speed'):
+        for name, client in (('StreamReader', polling_client), ('PeerConnection', connection_client)):
+            process = multiprocessing.Process(target=sender, args=(mode,), daemon=True)
+            process.start()
+            time.sleep(0.5)
+            try:
+                print(f'{mode:10s} {name:15s} {asyncio.run(run(client, mode))}')
+            finally:
+                process.terminate()
+                process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+"""
+loopback swarm benchmark of request sending. _PEERS connections run tcp_wire_communication against a seeder process
+that answers every request right away. prints the requests per second the seeder answered, the ramp-up time of a
+connection (until its first 10 and 50 requests arrived after the unchoke) and the number of writes per request.
+the outbox coalesces the messages of a connection into a write per loop iteration, the uncoalesced run writes every
+message on its own (a flush threshold of 0).
+usage: python benchmarks/request_pipeline.py [number of peers]
+"""
+
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import os
+import statistics
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+_PEERS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+_RUN = 5  # seconds
+_PIECE_LENGTH = 64 * 1024
+_PIECES = 20000
+_INFO_HASH = b'r' * 20
+_PORT = 47301
+
+
+def seeder(results: multiprocessing.Queue) -> None:
+    from RaBit.peer.message_types import Bitfield, Unchoke, Piece, REQUEST
+    import numpy as np
+
+    stats = []
+
+    async def handle(reader, writer):
+        await reader.readexactly(68)
+        writer.write(struct.pack('>B19sQ20s20s', 19, b'BitTorrent protocol', 0, _INFO_HASH, os.urandom(20)))
+        writer.write(Bitfield.encode(np.ones(_PIECES, dtype=bool)))
+        writer.write(Unchoke.encode())
+        await writer.drain()
+        begin, arrivals = time.perf_counter(), []
+        try:
+            while True:
+                length = struct.unpack('>I', await reader.readexactly(4))[0]
+                body = await reader.readexactly(length)
+                if body and body[0] == REQUEST:
+                    index, offset, size = struct.unpack('>III', body[1:])
+                    arrivals.append(time.perf_counter() - begin)
+                    writer.write(Piece.encode(index, offset, bytes(size)))
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        stats.append(arrivals)
+        if len(stats) == _PEERS:
+            results.put(stats.copy())  # pickled later, by the feeder thread of the queue
+            stats.clear()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', _PORT)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
+
+
+class Session:
+    downloaded = wasted = corrupted = uploaded = 0
+
+    def __init__(self, TorrentData) -> None:
+        from RaBit.bandwidth import RateEstimator
+        from RaBit.download.metadata import Metadata
+        self.TorrentData = TorrentData
+        self.metadata = Metadata(TorrentData.info_hash, TorrentData.info)
+        self.downloading = RateEstimator()
+        self.uploading = RateEstimator()
+
+
+class ChokingManager:
+    async def report_interested(self, peer):
+        pass
+
+    async def report_uninterested(self, peer):
+        pass
+
+
+async def client(flush_threshold: int) -> int:
+    """
+    :return: number of writes of the client
+    """
+    import bitstring
+    from RaBit.download.piece_picker import PiecePicker
+    from RaBit.download.upload_scheduler import UploadScheduler
+    from RaBit.peer import connection, peer_object
+    from RaBit.peer.outbox import Outbox
+    from RaBit.peer.peer_communication import tcp_wire_communication
+    from RaBit.peer.peer_object import Peer
+    from RaBit.torrent.torrent_object import Torrent
+
+    writes = [0]
+    write = connection.PeerConnection.write
+
+    def counted_write(self, data):
+        writes[0] += 1
+        write(self, data)
+    connection.PeerConnection.write = counted_write
+    if flush_threshold is not None:
+        peer_object.Outbox = lambda writer, _: Outbox(writer, flush_threshold)
+
+    torrent = Torrent(info={b'piece length': _PIECE_LENGTH}, info_hash=_INFO_HASH, piece_hashes=[b''] * _PIECES,
+                      multi_file=False, peer_id=b'c' * 20, length=_PIECES * _PIECE_LENGTH)
+    Peer.peer_instances[_INFO_HASH] = []
+    session = Session(torrent)
+    piece_picker = PiecePicker(torrent, session, bitstring.BitArray(_PIECES))
+
+    async def save_pieces():
+        while True:
+            piece = await piece_picker.results_queue.get()
+            piece.reset()
+            piece.release()
+
+    tasks = [asyncio.create_task(save_pieces())]
+    tasks += [asyncio.create_task(tcp_wire_communication((('127.0.0.1', _PORT), None, 0), torrent, session, None, piece_picker,
+                                                         ChokingManager(), UploadScheduler(None, session))) for _ in range(_PEERS)]
+    await asyncio.sleep(_RUN)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    connection.PeerConnection.write = write
+    peer_object.Outbox = Outbox
+    return writes[0]
+
+
+def main():
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=seeder, args=(results,), daemon=True)
+    process.start()
+    time.sleep(0.5)
+    try:
+        for name, flush_threshold in (('coalesced', None), ('uncoalesced', 0)):
+            with contextlib.redirect_stdout(io.StringIO()):  # the connections print their state
+                writes = asyncio.run(client(flush_threshold))
+            stats = results.get(timeout=30)
+            requests = sum(map(len, stats))
+            first_10 = statistics.median(arrivals[9] for arrivals in stats if len(arrivals) >= 10)
+            first_50 = statistics.median(arrivals[49] for arrivals in stats if len(arrivals) >= 50)
+            print(f'{name:12s} {_PEERS} peers: {requests / _RUN:.0f} requests/s ({requests * 16 / 1024 / _RUN:.0f} MiB/s), '
+                  f'first 10 requests after unchoke {first_10 * 1000:.1f} ms, first 50 {first_50 * 1000:.1f} ms (median), '
+                  f'{writes / requests:.2f} client writes per request')
+    finally:
+        process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+"""
+benchmark of the streaming window: the time until the first N MiB of a torrent can be read in order.
+a swarm of simulated seeds of different rates serves the requests of the real piece picker in virtual time.
+the download runs rarest-first only, and with a streaming window of _WINDOW pieces ahead of the read cursor.
+usage: python benchmarks/streaming.py
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+import types
+
+import bitstring
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+_PIECES = 2000
+_PIECE_LENGTH = 256 * 1024
+_SEEDS = 20
+_RATES = (50, 100, 200, 400, 800, 1600)  # KiB/s a seed may upload at
+_PIPELINE = 16
+_WINDOW = 16  # pieces
+_TARGETS = (4, 16, 32)  # MiB
+_STEP = 0.01  # seconds of virtual time
+_TIMEOUT = 600  # seconds of virtual time
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class Writer:
+    def write(self, data: bytes) -> None:
+        pass
+
+    def wake(self) -> None:
+        pass
+
+
+class Session:
+    downloaded = wasted = 0
+
+    def __init__(self, clock: Clock) -> None:
+        from RaBit.bandwidth import RateEstimator
+        self.downloading = RateEstimator(clock=clock)
+
+
+async def download(streaming_window: int) -> dict:
+    """
+    :return: MiB -> virtual time until they could be read in order
+    """
+    import RaBit.download.piece_picker as piece_picker_module
+    from RaBit.bandwidth import RateEstimator
+    from RaBit.download.piece_picker import PiecePicker
+    from RaBit.download.data_structures import Block
+    from RaBit.peer.peer_object import Peer
+    from RaBit.torrent.torrent_object import Torrent
+
+    random.seed(0)
+    np.random.seed(0)
+    clock = Clock()
+    piece_picker_module.time = types.SimpleNamespace(time=clock)  # deadlines and speed classes run on the virtual clock
+    torrent = Torrent(info={b'piece length': _PIECE_LENGTH}, info_hash=bytes([streaming_window]) * 20, piece_hashes=[b''] * _PIECES,
+                      multi_file=False, peer_id=b's' * 20, length=_PIECES * _PIECE_LENGTH)
+    Peer.peer_instances[torrent.info_hash] = []
+    rng = random.Random(1)
+    rates = [rng.choice(_RATES) * 1024 for _ in range(_SEEDS)]
+    peers = []
+    for number in range(_SEEDS):
+        peer = Peer(Writer(), torrent, (f'10.0.0.{number}', 6881), None)
+        peer.uploading = RateEstimator(clock=clock)
+        peer.have_pieces[:] = True
+        peer.is_choked = False
+        Peer.peer_instances[torrent.info_hash].append(peer)
+        peers.append(peer)
+    piece_picker = PiecePicker(torrent, Session(clock), bitstring.BitArray(_PIECES), streaming_window=streaming_window)
+    for peer in peers:
+        piece_picker.add_peer_bitfield(peer.have_pieces)
+    file_status = PiecePicker.FILE_STATUS[torrent.info_hash]
+    queues = [[] for _ in peers]
+    budgets = [0.0 for _ in peers]
+
+    readable, times = 0, {}
+    while clock.now < _TIMEOUT and len(times) < len(_TARGETS):
+        for peer, queue, rate, number in zip(peers, queues, rates, range(_SEEDS)):
+            while len(queue) < _PIPELINE and isinstance((block := await piece_picker.get_block(peer)), Block):
+                queue.append(block)
+                peer.pipelined_requests[block.key] = (block, clock.now)
+
+            # the seed serves its queue
+            budgets[number] += rate * _STEP
+            while queue and budgets[number] >= queue[0].length:
+                block = queue.pop(0)
+                budgets[number] -= block.length
+                peer.pipelined_requests.pop(block.key, None)
+                peer.uploading.add(block.length)
+                await piece_picker.report_block(block, (bytes(block.length), peer.address), peer)
+            if not queue:
+                budgets[number] = 0
+
+        # the disk IO manager saves the completed pieces
+        while not piece_picker.results_queue.empty():
+            piece = piece_picker.results_queue.get_nowait()
+            file_status[piece.index] = True
+            piece_picker.num_of_pieces_left -= 1
+            piece.reset()
+            piece.release()
+
+        while readable < _PIECES and file_status[readable]:
+            readable += 1
+        for target in _TARGETS:
+            if target not in times and readable * _PIECE_LENGTH >= target * 2 ** 20:
+                times[target] = clock.now
+        clock.now += _STEP
+
+    Peer.peer_instances.pop(torrent.info_hash)
+    piece_picker_module.time = time
+    return times
+
+
+def main():
+    print(f'{_PIECES} pieces of {_PIECE_LENGTH // 1024} KiB, {_SEEDS} seeds of {min(_RATES)}-{max(_RATES)} KiB/s')
+    rarest_first = asyncio.run(download(0))
+    streaming = asyncio.run(download(_WINDOW))
+    for target in _TARGETS:
+        print(f'  first {target:2d} MiB: rarest-first {rarest_first.get(target, float("nan")):6.1f} s, '
+              f'streaming window of {_WINDOW} pieces {streaming.get(target, float("nan")):6.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+"""
+loopback benchmark of the uTP transport against tcp through an emulated bottleneck link.
+a relay process forwards the server -> client traffic through a drop-tail queue drained at _RATE bytes per second,
+and delays every direction by _DELAY. a udp ping crosses the same queue every 20 ms, its extra delay is the
+queueing delay that other traffic on the link suffers.
+usage: python benchmarks/utp_loopback.py tcp | utp | both
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+from typing import Callable, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+_RATE = 2 * 2 ** 20  # bytes per second of the bottleneck
+_DELAY = 0.02  # seconds, one way
+_QUEUE = 512 * 1024  # bytes the bottleneck queues before it drops
+_RUN = 20  # seconds
+_WARMUP = 5  # seconds before measuring
+_PING_INTERVAL = 0.02
+_SERVER, _TCP_RELAY, _UDP_RELAY, _PING_RELAY, _SERVER2, _TCP_RELAY2 = range(47101, 47107)
+
+
+class Link:
+    """
+    the bottleneck: packets leave the queue at the rate of the link, then arrive after the delay
+    """
+    def __init__(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.queued = 0
+        self.busy_until = 0.0
+
+    def put(self, size: int, deliver: Callable[[], None], may_drop: bool = True) -> bool:
+        """
+        :param size: bytes on the wire
+        :param deliver: called when the packet arrives
+        :param may_drop: false for tcp, which waits for room in the queue instead
+        :return: whether the packet was queued
+        """
+        if may_drop and self.queued + size > _QUEUE:
+            return False
+        self.busy_until = max(self.loop.time(), self.busy_until) + size / _RATE
+        self.queued += size
+        self.loop.call_at(self.busy_until, self.__leave, size, deliver)
+        return True
+
+    def __leave(self, size: int, deliver: Callable[[], None]) -> None:
+        self.queued -= size
+        self.loop.call_later(_DELAY, deliver)
+
+
+def relay() -> None:
+    async def main():
+        loop = asyncio.get_running_loop()
+        link = Link()
+
+        async def tcp_relay(listen: int, target: int) -> None:
+            async def handle(client_reader, client_writer):
+                server_reader, server_writer = await asyncio.open_connection('127.0.0.1', target)
+
+                async def upstream():
+                    while data := await client_reader.read(65536):
+                        loop.call_later(_DELAY, server_writer.write, data)
+
+                async def downstream():
+                    while data := await server_reader.read(1400):
+                        while link.queued + len(data) > _QUEUE:  # the queue is full, tcp backs off into its buffers
+                            await asyncio.sleep(0.001)
+                        link.put(len(data), lambda data=data: client_writer.write(data), may_drop=False)
+
+                await asyncio.gather(upstream(), downstream(), return_exceptions=True)
+            await asyncio.start_server(handle, '127.0.0.1', listen)
+
+        await tcp_relay(_TCP_RELAY, _SERVER)
+        await tcp_relay(_TCP_RELAY2, _SERVER2)
+
+        class UdpRelay(asyncio.DatagramProtocol):
+            """
+            relays a single uTP connection
+            """
+            client = None
+
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, address):
+                if address[1] == _SERVER:
+                    if self.client is not None:
+                        link.put(len(data) + 28, lambda: self.transport.sendto(data, self.client))
+                else:
+                    self.client = address
+                    loop.call_later(_DELAY, self.transport.sendto, data, ('127.0.0.1', _SERVER))
+
+        class PingRelay(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, address):
+                loop.call_later(_DELAY, lambda: link.put(len(data) + 28, lambda: self.transport.sendto(data, address)))
+
+        await loop.create_datagram_endpoint(UdpRelay, local_addr=('127.0.0.1', _UDP_RELAY))
+        await loop.create_datagram_endpoint(PingRelay, local_addr=('127.0.0.1', _PING_RELAY))
+        await asyncio.Future()
+    asyncio.run(main())
+
+
+class Bulk(asyncio.Protocol):
+    """
+    sends as fast as the transport takes it
+    """
+    def connection_made(self, transport):
+        self.transport = transport
+        self.paused = False
+        self.chunk = os.urandom(65536)
+        self.fill()
+
+    def fill(self):
+        while not self.paused and not self.transport.is_closing():
+            self.transport.write(self.chunk)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        asyncio.get_running_loop().call_soon(self.fill)
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self.paused = True
+
+
+def server() -> None:
+    from RaBit.utp import start_utp_server
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        await loop.create_server(Bulk, '127.0.0.1', _SERVER)
+        await loop.create_server(Bulk, '127.0.0.1', _SERVER2)
+        await start_utp_server(Bulk, '127.0.0.1', _SERVER)
+        await asyncio.Future()
+    asyncio.run(main())
+
+
+class Count(asyncio.Protocol):
+    def __init__(self):
+        self.received = 0
+
+    def data_received(self, data):
+        self.received += len(data)
+
+
+async def client(mode: str) -> None:
+    from RaBit.utp import open_utp_connection
+    loop = asyncio.get_running_loop()
+
+    flows: List[Tuple[str, asyncio.BaseTransport, Count]] = []
+    if mode in ('tcp', 'both'):
+        transport, protocol = await loop.create_connection(Count, '127.0.0.1', _TCP_RELAY2 if mode == 'both' else _TCP_RELAY)
+        flows.append(('tcp', transport, protocol))
+    if mode in ('utp', 'both'):
+        transport, protocol = await open_utp_connection(('127.0.0.1', _UDP_RELAY), Count)
+        flows.append(('utp', transport, protocol))
+
+    rtts: List[Tuple[float, float]] = []  # (time of arrival, round trip time)
+
+    class Pinger(asyncio.DatagramProtocol):
+        def datagram_received(self, data, address):
+            now = time.perf_counter()
+            rtts.append((now, now - float(data)))
+
+    ping_transport, _ = await loop.create_datagram_endpoint(Pinger, remote_addr=('127.0.0.1', _PING_RELAY))
+    begin = time.perf_counter()
+    start, measure_begin = None, 0.0
+    while (now := time.perf_counter()) - begin < _RUN:
+        if start is None and now - begin >= _WARMUP:
+            start = {name: protocol.received for name, _, protocol in flows}
+            measure_begin = now
+        ping_transport.sendto(repr(time.perf_counter()).encode())
+        await asyncio.sleep(_PING_INTERVAL)
+    elapsed = time.perf_counter() - measure_begin
+
+    results = [f'{name} {(protocol.received - start[name]) / elapsed / 2 ** 20:.2f} MiB/s' for name, _, protocol in flows]
+    delays = sorted((rtt - 2 * _DELAY) * 1000 for arrival, rtt in rtts if arrival - begin >= _WARMUP)
+    results.append(f'ping queueing delay median {statistics.median(delays):.0f} ms, p95 {delays[int(len(delays) * 0.95)]:.0f} ms')
+    print(mode, '|', ', '.join(results), f'| link {_RATE / 2 ** 20:.0f} MiB/s, {_DELAY * 2000:.0f} ms rtt, {_QUEUE // 1024} KiB queue')
+
+    for _, transport, _ in flows:
+        transport.close()
+    ping_transport.close()
+    await asyncio.sleep(0.5)
+
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] not in ('tcp', 'utp', 'both'):
+        sys.exit(__doc__.strip().splitlines()[-1])
+    logging.getLogger('asyncio').setLevel(logging.CRITICAL)
+    processes = [multiprocessing.Process(target=relay, daemon=True), multiprocessing.Process(target=server, daemon=True)]
+    for process in processes:
+        process.start()
+    time.sleep(1)
+    try:
+        asyncio.run(client(sys.argv[1]))
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
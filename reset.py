@@ -27,6 +27,10 @@ if __name__ == '__main__':
             json_file.truncate()
             json.dump([], json_file)
 
+        # forget the dht node cache
+        with open(os.path.join(parent_path, 'dht_nodes.json'), 'w') as json_file:
+            json.dump({'id': '', 'nodes': []}, json_file)
+
         # reset config
         with open(os.path.join(parent_path, 'default_config.json'), 'r') as json_file:
             default = json.load(json_file)
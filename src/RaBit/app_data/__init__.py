@@ -1,7 +1,7 @@
 from .db_utils import (get_configuration, set_configuration, get_banned_countries, set_banned_countries, get_client,
-                       get_ongoing_torrents, add_ongoing_torrent, remove_ongoing_torrent,
+                       get_ongoing_torrents, add_ongoing_torrent, remove_ongoing_torrent, get_dht_nodes, save_dht_nodes,
                        BannedPeersDB, CompletedTorrentsDB)
 
 __all__ = ['get_configuration', 'set_configuration', 'get_banned_countries', 'set_banned_countries', 'get_client',
-           'get_ongoing_torrents', 'add_ongoing_torrent', 'remove_ongoing_torrent',
+           'get_ongoing_torrents', 'add_ongoing_torrent', 'remove_ongoing_torrent', 'get_dht_nodes', 'save_dht_nodes',
            'BannedPeersDB', 'CompletedTorrentsDB']
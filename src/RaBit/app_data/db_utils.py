@@ -18,7 +18,8 @@ Peers = namedtuple('Peers', 'address geodata client')
 
 def get_configuration(config_to_get: str) -> Any:
     """
-    gets a configuration from config.json file
+    gets a configuration from config.json file.
+    a config.json of an older version lacks the newer settings, they are taken from default_config.json
     :param config_to_get: what setting to get
     :return: Any
     """
@@ -26,7 +27,12 @@ def get_configuration(config_to_get: str) -> Any:
         configs: Dict[str, Any] = json.load(json_file)
         if config_to_get in configs:
             return configs[config_to_get]
-        return None
+    return __get_default_configurations().get(config_to_get)
+
+
+def __get_default_configurations() -> Dict[str, Any]:
+    with open(abs_db_path('default_config.json'), 'r') as json_file:
+        return json.load(json_file)
 
 
 async def set_configuration(config_to_set: str, new_value: Any) -> bool:
@@ -40,7 +46,7 @@ async def set_configuration(config_to_set: str, new_value: Any) -> bool:
         async with asyncio.Lock():
             with open(abs_db_path('config.json'), 'r+') as json_file:
                 configs: Dict[str, Any] = json.load(json_file)
-                if config_to_set in configs:
+                if config_to_set in configs or config_to_set in __get_default_configurations():  # newer settings are added
                     configs[config_to_set] = new_value
                     json_file.seek(0)
                     json_file.truncate()
@@ -99,13 +105,14 @@ def get_ongoing_torrents() -> List[Tuple[str]]:
         return torrents
 
 
-async def add_ongoing_torrent(torrent_file_path: str, download_dir_path: str):
+async def add_ongoing_torrent(torrent_file_path: str, download_dir_path: str, file_priorities: List[int] = None):
     with threading.Lock():
         async with asyncio.Lock():
             with open(abs_db_path('ongoing_torrents.json'), 'r+') as json_file:
                 torrents: List[List[str]] = json.load(json_file)
                 if torrent_file_path not in map(lambda x: x[0], torrents):
-                    torrents.append([torrent_file_path, download_dir_path])
+                    # file priorities are kept only for selective downloads
+                    torrents.append([torrent_file_path, download_dir_path] + ([file_priorities] if file_priorities is not None else []))
                     json_file.seek(0)
                     json_file.truncate()
                     json.dump(torrents, json_file)
@@ -121,6 +128,22 @@ def remove_ongoing_torrent(torrent_file_path: str):
             json.dump(torrents, json_file)
 
 
+def get_dht_nodes() -> Tuple[Union[bytes, None], List[Tuple[str, int]]]:
+    """
+    gets the DHT node id and the nodes of the routing table from the last run
+    :return: node id | None on the first run, (ip, port) of the nodes
+    """
+    with open(abs_db_path('dht_nodes.json'), 'r') as json_file:
+        state: Dict[str, Any] = json.load(json_file)
+        return bytes.fromhex(state['id']) if state['id'] else None, [tuple(address) for address in state['nodes']]
+
+
+def save_dht_nodes(node_id: bytes, nodes: List[Tuple[str, int]]):
+    with threading.Lock():
+        with open(abs_db_path('dht_nodes.json'), 'w') as json_file:
+            json.dump({'id': node_id.hex(), 'nodes': nodes}, json_file)
+
+
 class Singleton:
     """
     singleton pattern instance for sqlite databases instances
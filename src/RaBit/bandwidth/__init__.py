@@ -0,0 +1,6 @@
+from .rate_limiter import (TokenBucket, RateLimiter, UPLOAD, DOWNLOAD, load_rate_limits, set_global_rates, set_torrent_rates,
+                           remove_torrent_rates, set_peer_rates)
+from .rate_estimator import RateEstimator
+
+__all__ = ['TokenBucket', 'RateLimiter', 'UPLOAD', 'DOWNLOAD', 'load_rate_limits', 'set_global_rates', 'set_torrent_rates',
+           'remove_torrent_rates', 'set_peer_rates', 'RateEstimator']
@@ -0,0 +1,54 @@
+import time
+from math import exp, expm1
+from typing import Dict, Any, Callable
+
+_DEFAULT_WINDOW = 2.0  # seconds, the time constant of the decay
+_MIN_SPAN = 1.0  # seconds, a new estimator spreads its first bytes over at least this long
+
+
+class RateEstimator:
+    """
+    estimates the rate of a stream of bytes with an exponentially decayed byte counter.
+    the weight of every byte decays by e every window, so the rate follows a change of speed within a few windows
+    and does not jump with the size or the timing of single messages. an update costs a single exp().
+    a new estimator only counts the time since it started, so it is accurate from the first second.
+    not thread-safe, but the estimator is only updated by the event loop of its connection and a read from
+    another thread sees a rate that is at most one message behind.
+    only the window is pickled, the rate of a torrent that was stored starts over on the monotonic clock
+    """
+    def __init__(self, window: float = _DEFAULT_WINDOW, clock: Callable[[], float] = time.monotonic) -> None:
+        """
+        :param window: time constant of the decay in seconds, shorter follows changes faster but is noisier
+        :param clock: returns the current time in seconds
+        :return: None
+        """
+        self.window = window
+        self.clock = clock
+        self.counter = 0.0  # decayed bytes
+        self.start = self.last_update = clock()
+
+    def add(self, size: int) -> None:
+        """
+        counts transferred bytes
+        :param size: number of bytes
+        :return: None
+        """
+        now = self.clock()
+        self.counter = self.counter * exp((self.last_update - now) / self.window) + size
+        self.last_update = now
+
+    @property
+    def rate(self) -> float:
+        """
+        the rate in bytes per second
+        """
+        now = self.clock()
+        # a constant rate r fills the counter up to r * window * (1 - e^(-elapsed / window))
+        span = -self.window * expm1(-max(now - self.start, _MIN_SPAN) / self.window)
+        return self.counter * exp((self.last_update - now) / self.window) / span
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {'window': self.window}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state['window'])
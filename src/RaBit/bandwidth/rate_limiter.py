@@ -0,0 +1,173 @@
+from ..app_data import db_utils
+
+import threading
+import time
+import weakref
+from typing import Tuple, Dict, Set
+
+# directions of the traffic
+UPLOAD = 0
+DOWNLOAD = 1
+
+_MIN_BURST = 2 ** 16  # bytes a bucket holds at least, a block with its message header passes at once
+_BURST_TIME = 0.5  # seconds of traffic a bucket holds, longer bursts are smoothed
+
+
+class TokenBucket:
+    """
+    a token bucket that limits the rate of traffic, thread-safe since the downloads and the seeding server
+    run in separate threads.
+    the bucket fills at the rate up to its burst size. traffic takes its bytes right away and may leave the bucket
+    in debt, the traffic that follows waits until the debt is paid back
+    """
+    def __init__(self, rate: int = 0) -> None:
+        """
+        :param rate: bytes per second, 0 for unlimited
+        :return: None
+        """
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0.0
+        self.last_update = time.monotonic()
+        self.set_rate(rate)
+        self.tokens = self.burst
+
+    def set_rate(self, rate: int) -> None:
+        """
+        changes the rate, takes effect right away
+        :param rate: bytes per second, 0 for unlimited
+        :return: None
+        """
+        with self.lock:
+            self.rate = max(int(rate or 0), 0)
+            self.burst = max(self.rate * _BURST_TIME, _MIN_BURST)
+            self.tokens = min(self.tokens, self.burst)
+
+    def consume(self, size: int) -> float:
+        """
+        takes bytes from the bucket
+        :param size: number of bytes, 0 to ask for the current debt only
+        :return: seconds to wait before more traffic, 0 if there is no debt
+        """
+        with self.lock:
+            if self.rate == 0:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.last_update) * self.rate, self.burst) - size
+            self.last_update = now
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+def _configured_rates(upload_key: str, download_key: str) -> Tuple[int, int]:
+    return db_utils.get_configuration(upload_key) or 0, db_utils.get_configuration(download_key) or 0
+
+
+# client-wide buckets, and the default rates of the buckets of every torrent and every connection
+_global_buckets = (TokenBucket(), TokenBucket())
+_torrent_rates = [0, 0]
+_peer_rates = [0, 0]
+_torrent_buckets: Dict[bytes, Tuple[TokenBucket, TokenBucket]] = dict()
+_torrent_overrides: Set[bytes] = set()  # torrents with their own rates, the defaults don't change them
+_limiters: 'weakref.WeakSet[RateLimiter]' = weakref.WeakSet()
+_lock = threading.Lock()
+
+
+def load_rate_limits() -> None:
+    """
+    sets the rates of all the buckets from config.json
+    :return: None
+    """
+    set_global_rates(*_configured_rates('max_upload_rate', 'max_download_rate'))
+    set_torrent_rates(*_configured_rates('max_torrent_upload_rate', 'max_torrent_download_rate'))
+    set_peer_rates(*_configured_rates('max_peer_upload_rate', 'max_peer_download_rate'))
+
+
+def set_global_rates(upload: int, download: int) -> None:
+    """
+    :param upload: client-wide upload rate in bytes per second, 0 for unlimited
+    :param download: client-wide download rate in bytes per second, 0 for unlimited
+    :return: None
+    """
+    _global_buckets[UPLOAD].set_rate(upload)
+    _global_buckets[DOWNLOAD].set_rate(download)
+
+
+def _buckets_of(info_hash: bytes) -> Tuple[TokenBucket, TokenBucket]:
+    """
+    must be called with the lock held
+    """
+    if (buckets := _torrent_buckets.get(info_hash)) is None:
+        buckets = _torrent_buckets[info_hash] = (TokenBucket(_torrent_rates[UPLOAD]), TokenBucket(_torrent_rates[DOWNLOAD]))
+    return buckets
+
+
+def set_torrent_rates(upload: int, download: int, info_hash: bytes = None) -> None:
+    """
+    :param upload: upload rate of a torrent in bytes per second, 0 for unlimited
+    :param download: download rate of a torrent in bytes per second, 0 for unlimited
+    :param info_hash: the torrent | None to change the default of all the torrents without rates of their own
+    :return: None
+    """
+    with _lock:
+        if info_hash is not None:
+            _torrent_overrides.add(info_hash)
+            buckets = [_buckets_of(info_hash)]
+        else:
+            _torrent_rates[:] = upload, download
+            buckets = [buckets for torrent, buckets in _torrent_buckets.items() if torrent not in _torrent_overrides]
+    for upload_bucket, download_bucket in buckets:
+        upload_bucket.set_rate(upload)
+        download_bucket.set_rate(download)
+
+
+def remove_torrent_rates(info_hash: bytes) -> None:
+    """
+    forgets the buckets and the rates of a torrent that is neither downloaded nor seeded anymore.
+    connections made for it later start from the default rates
+    :param info_hash: the torrent
+    :return: None
+    """
+    with _lock:
+        _torrent_buckets.pop(info_hash, None)
+        _torrent_overrides.discard(info_hash)
+
+
+def set_peer_rates(upload: int, download: int) -> None:
+    """
+    :param upload: upload rate of every connection in bytes per second, 0 for unlimited
+    :param download: download rate of every connection in bytes per second, 0 for unlimited
+    :return: None
+    """
+    with _lock:
+        _peer_rates[:] = upload, download
+        limiters = list(_limiters)
+    for limiter in limiters:
+        limiter.buckets[UPLOAD][0].set_rate(upload)
+        limiter.buckets[DOWNLOAD][0].set_rate(download)
+
+
+class RateLimiter:
+    """
+    the rate limits of a single connection: its own buckets, the buckets of its torrent and the client-wide buckets.
+    the traffic of the connection is taken from all of them, and it waits for the slowest
+    """
+    def __init__(self, info_hash: bytes) -> None:
+        """
+        :param info_hash: info hash of the torrent of the connection
+        :return: None
+        """
+        with _lock:
+            torrent_buckets = _buckets_of(info_hash)
+            self.buckets = tuple((TokenBucket(_peer_rates[direction]), torrent_buckets[direction], _global_buckets[direction])
+                                 for direction in (UPLOAD, DOWNLOAD))
+            _limiters.add(self)
+
+    def consume(self, direction: int, size: int) -> float:
+        """
+        takes bytes from the buckets of a direction
+        :param direction: UPLOAD | DOWNLOAD
+        :param size: number of bytes, 0 to ask for the current debt only
+        :return: seconds to wait before more traffic in that direction
+        """
+        return max([bucket.consume(size) for bucket in self.buckets[direction]])  # every bucket takes the bytes
@@ -0,0 +1,5 @@
+from .node import DHTNode, start_dht_node, find_peers, announce, add_node, get_dht_port
+from .routing_table import RoutingTable, Node, K
+
+__all__ = ['DHTNode', 'start_dht_node', 'find_peers', 'announce', 'add_node', 'get_dht_port',
+           'RoutingTable', 'Node', 'K']
@@ -0,0 +1,509 @@
+from ..app_data import db_utils
+from .routing_table import RoutingTable, Node, K
+from .utils import distance, encode_nodes, decode_nodes, encode_peer, decode_peers
+
+import asyncio
+import bencodepy
+import os
+import random
+import socket
+import time
+from hashlib import sha1
+from typing import Tuple, List, Dict, Set, Any, Callable, Coroutine, Union
+
+_ALPHA = 3  # queries in flight during a lookup
+_QUERY_TIMEOUT = 2
+_TOKEN_ROTATION = 5 * 60  # BEP 5, a token is valid for 5 to 10 minutes
+_PEER_EXPIRY = 30 * 60  # announced peers are kept for 30 minutes
+_MAX_STORED_TORRENTS = 2000
+_MAX_STORED_PEERS = 200  # per info hash
+_MAX_VALUES = 50  # peers in a single get_peers response, so it fits in a datagram
+_MAINTENANCE_INTERVAL = 60
+_SAVE_INTERVAL = 10 * 60
+_BOOTSTRAP_TIMEOUT = 10
+_BOOTSTRAP_NODES = (('router.bittorrent.com', 6881), ('dht.transmissionbt.com', 6881), ('router.utorrent.com', 6881))
+
+# KRPC error codes
+_PROTOCOL_ERROR = 203
+_METHOD_UNKNOWN = 204
+
+
+class DHTNode(asyncio.DatagramProtocol):
+    """
+    a mainline DHT node (BEP 5), for finding the peers of a torrent without a tracker.
+    it answers the queries of other nodes, keeps a routing table of the nodes it met and stores the peers
+    announced to it. lookups go iteratively towards the info hash, with _ALPHA queries in flight,
+    until the K closest nodes known all answered.
+    only ipv4 nodes are used
+    """
+    def __init__(self, node_id: bytes = None) -> None:
+        """
+        :param node_id: the id of the node from the last run | None for a new random id
+        :return: None
+        """
+        self.node_id = node_id if node_id is not None else os.urandom(20)
+        self.routing_table = RoutingTable(self.node_id)
+        self.transport: Union[asyncio.DatagramTransport, None] = None
+        self.port: Union[int, None] = None
+
+        self.transactions: Dict[bytes, Tuple[asyncio.Future, Tuple[str, int]]] = dict()  # transaction id -> response, node
+        self.next_transaction = random.getrandbits(16)
+        self.pinged: Set[bytes] = set()  # questionable nodes that are pinged right now
+        self.tasks: Set[asyncio.Task] = set()
+
+        self.peers: Dict[bytes, Dict[Tuple[str, int], float]] = dict()  # info hash -> announced peer -> expiry time
+        self.secrets = [os.urandom(16), os.urandom(16)]  # the current and the previous token secrets
+        self.last_rotation = time.time()
+        self.is_bootstrapped = asyncio.Event()
+
+    async def start(self, host: str, port: int) -> int:
+        """
+        starts listening for datagrams
+        :param host: ip to listen on
+        :param port: udp port to listen on, 0 for any free port
+        :return: the port the node listens on
+        """
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port), family=socket.AF_INET)
+        self.port = self.transport.get_extra_info('sockname')[1]
+        return self.port
+
+    def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        if self.transport is not None:
+            self.transport.close()
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+
+    def connection_lost(self, exc: Union[Exception, None]) -> None:
+        self.transport = None
+        for future, _ in self.transactions.values():
+            if not future.done():
+                future.set_result(None)
+
+    def error_received(self, exc: Exception) -> None:
+        # e.g. icmp port unreachable, the query times out
+        pass
+
+    def datagram_received(self, data: bytes, address: Tuple[str, int]) -> None:
+        try:
+            message = bencodepy.decode(data)
+        except Exception:
+            return
+        if not isinstance(message, dict) or not isinstance(transaction := message.get(b't'), bytes):
+            return
+
+        kind = message.get(b'y')
+        if kind == b'q':
+            self.__handle_query(message, transaction, address)
+        elif kind in (b'r', b'e'):
+            pending = self.transactions.get(transaction)
+            if pending is not None and pending[1] == address and not pending[0].done():
+                pending[0].set_result(message)
+
+    # --------
+    # answering queries
+
+    def __send(self, message: Dict[bytes, Any], address: Tuple[str, int]) -> None:
+        if self.transport is not None:
+            self.transport.sendto(bencodepy.encode(message), address)
+
+    def __send_error(self, transaction: bytes, address: Tuple[str, int], code: int, reason: bytes) -> None:
+        self.__send({b't': transaction, b'y': b'e', b'e': [code, reason]}, address)
+
+    def __handle_query(self, message: Dict[bytes, Any], transaction: bytes, address: Tuple[str, int]) -> None:
+        """
+        answers a query of another node, and adds it to the routing table
+        """
+        method, args = message.get(b'q'), message.get(b'a')
+        if not isinstance(args, dict) or not isinstance(node_id := args.get(b'id'), bytes) or len(node_id) != 20:
+            self.__send_error(transaction, address, _PROTOCOL_ERROR, b'invalid id')
+            return
+
+        try:
+            if method == b'ping':
+                response = {}
+
+            elif method == b'find_node':
+                target = args.get(b'target')
+                assert isinstance(target, bytes) and len(target) == 20
+                response = {b'nodes': self.__compact_closest(target)}
+
+            elif method == b'get_peers':
+                info_hash = args.get(b'info_hash')
+                assert isinstance(info_hash, bytes) and len(info_hash) == 20
+                response = {b'token': self.__token(address[0], self.secrets[0]), b'nodes': self.__compact_closest(info_hash)}
+                if values := self.__stored_peers(info_hash):
+                    response[b'values'] = values
+
+            elif method == b'announce_peer':
+                info_hash, port, token = args.get(b'info_hash'), args.get(b'port'), args.get(b'token')
+                assert isinstance(info_hash, bytes) and len(info_hash) == 20
+                if args.get(b'implied_port') == 1:  # the node is behind a nat, its source port is the peer's port
+                    port = address[1]
+                assert isinstance(port, int) and 0 < port < 65536
+                if not self.__is_valid_token(address[0], token):
+                    self.__send_error(transaction, address, _PROTOCOL_ERROR, b'bad token')
+                    return
+                self.__store_peer(info_hash, (address[0], port))
+                response = {}
+
+            else:
+                self.__send_error(transaction, address, _METHOD_UNKNOWN, b'method unknown')
+                return
+
+        except AssertionError:
+            self.__send_error(transaction, address, _PROTOCOL_ERROR, b'invalid arguments')
+            return
+
+        response[b'id'] = self.node_id
+        self.__send({b't': transaction, b'y': b'r', b'r': response}, address)
+        if message.get(b'ro') != 1:  # read-only nodes (BEP 43) do not answer queries
+            self.__add_node(node_id, address)
+
+    def __compact_closest(self, target: bytes) -> bytes:
+        return encode_nodes((node.id, node.address) for node in self.routing_table.closest(target))
+
+    def __token(self, ip: str, secret: bytes) -> bytes:
+        """
+        :return: the token a node with this ip needs to announce to me
+        """
+        return sha1(secret + socket.inet_aton(ip)).digest()[:8]
+
+    def __is_valid_token(self, ip: str, token: Any) -> bool:
+        """
+        tokens of the current and the previous secrets are valid
+        """
+        if time.time() - self.last_rotation >= _TOKEN_ROTATION:
+            self.rotate_secrets()
+        return isinstance(token, bytes) and any(token == self.__token(ip, secret) for secret in self.secrets)
+
+    def rotate_secrets(self) -> None:
+        self.secrets = [os.urandom(16), self.secrets[0]]
+        self.last_rotation = time.time()
+
+    def __store_peer(self, info_hash: bytes, address: Tuple[str, int]) -> None:
+        peers = self.peers.get(info_hash)
+        if peers is None:
+            if len(self.peers) >= _MAX_STORED_TORRENTS:
+                return
+            peers = self.peers[info_hash] = dict()
+        if address in peers or len(peers) < _MAX_STORED_PEERS:
+            peers[address] = time.time() + _PEER_EXPIRY
+
+    def __stored_peers(self, info_hash: bytes) -> List[bytes]:
+        """
+        :return: compact peer info of up to _MAX_VALUES random peers announced for the info hash
+        """
+        now = time.time()
+        peers = [address for address, expiry in self.peers.get(info_hash, {}).items() if expiry > now]
+        return [encode_peer(address) for address in random.sample(peers, min(len(peers), _MAX_VALUES))]
+
+    def expire_peers(self) -> None:
+        """
+        forgets peers that were not announced again for _PEER_EXPIRY
+        :return: None
+        """
+        now = time.time()
+        for info_hash in list(self.peers):
+            peers = {address: expiry for address, expiry in self.peers[info_hash].items() if expiry > now}
+            if peers:
+                self.peers[info_hash] = peers
+            else:
+                del self.peers[info_hash]
+
+    # --------
+    # sending queries
+
+    def __add_node(self, node_id: bytes, address: Tuple[str, int]) -> None:
+        """
+        adds a node that was heard from to the routing table. if its bucket is full of nodes that were not seen
+        for a while, the least recently seen one is pinged and replaced if it does not answer
+        """
+        questionable = self.routing_table.add(node_id, address)
+        if questionable is not None and questionable.id not in self.pinged:
+            self.pinged.add(questionable.id)
+            self.__create_task(self.__ping_questionable(questionable))
+
+    async def __ping_questionable(self, node: Node) -> None:
+        try:
+            await self.query(node.address, b'ping', {}, node.id)
+        finally:
+            self.pinged.discard(node.id)
+
+    def __create_task(self, coroutine: Coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def ping(self, address: Tuple[str, int]) -> None:
+        """
+        pings a node I heard about, e.g. from the port message of a peer. it is added to the routing table if it answers
+        :param address: (ip, port) of the node
+        :return: None
+        """
+        self.__create_task(self.query(address, b'ping', {}))
+
+    async def query(self, address: Tuple[str, int], method: bytes, args: Dict[bytes, Any], node_id: bytes = None) -> Union[Dict[bytes, Any], None]:
+        """
+        sends a query to a node and waits for its response. a node that answers is added to the routing table
+        :param address: (ip, port) of the node
+        :param method: ping | find_node | get_peers | announce_peer
+        :param args: arguments of the query, without my id
+        :param node_id: id of the node if it is known, it is marked as failed if it does not answer
+        :return: the response dictionary | None if the node did not answer or answered with an error
+        """
+        if self.transport is None:
+            return None
+        self.next_transaction = (self.next_transaction + 1) % 2 ** 16
+        transaction = self.next_transaction.to_bytes(2, 'big')
+        future = asyncio.get_running_loop().create_future()
+        self.transactions[transaction] = (future, address)
+        try:
+            self.__send({b't': transaction, b'y': b'q', b'q': method, b'a': {**args, b'id': self.node_id}}, address)
+            message = await asyncio.wait_for(future, _QUERY_TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            message = None
+        finally:
+            self.transactions.pop(transaction, None)
+
+        response = message.get(b'r') if message is not None and message.get(b'y') == b'r' else None
+        if not isinstance(response, dict) or not isinstance(response.get(b'id'), bytes) or len(response[b'id']) != 20:
+            if node_id is not None:
+                self.routing_table.fail(node_id)
+            return None
+        self.__add_node(response[b'id'], address)
+        return response
+
+    async def __lookup(self, target: bytes, method: bytes, args: Dict[bytes, Any], extra_nodes: List[Tuple[bytes, Tuple[str, int]]] = ()) -> Tuple[List[Tuple[str, int]], List[Tuple[Tuple[str, int], Any]]]:
+        """
+        an iterative lookup: the closest nodes I know to the target are queried, and the closer nodes they return
+        are queried next, until the K closest nodes that were found all answered
+        :param target: node id or info hash to look up
+        :param method: find_node | get_peers
+        :param args: arguments of the queries
+        :param extra_nodes: (node id, (ip, port)) of nodes to start with, besides the routing table
+        :return: peers found (get_peers), (address, token) of the nodes that answered, the closest first
+        """
+        candidates: Dict[bytes, Tuple[str, int]] = {node.id: node.address for node in self.routing_table.closest(target)}
+        for node_id, address in extra_nodes:
+            candidates.setdefault(node_id, address)
+        queried: Set[bytes] = set()
+        failed: Set[bytes] = set()
+        responses: Dict[bytes, Any] = dict()  # node id -> token
+        peers: Dict[Tuple[str, int], None] = dict()
+        pending: Set[asyncio.Task] = set()
+
+        async def query(node_id: bytes) -> Tuple[bytes, Union[Dict[bytes, Any], None]]:
+            return node_id, await self.query(candidates[node_id], method, args, node_id)
+
+        try:
+            while True:
+                closest = sorted((node_id for node_id in candidates if node_id not in failed), key=lambda x: distance(x, target))[:K]
+                for node_id in closest:
+                    if len(pending) >= _ALPHA:
+                        break
+                    if node_id not in queried:
+                        queried.add(node_id)
+                        pending.add(asyncio.create_task(query(node_id)))
+                if not pending:
+                    break
+
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node_id, response = task.result()
+                    if response is None:
+                        failed.add(node_id)
+                        continue
+                    responses[node_id] = response.get(b'token')
+                    for new_id, address in decode_nodes(response.get(b'nodes'), K):
+                        if new_id != self.node_id:
+                            candidates.setdefault(new_id, address)
+                    peers.update(dict.fromkeys(decode_peers(response.get(b'values'))))
+        finally:
+            for task in pending:
+                task.cancel()
+
+        closest = sorted(responses, key=lambda x: distance(x, target))[:K]
+        return list(peers), [(candidates[node_id], responses[node_id]) for node_id in closest]
+
+    async def bootstrap(self, addresses: List[Tuple[str, int]]) -> None:
+        """
+        joins the network: the nodes are asked for the nodes closest to me, and then I look myself up
+        :param addresses: (ip, port) of nodes to start with, e.g. cached nodes or bootstrap routers
+        :return: None
+        """
+        responses = await asyncio.gather(*(self.query(address, b'find_node', {b'target': self.node_id}) for address in addresses))
+        extra_nodes = [node for response in responses if response is not None for node in decode_nodes(response.get(b'nodes'), K)]
+        await self.__lookup(self.node_id, b'find_node', {b'target': self.node_id}, extra_nodes)
+        self.is_bootstrapped.set()
+
+    async def find_node(self, target: bytes) -> None:
+        """
+        looks a node id up, the nodes met on the way fill the routing table
+        :param target: node id
+        :return: None
+        """
+        await self.__lookup(target, b'find_node', {b'target': target})
+
+    async def get_peers(self, info_hash: bytes) -> List[Tuple[str, int]]:
+        """
+        looks the peers of a torrent up
+        :param info_hash: info hash of the torrent
+        :return: (ip, port) of the peers that were found
+        """
+        peers, _ = await self.__lookup(info_hash, b'get_peers', {b'info_hash': info_hash})
+        return peers
+
+    async def announce_peer(self, info_hash: bytes, port: int) -> List[Tuple[str, int]]:
+        """
+        tells the K nodes closest to the info hash that I have the torrent, with the tokens they gave me on the lookup
+        :param info_hash: info hash of the torrent
+        :param port: the tcp port peers connect to
+        :return: (ip, port) of the peers that were found on the lookup
+        """
+        peers, responses = await self.__lookup(info_hash, b'get_peers', {b'info_hash': info_hash})
+        args = {b'info_hash': info_hash, b'port': port, b'implied_port': 0}
+        await asyncio.gather(*(self.query(address, b'announce_peer', {**args, b'token': token})
+                               for address, token in responses if isinstance(token, bytes)))
+        return peers
+
+    async def maintain(self, bootstrap_nodes: List[Tuple[str, int]]) -> None:
+        """
+        periodically rotates the token secrets, forgets expired peers and refreshes the buckets
+        :param bootstrap_nodes: (ip, port) of nodes to join the network again with, if the routing table empties
+        :return: None
+        """
+        while True:
+            await asyncio.sleep(_MAINTENANCE_INTERVAL)
+            if time.time() - self.last_rotation >= _TOKEN_ROTATION:
+                self.rotate_secrets()
+            self.expire_peers()
+            if not len(self.routing_table):
+                await self.bootstrap(bootstrap_nodes)
+            for target in self.routing_table.refresh_targets():
+                await self.find_node(target)
+
+
+# the DHT node of the client, it runs in its own thread and event loop
+_dht_node: Union[DHTNode, None] = None
+_dht_loop: Union[asyncio.AbstractEventLoop, None] = None
+
+
+async def __resolve(addresses: Tuple[Tuple[str, int], ...]) -> List[Tuple[str, int]]:
+    """
+    :return: (ip, port) of the hosts that could be resolved
+    """
+    loop = asyncio.get_running_loop()
+    resolved = []
+    for host, port in addresses:
+        try:
+            infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            resolved.extend(info[4][:2] for info in infos[:1])
+        except OSError:
+            pass
+    return resolved
+
+
+def __save_nodes(dht_node: DHTNode) -> None:
+    db_utils.save_dht_nodes(dht_node.node_id, [node.address for node in dht_node.routing_table.nodes()])
+
+
+async def start_dht_node() -> None:
+    """
+    starts the DHT node of the client. it bootstraps off the nodes cached on the last run, and off the
+    bootstrap routers if there are not enough of them. the routing table is saved periodically
+    :return: None
+    """
+    global _dht_node, _dht_loop
+    try:
+        node_id, cached_nodes = db_utils.get_dht_nodes()
+        node = DHTNode(node_id)
+        try:
+            await node.start('0.0.0.0', db_utils.get_configuration('dht_port'))
+        except OSError:  # the port is occupied
+            await node.start('0.0.0.0', 0)
+        _dht_node, _dht_loop = node, asyncio.get_running_loop()
+        print(f'DHT node is listening on udp port {node.port}')
+
+        bootstrap_nodes = await __resolve(_BOOTSTRAP_NODES)
+        await node.bootstrap(cached_nodes)
+        if len(node.routing_table) < K:
+            await node.bootstrap(bootstrap_nodes)
+        print(f'DHT node joined with {len(node.routing_table)} nodes')
+
+        maintenance = asyncio.create_task(node.maintain(bootstrap_nodes))
+        while True:
+            await asyncio.to_thread(__save_nodes, node)
+            done, _ = await asyncio.wait((maintenance,), timeout=_SAVE_INTERVAL)
+            if done:
+                maintenance.result()
+
+    except Exception as e:
+        print(f'DHT node stopped: {e}')
+    finally:
+        _dht_node = None
+
+
+async def __run_in_dht_loop(lookup: Callable[[DHTNode], Coroutine]) -> Any:
+    """
+    runs a lookup of the DHT node in its event loop, once the node joined the network, and waits for it from another event loop
+    """
+    node = _dht_node
+
+    async def run() -> Any:
+        await asyncio.wait_for(node.is_bootstrapped.wait(), _BOOTSTRAP_TIMEOUT)
+        return await lookup(node)
+
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(run(), _dht_loop))
+
+
+async def find_peers(info_hash: bytes) -> List[Tuple[str, int]]:
+    """
+    looks the peers of a torrent up in the DHT, from any thread
+    :param info_hash: info hash of the torrent
+    :return: (ip, port) of the peers | [] if the DHT node is not running
+    """
+    if _dht_node is None:
+        return []
+    try:
+        return await __run_in_dht_loop(lambda node: node.get_peers(info_hash))
+    except (asyncio.TimeoutError, RuntimeError):
+        return []
+
+
+async def announce(info_hash: bytes, port: int) -> None:
+    """
+    announces that I seed a torrent in the DHT, from any thread
+    :param info_hash: info hash of the torrent
+    :param port: the tcp port of the seeding server
+    :return: None
+    """
+    if _dht_node is None:
+        return
+    try:
+        await __run_in_dht_loop(lambda node: node.announce_peer(info_hash, port))
+    except (asyncio.TimeoutError, RuntimeError):
+        pass
+
+
+def add_node(address: Tuple[str, int]) -> None:
+    """
+    adds a node a peer told me about with a port message, from any thread
+    :param address: (ip, port) of the node
+    :return: None
+    """
+    if _dht_node is not None and ':' not in address[0] and 0 < address[1] < 65536:
+        try:
+            _dht_loop.call_soon_threadsafe(_dht_node.ping, address)
+        except RuntimeError:  # the loop is closed
+            pass
+
+
+def get_dht_port() -> Union[int, None]:
+    """
+    :return: the udp port of the DHT node | None if it is not running
+    """
+    return _dht_node.port if _dht_node is not None else None
@@ -0,0 +1,126 @@
+from .utils import distance
+
+import heapq
+import random
+import time
+from dataclasses import dataclass
+from typing import Tuple, List, Dict, Union
+
+K = 8  # nodes in a bucket, also the number of closest nodes a lookup converges on
+_MAX_FAILURES = 2  # unanswered queries in a row before a node is bad
+_QUESTIONABLE_AFTER = 15 * 60  # BEP 5, a node not seen for 15 minutes is questionable
+_REFRESH_AFTER = 15 * 60  # BEP 5, a bucket that did not change for 15 minutes is refreshed
+
+
+@dataclass(slots=True)
+class Node:
+    """
+    a DHT node in the routing table
+    """
+    id: bytes
+    address: Tuple[str, int]
+    last_seen: float
+    failures: int = 0
+
+    @property
+    def is_good(self) -> bool:
+        return self.failures < _MAX_FAILURES
+
+
+class RoutingTable:
+    """
+    the k-buckets of a DHT node (BEP 5).
+    bucket i holds the nodes whose distance from me is 2^i to 2^(i+1) - 1, so the buckets cover the id space
+    closer to me with more detail. a bucket keeps the K nodes that were seen first: a new node only takes the
+    place of a bad node, and a questionable node is pinged before it can be replaced
+    """
+    def __init__(self, node_id: bytes) -> None:
+        """
+        :param node_id: my node id
+        :return: None
+        """
+        self.node_id = node_id
+        # a dict keeps the nodes in the order they were seen, the least recently seen first
+        self.buckets: List[Dict[bytes, Node]] = [dict() for _ in range(len(node_id) * 8)]
+        self.last_changed: List[float] = [time.time()] * len(self.buckets)
+
+    def __bucket_index(self, node_id: bytes) -> int:
+        return distance(self.node_id, node_id).bit_length() - 1
+
+    def __len__(self) -> int:
+        return sum(map(len, self.buckets))
+
+    def add(self, node_id: bytes, address: Tuple[str, int]) -> Union[Node, None]:
+        """
+        adds a node that answered me or queried me, or marks a known node as seen
+        :param node_id: id of the node
+        :param address: (ip, port) of the node
+        :return: a questionable node to ping if the bucket is full | None
+        """
+        index = self.__bucket_index(node_id)
+        if index < 0:  # that's me
+            return None
+        bucket = self.buckets[index]
+        now = time.time()
+
+        if (node := bucket.get(node_id)) is not None:
+            if node.address == address:  # from another address it is a different node claiming the id
+                del bucket[node_id]
+                node.last_seen = now
+                node.failures = 0
+                bucket[node_id] = node
+                self.last_changed[index] = now
+            return None
+
+        if len(bucket) >= K:
+            bad_node = next((node for node in bucket.values() if not node.is_good), None)
+            if bad_node is None:
+                oldest = next(iter(bucket.values()))
+                return oldest if now - oldest.last_seen > _QUESTIONABLE_AFTER else None
+            del bucket[bad_node.id]
+
+        bucket[node_id] = Node(node_id, address, now)
+        self.last_changed[index] = now
+        return None
+
+    def fail(self, node_id: bytes) -> None:
+        """
+        a node did not answer a query
+        :param node_id: id of the node
+        :return: None
+        """
+        index = self.__bucket_index(node_id)
+        if index >= 0 and (node := self.buckets[index].get(node_id)) is not None:
+            node.failures += 1
+
+    def closest(self, target: bytes, count: int = K) -> List[Node]:
+        """
+        :param target: an id
+        :param count: number of nodes
+        :return: the good nodes closest to the target, the closest first
+        """
+        target = int.from_bytes(target, 'big')
+        nodes = (node for bucket in self.buckets for node in bucket.values() if node.is_good)
+        return heapq.nsmallest(count, nodes, key=lambda node: int.from_bytes(node.id, 'big') ^ target)
+
+    def nodes(self) -> List[Node]:
+        """
+        :return: the good nodes of the table
+        """
+        return [node for bucket in self.buckets for node in bucket.values() if node.is_good]
+
+    def refresh_targets(self) -> List[bytes]:
+        """
+        picks a random id in the range of every bucket that has nodes but did not change for a while,
+        looking it up refreshes the bucket
+        :return: the ids to look up
+        """
+        now = time.time()
+        my_id = int.from_bytes(self.node_id, 'big')
+        targets = []
+        for index, bucket in enumerate(self.buckets):
+            if bucket and now - self.last_changed[index] > _REFRESH_AFTER:
+                self.last_changed[index] = now
+                target = my_id ^ ((1 << index) | random.getrandbits(index))
+                targets.append(target.to_bytes(len(self.node_id), 'big'))
+        return targets
@@ -0,0 +1,57 @@
+import socket
+import struct
+from typing import Tuple, List, Iterable, Any
+
+_COMPACT_NODE = struct.Struct('>20s4sH')  # node id, ipv4, port
+_COMPACT_PEER = struct.Struct('>4sH')
+
+
+def distance(node_id: bytes, target: bytes) -> int:
+    """
+    :return: the xor distance between two ids, as an integer
+    """
+    return int.from_bytes(node_id, 'big') ^ int.from_bytes(target, 'big')
+
+
+def encode_nodes(nodes: Iterable[Tuple[bytes, Tuple[str, int]]]) -> bytes:
+    """
+    :param nodes: (node id, (ip, port)) of ipv4 nodes
+    :return: compact node info of the nodes
+    """
+    return b''.join(_COMPACT_NODE.pack(node_id, socket.inet_aton(ip), port) for node_id, (ip, port) in nodes)
+
+
+def decode_nodes(data: Any, max_nodes: int) -> List[Tuple[bytes, Tuple[str, int]]]:
+    """
+    :param data: compact node info from a response
+    :param max_nodes: at most this many nodes are taken
+    :return: (node id, (ip, port)) of the nodes | an empty list if the data is invalid
+    """
+    if not isinstance(data, bytes):
+        return []
+    data = data[:len(data) - len(data) % _COMPACT_NODE.size][:max_nodes * _COMPACT_NODE.size]
+    return [(node_id, (socket.inet_ntoa(ip), port)) for node_id, ip, port in _COMPACT_NODE.iter_unpack(data) if port != 0]
+
+
+def encode_peer(address: Tuple[str, int]) -> bytes:
+    """
+    :param address: (ip, port) of an ipv4 peer
+    :return: compact peer info
+    """
+    return _COMPACT_PEER.pack(socket.inet_aton(address[0]), address[1])
+
+
+def decode_peers(values: Any) -> List[Tuple[str, int]]:
+    """
+    :param values: list of compact peer info strings from a get_peers response
+    :return: (ip, port) of the peers, invalid entries are left out
+    """
+    if not isinstance(values, list):
+        return []
+    peers = []
+    for value in values:
+        if isinstance(value, bytes) and len(value) == _COMPACT_PEER.size:
+            ip, port = _COMPACT_PEER.unpack(value)
+            if port != 0:
+                peers.append((socket.inet_ntoa(ip), port))
+    return peers
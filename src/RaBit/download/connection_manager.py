@@ -0,0 +1,283 @@
+from ..app_data import db_utils
+from ..torrent.torrent_object import Torrent
+from ..tracker.tracker_object import Tracker, WORKING
+from ..tracker.utils import format_peers_list, is_lan_address
+from ..peer.peer_communication import tcp_wire_communication
+from ..peer.peer_object import Peer
+from ..download.piece_picker import PiecePicker
+from ..download.upload_in_download import TitForTat
+from ..download.upload_scheduler import UploadScheduler
+from ..file.file_object import File
+from ..dht import find_peers
+from ..lsd import subscribe, unsubscribe
+
+import asyncio
+import time
+import numpy as np
+from dataclasses import dataclass
+from typing import Tuple, List, Dict, Set, Any
+
+# states of a peer in the pool
+UNTRIED = 0
+CONNECTING = 1
+CONNECTED = 2
+FAILED = 3
+
+_REFILL_INTERVAL = 1  # seconds between checks of the pool and the trackers
+_MIN_BACKOFF = 30  # seconds before a failed or disconnected peer is tried again
+_MAX_BACKOFF = 30 * 60
+_DHT_INTERVAL = 5 * 60  # seconds between DHT lookups
+_MIN_DHT_INTERVAL = 60  # while there are free connection slots
+
+
+@dataclass(slots=True)
+class PoolPeer:
+    """
+    a known peer of the torrent and its connection state
+    """
+    address: Tuple[str, int]
+    geodata: Any
+    distance: float
+    state: int = UNTRIED
+    failures: int = 0  # failed attempts in a row
+    retry_at: float = 0.0  # when a failed peer can be tried again
+    is_local: bool = False  # on my LAN
+
+
+class ConnectionManager:
+    """
+    keeps the pool of known peers of a torrent and decides which ones to connect to.
+    new connections are opened until max_peer_connections peers are connected, with at most
+    max_half_open_connections connection attempts (tcp connect and handshake) at a time.
+    peers that failed or disconnected are tried again with an exponential backoff, and the pool is refilled
+    with the peers of periodic tracker re-announces and DHT lookups.
+    peers on the LAN, found by local service discovery or on the lists, are tried first and are not limited by
+    max_peer_connections, they are a lot faster than the rest.
+    """
+    def __init__(self, TorrentData: Torrent, session, file_manager: File, piece_picker: PiecePicker, choking_manager: TitForTat, upload_scheduler: UploadScheduler, trackers: List[Tracker], my_ip: str) -> None:
+        """
+        :param TorrentData: torrent data instance
+        :param session: DownloadingSession instance with session stats
+        :param file_manager: File instance managing disk IO operations | None until the metadata of a magnet link arrives
+        :param piece_picker: PiecePicker instance of the torrent | None until the metadata of a magnet link arrives
+        :param choking_manager: tit-for-tat algorithm for choking management | None until the metadata of a magnet link arrives
+        :param upload_scheduler: serves the requests of the peers | None until the metadata of a magnet link arrives
+        :param trackers: trackers of the torrent, re-announced at their intervals
+        :param my_ip: my public ip for geolocation calculations
+        :return: None
+        """
+        self.MAX_CONNECTIONS = db_utils.get_configuration('max_peer_connections')
+        self.MAX_HALF_OPEN = db_utils.get_configuration('max_half_open_connections')
+
+        self.TorrentData = TorrentData
+        self.session = session
+        self.file_manager = file_manager
+        self.piece_picker = piece_picker
+        self.choking_manager = choking_manager
+        self.upload_scheduler = upload_scheduler
+        self.trackers = trackers
+        self.my_ip = my_ip
+
+        self.pool: Dict[Tuple[str, int], PoolPeer] = dict()  # address -> peer, every address once
+        self.local_peers = 0  # peers of the pool on my LAN
+        self.half_open = 0
+        self.connected = 0
+        self.tasks: Set[asyncio.Task] = set()
+        self.is_running = True
+        self.next_dht_lookup = time.time() + _MIN_DHT_INTERVAL  # the download session looked the peers up already
+
+    @property
+    def is_private(self) -> bool:
+        """
+        :return: whether the torrent is private (BEP 27), unknown until the metadata of a magnet link arrives
+        """
+        return self.TorrentData.info is not None and self.TorrentData.info.get(b'private') == 1
+
+    def add_peers(self, peers_list: List[Tuple]) -> int:
+        """
+        adds peers to the pool, known peers are ignored
+        :param peers_list: formatted peer list, see format_peers_list()
+        :return: number of new peers
+        """
+        new_peers = 0
+        for address, geodata, distance in peers_list:
+            if address not in self.pool:
+                self.pool[address] = PoolPeer(address, geodata, distance, is_local=is_lan_address(address[0]))
+                self.local_peers += self.pool[address].is_local
+                new_peers += 1
+        return new_peers
+
+    def add_exchanged_peers(self, addresses: List[Tuple[str, int]]) -> None:
+        """
+        adds peers another peer told me about (peer exchange). unknown peers are formatted in a thread,
+        since geolocation and the banned peers lookup are blocking
+        :param addresses: (ip, port) of the peers
+        :return: None
+        """
+        addresses = [address for address in dict.fromkeys(addresses) if address not in self.pool]
+        if addresses and self.is_running:
+            task = asyncio.create_task(self.__add_formatted_peers(addresses))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def __add_formatted_peers(self, addresses: List[Tuple[str, int]]) -> None:
+        peers_list = await asyncio.to_thread(format_peers_list, addresses, self.my_ip)
+        if self.add_peers(peers_list):
+            self.connect_peers()
+
+    def add_local_peer(self, address: Tuple[str, int]) -> None:
+        """
+        adds a peer on the LAN that announced the torrent (local service discovery)
+        :param address: (ip, port) of the peer
+        :return: None
+        """
+        self.add_exchanged_peers([address])
+
+    def connected_addresses(self) -> List[Tuple[str, int]]:
+        """
+        :return: (ip, port) of the connected peers
+        """
+        return [peer.address for peer in self.pool.values() if peer.state == CONNECTED]
+
+    def start_download(self, file_manager: File, piece_picker: PiecePicker, choking_manager: TitForTat, upload_scheduler: UploadScheduler) -> None:
+        """
+        starts downloading pieces once the metadata of a magnet link arrived.
+        the connections that fetched the metadata carry on with the download
+        :param file_manager: File instance managing disk IO operations
+        :param piece_picker: PiecePicker instance of the torrent
+        :param choking_manager: tit-for-tat algorithm for choking management
+        :param upload_scheduler: serves the requests of the peers
+        :return: None
+        """
+        self.file_manager = file_manager
+        self.piece_picker = piece_picker
+        self.choking_manager = choking_manager
+        self.upload_scheduler = upload_scheduler
+        if self.is_private:
+            unsubscribe(self.TorrentData.info_hash)
+        # the pieces of the peers that fetched the metadata are sized when their connections carry on with the
+        # download, until then they have none. the disk IO manager announces pieces to them right away
+        pieces_num = len(self.TorrentData.piece_hashes)
+        for peer in Peer.peer_instances.get(self.TorrentData.info_hash, []):
+            if len(peer.have_pieces) != pieces_num:
+                peer.have_pieces = np.zeros(pieces_num, dtype=bool)
+            peer.wake()
+
+    def stop(self) -> None:
+        """
+        stops opening new connections, e.g. when the download is removed
+        :return: None
+        """
+        self.is_running = False
+        unsubscribe(self.TorrentData.info_hash)
+
+    def connect_peers(self) -> None:
+        """
+        starts connection attempts to pool peers while there are free connection slots.
+        LAN peers come first, then untried peers in the order they were added (nearest first), then failed peers that
+        waited their backoff
+        :return: None
+        """
+        if not self.is_running:
+            return
+        now = time.time()
+        half_open_slots = self.MAX_HALF_OPEN - self.half_open
+        free_slots = self.MAX_CONNECTIONS - self.half_open - self.connected
+        if half_open_slots <= 0 or (free_slots <= 0 and not self.local_peers):
+            return
+
+        candidates = [peer for peer in self.pool.values() if peer.state == UNTRIED or (peer.state == FAILED and peer.retry_at <= now)]
+        candidates.sort(key=lambda x: (not x.is_local, x.failures))
+        for peer in candidates:
+            if half_open_slots == 0 or (free_slots <= 0 and not peer.is_local):
+                break
+            if peer.failures and db_utils.BannedPeersDB().find_ip(peer.address[0]):
+                peer.retry_at = float('inf')
+                continue
+
+            # counted as half-open right away, the task starts later
+            peer.state = CONNECTING
+            self.half_open += 1
+            half_open_slots -= 1
+            free_slots -= 1
+            task = asyncio.create_task(self.__connect(peer))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def __connect(self, peer: PoolPeer) -> None:
+        """
+        runs a connection to a pool peer and updates its state
+        :param peer: the peer to connect to, already counted as half-open
+        :return: None
+        """
+        def on_connected() -> None:
+            peer.state = CONNECTED
+            peer.failures = 0
+            self.half_open -= 1
+            self.connected += 1
+            self.connect_peers()  # a half-open slot is free
+
+        try:
+            await tcp_wire_communication((peer.address, peer.geodata, peer.distance), self.TorrentData, self.session,
+                                         self.file_manager, self.piece_picker, self.choking_manager, self.upload_scheduler, on_connected)
+        finally:
+            if peer.state == CONNECTED:
+                self.connected -= 1
+            else:
+                self.half_open -= 1
+            peer.state = FAILED
+            peer.failures += 1
+            peer.retry_at = time.time() + min(_MIN_BACKOFF * 2 ** (peer.failures - 1), _MAX_BACKOFF)
+            if not asyncio.current_task().cancelling():  # the loop is not shutting down
+                self.connect_peers()
+
+    async def __announce(self, tracker: Tracker) -> None:
+        """
+        re-announces to a tracker and adds the peers it returned to the pool
+        :param tracker: the tracker
+        :return: None
+        """
+        download = self.session.corrupted + self.session.wasted + self.session.downloaded
+        peers_list = await tracker.re_announce(download, self.session.uploaded, self.session.left, 0)
+        if peers_list:
+            # blocking geolocation and database lookups
+            peers_list = await asyncio.to_thread(format_peers_list, list(dict.fromkeys(peers_list)), self.my_ip)
+            print('announced! ', tracker, f'{self.add_peers(peers_list)} new peers')
+        self.connect_peers()
+
+    async def __lookup_dht(self) -> None:
+        """
+        looks the peers of the torrent up in the DHT and adds them to the pool
+        :return: None
+        """
+        if peers := await find_peers(self.TorrentData.info_hash):
+            print(f'DHT lookup found {len(peers)} peers')
+            self.add_exchanged_peers(peers)
+
+    async def loop(self) -> None:
+        """
+        re-announces to trackers at their intervals, looks peers up in the DHT and keeps the connections count up
+        :return: None
+        """
+        # private torrents (BEP 27) only use their trackers
+        if not self.is_private:
+            subscribe(self.TorrentData.info_hash, self.add_local_peer)
+        try:
+            while self.is_running:
+                now = time.time()
+                for tracker in self.trackers:
+                    if tracker.state == WORKING and tracker.last_announce + tracker.interval <= now:
+                        task = asyncio.create_task(self.__announce(tracker))
+                        self.tasks.add(task)
+                        task.add_done_callback(self.tasks.discard)
+
+                if not self.is_private and self.next_dht_lookup <= now:
+                    self.next_dht_lookup = now + (_DHT_INTERVAL if self.connected >= self.MAX_CONNECTIONS else _MIN_DHT_INTERVAL)
+                    task = asyncio.create_task(self.__lookup_dht())
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+
+                self.connect_peers()
+                await asyncio.sleep(_REFILL_INTERVAL)
+        finally:
+            unsubscribe(self.TorrentData.info_hash)
@@ -2,6 +2,8 @@ from ..peer.message_types import BLOCK_SIZE
 
 from typing import List, Tuple, Any, Set, Union
 from dataclasses import dataclass
+from hashlib import sha1
+from math import ceil
 from random import random
 
 # block states
@@ -9,20 +11,38 @@ OPEN = 0
 REQUESTED = 1
 FINISHED = 2
 
+# file and piece priorities
+SKIP = 0
+LOW = 1
+NORMAL = 2
+HIGH = 3
 
-@dataclass(slots=True)
+
+def get_block_key(index: int, begin: int, blocks_per_piece: int) -> int:
+    """
+    the integer key of a block, unique in a torrent: piece index * blocks per piece + block number
+    :param index: index of the piece
+    :param begin: offset of the block in the piece
+    :param blocks_per_piece: number of blocks in a full piece
+    :return: the key
+    """
+    return index * blocks_per_piece + begin // BLOCK_SIZE
+
+
+@dataclass(slots=True, eq=False)
 class Block:
     """
     a representation of a block - the smallest unit that is requested with a 'Request' message
     a several blocks make up a piece.
+    blocks are compared by identity and hashed by their precomputed key
     """
     # block attributes
     index: int
     begin: int
     length: int
     piece: Any  # corresponding DownloadingPiece instance
+    key: int  # see get_block_key()
 
-    data: bytes = None
     state: int = OPEN
     
     downloaded_from: str = None  # address is stored for smart banning
@@ -31,19 +51,20 @@ class Block:
         """
         flushes the block
         """
-        self.data = None
         self.state = OPEN
         self.downloaded_from = None
 
-    def add_data(self, data: bytes, address: Tuple[str, int]):
+    def add_data(self, data: Union[bytes, memoryview], address: Tuple[str, int]):
         """
-        adds data to the block when it arrives
+        adds data to the block when it arrives.
+        the data is copied once, directly to its offset in the piece's buffer
         """
-        if self.data is None:
-            self.data = data
+        if self.state != FINISHED and self.piece.view is not None:
+            self.piece.view[self.begin:self.begin + self.length] = data
             self.state = FINISHED
             self.downloaded_from = address[0]
             self.piece.current_block += 1
+            self.piece.advance_hash()
             return True
         return False
 
@@ -54,14 +75,53 @@ class Block:
         return f"index: {self.index}, begin: {self.begin}, length: {self.length}"
 
     def __hash__(self):
-        return hash(repr(self))
+        return self.key
+
+    @property
+    def data(self) -> memoryview:
+        """
+        the block's data inside the piece's buffer
+        """
+        return self.piece.view[self.begin:self.begin + self.length]
 
     @property
     def data_hash(self):
         """
         hash value of the block's data, NOT the block's instance hash.
         """
-        return hash(self.data)
+        return hash(self.data.tobytes())
+
+
+class PieceBufferPool:
+    """
+    a pool of reusable piece-sized buffers.
+    every downloading piece is assembled in place inside one buffer, instead of keeping a bytes object per block
+    and joining them when the piece completes. an instance is created for each download
+    """
+    def __init__(self, piece_length: int, max_free: int = 8) -> None:
+        """
+        :param piece_length: size of the buffers, the torrent's piece length
+        :param max_free: how many released buffers to keep for reuse
+        :return: None
+        """
+        self.piece_length = piece_length
+        self.max_free = max_free
+        self.free: List[bytearray] = []
+
+    def acquire(self) -> bytearray:
+        """
+        :return: a free buffer, or a new one if there aren't any
+        """
+        if self.free:
+            return self.free.pop()
+        return bytearray(self.piece_length)
+
+    def release(self, buffer: bytearray) -> None:
+        """
+        returns a buffer to the pool
+        """
+        if len(self.free) < self.max_free:
+            self.free.append(buffer)
 
 
 class DownloadingPiece:
@@ -69,43 +129,96 @@ class DownloadingPiece:
     a downloading piece instance.
     creates a list of Block instances and keeps track of them
     """
-    def __init__(self, index, piece_length: int, block_size: int = BLOCK_SIZE) -> None:
+    def __init__(self, index, piece_length: int, block_size: int = BLOCK_SIZE, buffer_pool: PieceBufferPool = None) -> None:
         """
         :param index: index of the piece
         :param piece_length: length of the piece
         :param block_size: size of each 'full' block the piece should have
+        :param buffer_pool: pool to draw the piece's buffer from
         :return: None
         """
         self.index = index
         self.piece_length = piece_length
         self.block_size = block_size
 
+        # all blocks are written to their offset in a single buffer
+        self.buffer_pool = buffer_pool
+        self.buffer: bytearray = buffer_pool.acquire() if buffer_pool is not None else bytearray(piece_length)
+        self.view: Union[memoryview, None] = memoryview(self.buffer)
+
         self.all_requested = False
 
+        self.blocks_per_piece = ceil(self.piece_length / self.block_size)
         self.blocks: List[Block] = []
         for i in range(self.piece_length // self.block_size + 1):
             begin = i * self.block_size
             end = min((i + 1) * self.block_size, self.piece_length)
             length = end - begin
             if length != 0:
-                block = Block(self.index, begin, length, self)
+                block = Block(self.index, begin, length, self, self.index * self.blocks_per_piece + i)
                 self.blocks.append(block)
 
         self.current_block = 0
         self.blocks_length = len(self.blocks)
 
         self.urgent = False  # true if the piece needs to be completed as fast as possible due to a failed request
+        self.owner: Any = None  # the fast peer the piece is assigned to, None if slow peers share it
         self.previous_tries: List[FailedPiece] = []
 
-    def reset(self):
+        # running sha1 over the contiguous prefix of finished blocks.
+        # out of order blocks wait in the buffer until the gap before them is filled
+        self.hash_incrementally = True
+        self.hasher = sha1()
+        self.hashed_blocks = 0
+
+    def reset(self, hash_incrementally: bool = True):
         """
         flushes the piece
+        :param hash_incrementally: false to hash the whole piece once it completes instead of as blocks arrive
         """
         self.all_requested = False
         self.current_block = 0
         for block in self.blocks:
             block.reset()
 
+        self.hash_incrementally = hash_incrementally
+        self.hasher = sha1()
+        self.hashed_blocks = 0
+
+    def advance_hash(self) -> None:
+        """
+        feeds the hasher with every finished block that directly follows the hashed prefix
+        """
+        if not self.hash_incrementally:
+            return
+        while self.hashed_blocks < self.blocks_length and self.blocks[self.hashed_blocks].state == FINISHED:
+            block = self.blocks[self.hashed_blocks]
+            self.hasher.update(self.view[block.begin:block.begin + block.length])
+            self.hashed_blocks += 1
+
+    def digest(self) -> bytes:
+        """
+        sha1 digest of the completed piece.
+        uses the running hash if it covers all the blocks, otherwise hashes the whole piece
+        :return: the piece's digest
+        """
+        if self.hash_incrementally and self.hashed_blocks == self.blocks_length:
+            return self.hasher.digest()
+        return sha1(self.get_data).digest()
+
+    def release(self) -> None:
+        """
+        returns the piece's buffer to the pool once the piece is saved.
+        blocks that arrive after that (in endgame) are ignored
+        """
+        if self.view is None:
+            return
+        self.view.release()
+        self.view = None
+        if self.buffer_pool is not None:
+            self.buffer_pool.release(self.buffer)
+        self.buffer = None
+
     def get_next_request(self) -> Union[Block, None]:
         """
         returns the nest unpicked block, if there are any
@@ -134,9 +247,19 @@ class DownloadingPiece:
                 return
 
     @property
-    def get_data(self) -> bytes:
-        data = b''.join([block.data for block in self.blocks])
-        return data
+    def length(self) -> int:
+        """
+        actual length of the piece, the last piece can be shorter than the piece length
+        """
+        last_block = self.blocks[-1]
+        return last_block.begin + last_block.length
+
+    @property
+    def get_data(self) -> memoryview:
+        """
+        a view of the piece's data, hashed and written to disk without copying
+        """
+        return self.view[:self.length]
 
     @property
     def is_completed(self) -> bool:
@@ -1,24 +1,28 @@
 from ..app_data import db_utils
 from ..peer.peer_object import Peer
-from ..torrent.torrent import read_torrent
+from ..torrent.torrent import read_torrent, read_magnet, get_magnet_name, set_info
 from ..tracker.initial_announce import initial_announce
 from ..tracker.utils import format_peers_list
 from ..geoip.utils import get_my_public_ip
 from ..download.piece_picker import PiecePicker
-from ..peer.peer_communication import tcp_wire_communication
-from ..file.file_object import File, PickleableFile
+from ..file.file_object import File, PickleableFile, get_piece_priorities, get_unshared_pieces
+from ..download.data_structures import SKIP
 from ..download.upload_in_download import TitForTat
+from ..download.upload_scheduler import UploadScheduler
+from ..download.connection_manager import ConnectionManager
+from ..download.metadata import Metadata
 from ..tracker.tracker_object import Tracker, ANNOUNCING, WORKING
-from ..seeding.announce_loop import announce_loop
+from ..dht import find_peers
+from ..bandwidth import RateEstimator, remove_torrent_rates
 
 import threading
 import asyncio
 from hashlib import sha1
 import bitstring
+import numpy as np
 from typing import List, Tuple, Dict, Any
 import os
 import random
-import time
 from math import ceil
 
 
@@ -28,14 +32,21 @@ class DownloadSession:
     """
     Sessions: Dict[bytes, Any] = dict()
 
-    def __init__(self, torrent_path: str, result_dir: str, skip_hash_check: bool) -> None:
+    def __init__(self, torrent_path: str, result_dir: str, skip_hash_check: bool, streaming_window: int = 0, file_priorities: List[int] = None) -> None:
         """
-        :param torrent_path: path of the .torrent file
+        :param torrent_path: path of the .torrent file | a magnet link
         :param result_dir: path to where downloaded files will be saved
+        :param skip_hash_check: whatever to skip the hash check
+        :param streaming_window: number of pieces ahead of the read cursor to download first (streaming mode), 0 to disable
+        :param file_priorities: priority of each file in the torrent (SKIP, LOW, NORMAL, HIGH) | None to download all files
         :return: None
         """
         self.torrent_path = torrent_path
-        self.name = os.path.splitext(os.path.basename(torrent_path))[0]
+        self.is_magnet = torrent_path.startswith('magnet:')
+        if self.is_magnet:  # the name of the torrent is known once the metadata arrives
+            self.name = get_magnet_name(torrent_path) or read_magnet(torrent_path).info_hash.hex()
+        else:
+            self.name = os.path.splitext(os.path.basename(torrent_path))[0]
         self.skip_hash_check = skip_hash_check
         self.TorrentData = None
         self.length = 0
@@ -49,31 +60,40 @@ class DownloadSession:
         self.state = 'Started'
         self.trackers = []
         self.announce_task = None
+        self.connection_manager = None
+        self.metadata = None
         self.peers = []
         self.progress = 0
-        # ETA
-        self.last_Total = 0
-        self.last_Time = 0
-        self.last_ETA = 0
+        # streaming
+        self.streaming_window = streaming_window
+        self.read_cursor = 0  # in bytes
+        self.piece_picker = None
+        # selective download
+        self.file_priorities = file_priorities
+        # rates of the piece payload, the wasted and corrupted data included
+        self.downloading = RateEstimator()
+        self.uploading = RateEstimator()
 
         self.__seed = random.getrandbits(64)
 
     @staticmethod
-    async def work_wrapper(disk_loop, tit_for_tat_loop, *work):
+    async def work_wrapper(disk_loop, tit_for_tat_loop, timeout_loop, upload_loop, connection_loop):
         tit_for_tat_loop = asyncio.create_task(tit_for_tat_loop())
+        timeout_loop = asyncio.create_task(timeout_loop())
+        upload_loop = asyncio.create_task(upload_loop())
         disk_loop = await asyncio.to_thread(disk_loop)
 
-        await asyncio.gather(tit_for_tat_loop, disk_loop, *work)
+        await asyncio.gather(tit_for_tat_loop, timeout_loop, upload_loop, disk_loop, connection_loop())
 
     async def download(self) -> bool:
         """
-        main function for downloading a .torrent file
+        main function for downloading a .torrent file or a magnet link
         :return: whatever the download was successful
         """
         try:
             # read torrent file
             self.state = 'Reading torrent'
-            self.TorrentData = read_torrent(self.torrent_path)
+            self.TorrentData = read_magnet(self.torrent_path) if self.is_magnet else read_torrent(self.torrent_path)
             self.info_hash = self.TorrentData.info_hash
             self.length = self.TorrentData.length
 
@@ -83,39 +103,39 @@ class DownloadSession:
                 print('already downloading!')
                 return False
 
-            self.state = 'Verifying files'
-            bitarray, missing = self.verify_torrent()
-
-            if missing is None:
-                self.left = self.TorrentData.length
+            if not self.is_magnet:
+                self.metadata = Metadata(self.info_hash, self.TorrentData.info)
+                self.state = 'Verifying files'
+                piece_priorities, bitarray, wanted = self.__prepare_pieces()
             else:
-                extra = len(self.TorrentData.piece_hashes) * self.TorrentData.info[b'piece length'] - self.TorrentData.length
-                self.left = len(missing) * self.TorrentData.info[b'piece length'] - extra
-                self.downloaded = self.TorrentData.length - self.left
+                self.metadata = Metadata(self.info_hash)
+                self.left = 1  # unknown until the metadata arrives, a tracker takes 0 for a seed
 
             # add the TorrentData file path for fail safety
-            await db_utils.add_ongoing_torrent(self.torrent_path, self.result_dir)
+            await db_utils.add_ongoing_torrent(self.torrent_path, self.result_dir, self.file_priorities)
 
             # add self to dict
             DownloadSession.Sessions[self.info_hash] = self
 
-            # initial announce
+            # initial announce, the DHT is searched meanwhile. private torrents (BEP 27) only use their trackers
             self.state = 'Announcing'
-            peers_list, self.trackers = await initial_announce(self.TorrentData, self.downloaded, self.uploaded, self.left, db_utils.get_configuration('v4_forward')['external_port'], 2)
+            announce = initial_announce(self.TorrentData, self.downloaded, self.uploaded, self.left, db_utils.get_configuration('v4_forward')['external_port'], 2)
+            if not self.is_magnet and self.TorrentData.info.get(b'private') == 1:
+                peers_list, self.trackers = await announce
+            else:
+                (peers_list, self.trackers), dht_peers = await asyncio.gather(announce, find_peers(self.info_hash))
+                peers_list = list(dict.fromkeys(peers_list + dht_peers))
             # format peer list: sort and remove unwanted peers
             my_ip = await get_my_public_ip()
             peers_list = format_peers_list(peers_list, my_ip)
 
             # verify torrent
-            if all(bitarray):
-                self.state = 'Completed'
-                self.progress = 100
-                print('got all!')
-                db_utils.CompletedTorrentsDB().insert_torrent(PickleableFile(File(self.TorrentData, self, None, None, self.torrent_path, self.result_dir)))
-                db_utils.remove_ongoing_torrent(self.torrent_path)
+            if not self.is_magnet and not wanted:
+                self.__complete_without_download(piece_priorities)
                 return True
 
-            db_utils.CompletedTorrentsDB().delete_torrent(self.info_hash)
+            if not self.is_magnet:
+                db_utils.CompletedTorrentsDB().delete_torrent(self.info_hash)
 
             if not peers_list:
                 self.state = 'Failed'
@@ -125,26 +145,41 @@ class DownloadSession:
 
             # --------
             # peer wire protocol
-            self.state = 'Downloading'
-            announce_loop_task = asyncio.create_task(announce_loop(self.trackers, self))
-            self.announce_task = announce_loop_task
-
-            piece_picker = PiecePicker(self.TorrentData, self, bitarray, missing)
-            tit_for_tat_manager = TitForTat(piece_picker)
-
-            # start disk IO thread
-            await db_utils.set_configuration('download_dir', self.result_dir)
-            file = File(self.TorrentData, self, piece_picker, piece_picker.results_queue, self.torrent_path, self.result_dir, self.skip_hash_check)
-
-            work = [tcp_wire_communication(peer, self.TorrentData, self, file, piece_picker, tit_for_tat_manager) for peer in peers_list]
+            if not self.is_magnet:
+                self.state = 'Downloading'
+                file, piece_picker, tit_for_tat_manager, upload_scheduler = self.__start_pieces(bitarray, wanted, piece_priorities)
+                await db_utils.set_configuration('download_dir', self.result_dir)
+            else:
+                self.state = 'Fetching metadata'
+                file = piece_picker = tit_for_tat_manager = upload_scheduler = None
+                Peer.peer_instances[self.info_hash] = []
+                self.peers = Peer.peer_instances[self.info_hash]
+
+            # the connection manager connects to the peers and re-announces to the trackers for more
+            connection_manager = ConnectionManager(self.TorrentData, self, file, piece_picker, tit_for_tat_manager, upload_scheduler, self.trackers, my_ip)
+            connection_manager.add_peers(peers_list)
+            self.connection_manager = connection_manager
             try:
-                thread = threading.Thread(target=lambda: asyncio.run(DownloadSession.work_wrapper(file.save_pieces_loop, tit_for_tat_manager.loop, *work)), daemon=True)
+                if not self.is_magnet:
+                    work = lambda: DownloadSession.work_wrapper(file.save_pieces_loop, tit_for_tat_manager.loop, piece_picker.timeout_loop, upload_scheduler.loop, connection_manager.loop)
+                else:
+                    work = self.__fetch_metadata_and_download
+                thread = threading.Thread(target=lambda: asyncio.run(work()), daemon=True)
                 thread.start()
                 thread.join()
             except RuntimeError:
                 pass
 
-            if db_utils.CompletedTorrentsDB().find_info_hash(self.info_hash):
+            if self.is_magnet:
+                if self.state == 'Completed':  # all the files were already there
+                    return True
+                file, piece_picker = connection_manager.file_manager, connection_manager.piece_picker
+                if piece_picker is None:
+                    self.state = 'Failed'
+                    print('Failed!')
+                    return False
+
+            if piece_picker.num_of_pieces_left == 0:
                 # announce completion
                 total_download, total_upload = self.downloaded + self.corrupted + self.wasted, self.uploaded
 
@@ -155,30 +190,111 @@ class DownloadSession:
                         except asyncio.TimeoutError:
                             pass
 
-                work = [final_announce(tracker) for tracker in self.trackers]
-                await asyncio.gather(*work)
+                if not file.is_selective:  # a selective download did not complete the torrent
+                    work = [final_announce(tracker) for tracker in self.trackers]
+                    await asyncio.gather(*work)
 
                 self.state = 'Completed'
                 # cleanup
                 DownloadSession.Sessions.pop(self.info_hash)
                 Peer.peer_instances.pop(self.info_hash)
-                announce_loop_task.cancel()
                 return True
 
             else:
                 self.state = 'Failed'
                 print('Failed!')
-                announce_loop_task.cancel()
                 return False
         except:
             db_utils.remove_ongoing_torrent(self.torrent_path)
             self.state = 'Failed'
             print('Failed!')
             return False
+        finally:
+            # the connections of the session made buckets for the torrent, a completed torrent keeps them for seeding
+            if self.connection_manager is not None and self.state != 'Completed':
+                remove_torrent_rates(self.info_hash)
 
-    def verify_torrent(self) -> Tuple[bitstring.BitArray, List[int]]:
+    async def __fetch_metadata_and_download(self) -> None:
+        """
+        the work of a magnet link download: the connections fetch the metadata from the peers,
+        then the same connections download the pieces
+        :return: None
+        """
+        connection_loop = asyncio.create_task(self.connection_manager.loop())
+        metadata_done = asyncio.create_task(self.metadata.done.wait())
+        await asyncio.wait((connection_loop, metadata_done), return_when=asyncio.FIRST_COMPLETED)
+        if not self.metadata.is_complete:  # the download was removed
+            metadata_done.cancel()
+            return
+
+        set_info(self.TorrentData, self.metadata.info)
+        self.length = self.TorrentData.length
+        if self.name == self.info_hash.hex() and self.TorrentData.info.get(b'name'):
+            self.name = self.TorrentData.info[b'name'].decode('utf-8', errors='replace')
+
+        self.state = 'Verifying files'
+        piece_priorities, bitarray, wanted = await asyncio.to_thread(self.__prepare_pieces)
+        if not wanted:
+            self.connection_manager.stop()
+            self.__complete_without_download(piece_priorities)
+            return
+        db_utils.CompletedTorrentsDB().delete_torrent(self.info_hash)
+
+        self.state = 'Downloading'
+        file, piece_picker, tit_for_tat_manager, upload_scheduler = self.__start_pieces(bitarray, wanted, piece_priorities)
+        await db_utils.set_configuration('download_dir', self.result_dir)
+        self.connection_manager.start_download(file, piece_picker, tit_for_tat_manager, upload_scheduler)
+        await DownloadSession.work_wrapper(file.save_pieces_loop, tit_for_tat_manager.loop, piece_picker.timeout_loop, upload_scheduler.loop, lambda: connection_loop)
+
+    def __prepare_pieces(self) -> Tuple[np.ndarray, bitstring.BitArray, List[int]]:
+        """
+        finds out which pieces are downloaded, out of the pieces of the wanted files
+        :return: priority of every piece, bitarray of pieces availability, indexes of the pieces to download
+        """
+        piece_priorities = get_piece_priorities(self.TorrentData, self.file_priorities)
+        bitarray, missing = self.verify_torrent(piece_priorities)
+
+        # only pieces of wanted files are downloaded
+        piece_length = self.TorrentData.info[b'piece length']
+        wanted = [index for index in (missing if missing is not None else range(len(self.TorrentData.piece_hashes))) if piece_priorities[index] != SKIP]
+        extra = len(self.TorrentData.piece_hashes) * piece_length - self.TorrentData.length
+        self.left = len(wanted) * piece_length - (extra if wanted and wanted[-1] == len(self.TorrentData.piece_hashes) - 1 else 0)
+        if missing is not None:
+            self.downloaded = self.TorrentData.length - self.left
+        return piece_priorities, bitarray, wanted
+
+    def __start_pieces(self, bitarray: bitstring.BitArray, wanted: List[int], piece_priorities: np.ndarray) -> Tuple[File, PiecePicker, TitForTat, UploadScheduler]:
+        """
+        creates the piece picker, the disk IO manager, the choking manager and the upload scheduler of the download
+        :return: File instance, PiecePicker instance, TitForTat instance, UploadScheduler instance
+        """
+        piece_picker = PiecePicker(self.TorrentData, self, bitarray, wanted, self.streaming_window, piece_priorities,
+                                   get_unshared_pieces(self.TorrentData, self.file_priorities))
+        piece_picker.set_read_cursor(self.read_cursor // self.TorrentData.info[b'piece length'])
+        self.piece_picker = piece_picker
+        tit_for_tat_manager = TitForTat(piece_picker)
+
+        # start disk IO thread
+        file = File(self.TorrentData, self, piece_picker, piece_picker.results_queue, self.torrent_path, self.result_dir, self.skip_hash_check, self.file_priorities)
+        return file, piece_picker, tit_for_tat_manager, UploadScheduler(file, self)
+
+    def __complete_without_download(self, piece_priorities: np.ndarray) -> None:
+        """
+        all the wanted pieces are already downloaded
+        :param piece_priorities: priority of every piece
+        :return: None
+        """
+        self.state = 'Completed'
+        self.progress = 100
+        print('got all!')
+        if SKIP not in piece_priorities:
+            db_utils.CompletedTorrentsDB().insert_torrent(PickleableFile(File(self.TorrentData, self, None, None, self.torrent_path, self.result_dir)))
+        db_utils.remove_ongoing_torrent(self.torrent_path)
+
+    def verify_torrent(self, piece_priorities) -> Tuple[bitstring.BitArray, List[int]]:
         """
         goes over the entire torrent and checks which pieces are missing to not re-download existing torrent pieces
+        :param piece_priorities: priority of every piece, skipped pieces are not checked
         :return: bitarray of pieces availability, a range of missing pieces indexes (tuple)
         """
         missing = None
@@ -188,8 +304,12 @@ class DownloadSession:
             try:
                 bitarray = bitstring.BitArray(bin='1' * len(self.TorrentData.piece_hashes))
                 missing = []
-                temp_file = File(self.TorrentData, None, None, None, None, self.result_dir)
+                temp_file = File(self.TorrentData, None, None, None, None, self.result_dir, file_priorities=self.file_priorities)
                 for index, torrent_piece_hash in enumerate(self.TorrentData.piece_hashes):
+                    if piece_priorities[index] == SKIP:
+                        bitarray[index] = False
+                        continue
+
                     # hash check
                     if index != len(self.TorrentData.piece_hashes) - 1:
                         data = temp_file.get_piece(index, 0, self.TorrentData.info[b'piece length'])
@@ -207,26 +327,47 @@ class DownloadSession:
                 del temp_file
         return bitarray, missing
 
+    def seek(self, offset: int) -> None:
+        """
+        moves the read cursor of the streaming window to a new position in the torrent
+        :param offset: position in bytes, relative to the start of the torrent's data
+        :return: None
+        """
+        self.read_cursor = offset
+        if self.piece_picker is not None:
+            self.piece_picker.set_read_cursor(offset // self.TorrentData.info[b'piece length'])
+
+    def add_uploaded(self, size: int) -> None:
+        """
+        counts a block uploaded to a peer
+        :param size: length of the block
+        :return: None
+        """
+        self.uploaded += size
+        self.uploading.add(size)
+
+    @property
+    def download_rate(self) -> float:
+        """
+        :return: download rate, in KiB/s
+        """
+        return self.downloading.rate / 1024
+
+    @property
+    def upload_rate(self) -> float:
+        """
+        :return: upload rate, in KiB/s
+        """
+        return self.uploading.rate / 1024
+
     @property
     def ETA(self) -> float:
         """
         :return: estimated time of arrival, in seconds
         """
-        Total = self.downloaded + self.wasted + self.corrupted
-        Time = time.time()
-        delay = 1.5 if self.progress < 95 else 0.5
-        if Time - self.last_Time < delay:
-            return self.last_ETA  # a very long time (100.9y)
-        speed = (Total - self.last_Total) / (Time - self.last_Time)
-        if speed == 0:
-            return 3184622406
-        ETA = ceil(self.left / speed)
-        if self.last_ETA == 1:
-            ETA = 1
-        self.last_Total = Total
-        self.last_Time = Time
-        self.last_ETA = ETA
-        return ETA
+        if (rate := self.downloading.rate) == 0:
+            return 3184622406  # a very long time (100.9y)
+        return ceil(self.left / rate)
 
     def __repr__(self):
         return f"{self.state}, {self.info_hash}"
@@ -0,0 +1,152 @@
+import asyncio
+import bencodepy
+from hashlib import sha1
+from math import ceil
+from typing import List, Dict, Set, Union
+
+METADATA_PIECE_SIZE = 2 ** 14
+_MAX_METADATA_SIZE = 2 ** 23  # 8 MiB, bigger info dicts are refused
+_MAX_PEER_REQUESTS = 4  # outstanding metadata requests to a single peer
+
+
+class Metadata:
+    """
+    the info dict of a torrent, shared by the connections of a download.
+    for a magnet link it is fetched from the peers with ut_metadata (BEP 9): the pieces are requested from all the
+    peers that have the metadata in parallel, the least requested pieces first, so once every piece was requested
+    the remaining ones are raced between peers and the first to arrive is kept.
+    the pieces can only be verified together against the info hash. if they do not match, the metadata is fetched
+    again from a single peer at a time, so the peer that sent a bad piece is found and not asked again
+    """
+    def __init__(self, info_hash: bytes, info: dict = None) -> None:
+        """
+        :param info_hash: info hash of the torrent
+        :param info: the info dict | None if it is fetched from peers
+        :return: None
+        """
+        self.info_hash = info_hash
+        self.info = info
+        self.data: Union[bytes, bytearray, None] = bencodepy.encode(info) if info is not None else None
+        self.size: Union[int, None] = len(self.data) if info is not None else None
+        self.pieces_num = ceil(self.size / METADATA_PIECE_SIZE) if info is not None else 0
+
+        self.received: List[bool] = []
+        self.requests: List[int] = []  # outstanding requests of every piece
+        self.sources: Dict[int, int] = dict()  # piece index -> key of the peer it came from
+        self.excluded: Set[int] = set()  # keys of peers that sent bad pieces
+        self.is_single_source = False
+        self.source: Union[int, None] = None  # the peer all the pieces are fetched from, in single source mode
+
+        self.done = asyncio.Event()
+        if info is not None:
+            self.done.set()
+
+    @property
+    def is_complete(self) -> bool:
+        return self.info is not None
+
+    def set_size(self, size: int) -> bool:
+        """
+        sets the size of the info dict a peer told me about
+        :param size: metadata_size from the extended handshake of the peer
+        :return: whether the size is valid and matches what the other peers said
+        """
+        if self.size is not None:
+            return size == self.size
+        if not 0 < size <= _MAX_METADATA_SIZE:
+            return False
+        self.size = size
+        self.pieces_num = ceil(size / METADATA_PIECE_SIZE)
+        self.data = bytearray(size)
+        self.received = [False] * self.pieces_num
+        self.requests = [0] * self.pieces_num
+        return True
+
+    def pick_piece(self, peer_key: int, requested: Set[int]) -> Union[int, None]:
+        """
+        picks the next piece to request from a peer
+        :param peer_key: key of the peer
+        :param requested: pieces that were already requested from the peer
+        :return: index of the piece | None if there is nothing to request from the peer
+        """
+        if self.is_complete or self.size is None or peer_key in self.excluded or len(requested) >= _MAX_PEER_REQUESTS:
+            return None
+        if self.is_single_source:
+            if self.source is None:
+                self.source = peer_key
+            elif self.source != peer_key:
+                return None
+
+        piece = None
+        for index in range(self.pieces_num):
+            if not self.received[index] and index not in requested and (piece is None or self.requests[index] < self.requests[piece]):
+                piece = index
+        if piece is not None:
+            self.requests[piece] += 1
+        return piece
+
+    def release(self, piece: int) -> None:
+        """
+        a request of the piece was answered or will not be
+        :param piece: index of the piece
+        :return: None
+        """
+        if 0 <= piece < self.pieces_num and self.requests[piece] > 0:
+            self.requests[piece] -= 1
+
+    def release_peer(self, peer_key: int) -> None:
+        """
+        a peer disconnected, in single source mode another peer can take its place
+        :param peer_key: key of the peer
+        :return: None
+        """
+        if self.source == peer_key:
+            self.source = None
+
+    def add_piece(self, piece: int, data: bytes, peer_key: int) -> bool:
+        """
+        adds a piece that arrived from a peer and verifies the metadata once all the pieces arrived
+        :param piece: index of the piece
+        :param data: the piece
+        :param peer_key: key of the peer
+        :return: whether the metadata is complete now
+        """
+        if self.is_complete or (self.is_single_source and peer_key != self.source):
+            return False
+        assert 0 <= piece < self.pieces_num
+        begin = piece * METADATA_PIECE_SIZE
+        assert len(data) == min(METADATA_PIECE_SIZE, self.size - begin)
+        if self.received[piece]:  # lost the race
+            return False
+
+        self.data[begin: begin + len(data)] = data
+        self.received[piece] = True
+        self.sources[piece] = peer_key
+        if not all(self.received):
+            return False
+
+        if sha1(self.data).digest() != self.info_hash:
+            print('metadata does not match the info hash!')
+            sources = set(self.sources.values())
+            if len(sources) == 1:
+                self.excluded.update(sources)
+            self.is_single_source = True
+            self.source = None
+            self.received = [False] * self.pieces_num
+            self.sources.clear()
+            return False
+
+        info = bencodepy.decode(bytes(self.data))
+        self.data = bytes(self.data)
+        self.info = info
+        self.done.set()
+        return True
+
+    def get_piece(self, piece: int) -> Union[bytes, None]:
+        """
+        :param piece: index of the piece
+        :return: the piece | None if I do not have it
+        """
+        if not self.is_complete or not 0 <= piece < self.pieces_num:
+            return None
+        return self.data[piece * METADATA_PIECE_SIZE: (piece + 1) * METADATA_PIECE_SIZE]
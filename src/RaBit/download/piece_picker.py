@@ -3,14 +3,21 @@ from ..peer.message_types import *
 from ..peer.peer_object import Peer
 from .data_structures import *
 
-from typing import List, Dict, Set
+from typing import List, Dict, Set, Iterable, Union
 import bitstring
-from dataclasses import dataclass
+import numpy as np
 import time
 import threading
 import asyncio
-from collections import defaultdict
-from random import shuffle
+from collections import deque
+from random import random
+from math import ceil
+
+
+_STREAMING_PIECE_DEADLINE = 2  # seconds per piece of distance from the read cursor
+_ENDGAME_REDUNDANCY = 2  # max number of peers a block is requested from at once in endgame mode
+_TIMEOUT_CHECK_INTERVAL = 1  # seconds between scans for timed out requests
+_MIN_OPEN_PIECES = 4  # lower bound for the number of partially downloaded pieces
 
 
 class BetterQueue(asyncio.Queue):
@@ -31,60 +38,187 @@ class BetterQueue(asyncio.Queue):
         return item
 
 
-@dataclass
-class PiecePos:
-    """
-    a small dataclass to represent a piece index and its availability for picking calculations
-    """
-    piece_index: int  # piece index
-    peer_count: int = 0  # availability, position in priority bucket
-
-
-class PriorityBucket:
+class AvailabilityIndex:
     """
-    a priority bucket containing a list of PiecePos sharing the same availability.
-    the lower the priority (key) the rarer the piece is
+    a position-indexed availability index of the pieces that can still be picked.
+    all pickable pieces are kept in a single list sorted by availability, where every availability value
+    owns a contiguous bucket. moving a piece to a neighbouring bucket is a single swap with the edge of its bucket,
+    so changing the availability of a piece is O(1) and the rarest pieces are always at the front of the list.
+    the availability itself is a uint16 vector, so whole bitfields are added or subtracted in one vectorized operation.
+    an instance is created for each piece picker.
     """
-    keys: List[int] = []
-    buckets: List = []
+    def __init__(self, num_pieces: int, pieces: Iterable[int], availability: np.ndarray = None) -> None:
+        """
+        :param num_pieces: number of pieces in the torrent
+        :param pieces: indexes of the pieces that should be picked
+        :param availability: an availability vector to share with other indexes
+        :return: None
+        """
+        # piece index -> number of connected peers that have it
+        self.availability: np.ndarray = np.zeros(num_pieces, dtype=np.uint16) if availability is None else availability
+        self.tiebreak: np.ndarray = np.random.permutation(num_pieces)  # random order inside a bucket, kept across re-sorts
+        self.pieces: List[int] = list(pieces)  # pickable pieces, sorted by availability
+        self.positions: List[int] = [-1] * num_pieces  # piece index -> position in self.pieces, -1 if not pickable
+        # availability -> end (exclusive) of its bucket. the start of a bucket is the end of the previous one
+        self.bucket_ends: List[int] = [len(self.pieces)]
+        self.is_sorted = False  # false after a bulk update, until the pieces are sorted again
+        self.__sort()
+
+    def __len__(self) -> int:
+        return len(self.pieces)
+
+    def __contains__(self, piece_index: int) -> bool:
+        return self.positions[piece_index] != -1
+
+    def __swap(self, position1: int, position2: int) -> None:
+        piece1, piece2 = self.pieces[position1], self.pieces[position2]
+        self.pieces[position1], self.pieces[position2] = piece2, piece1
+        self.positions[piece1], self.positions[piece2] = position2, position1
+
+    def __sort(self) -> None:
+        """
+        sorts the pickable pieces again after a bulk update
+        """
+        pieces = np.array(self.pieces, dtype=np.int64)
+        availability = self.availability[pieces]
+        # a single integer key: availability first, then the random tiebreak
+        pieces = pieces[np.argsort(availability.astype(np.int64) * len(self.tiebreak) + self.tiebreak[pieces])]
+
+        positions = np.full(len(self.positions), -1, dtype=np.int64)
+        positions[pieces] = np.arange(len(pieces))
+        self.pieces = pieces.tolist()
+        self.positions = positions.tolist()
+        self.bucket_ends = np.cumsum(np.bincount(availability)).tolist() if len(pieces) else [0]
+        self.is_sorted = True
+
+    def add_bitfield(self, bitfield: np.ndarray, update_availability: bool = True) -> None:
+        """
+        increases the availability of all pieces a peer has, in one vectorized operation.
+        a seed's bitfield moves every pickable piece up by one bucket and keeps their order,
+        any other bitfield leaves the pieces to be sorted lazily before the next ordered operation
+        :param bitfield: boolean vector of the pieces the peer has
+        :param update_availability: false if a shared availability vector was already updated
+        :return: None
+        """
+        if update_availability:
+            self.availability += bitfield
+        if self.is_sorted and bitfield.all():
+            self.bucket_ends.insert(0, 0)
+        else:
+            self.is_sorted = False
 
-    def __init__(self, pieces_list: List[PiecePos] = None) -> None:
+    def subtract_bitfield(self, bitfield: np.ndarray, update_availability: bool = True) -> None:
         """
-        :param pieces_list: a number of PiecePos with the same availability
+        decreases the availability of all pieces a peer had, in one vectorized operation.
+        :param bitfield: boolean vector of the pieces the peer has
+        :param update_availability: false if a shared availability vector was already updated
         :return: None
         """
-        PriorityBucket.buckets.append(self)
-        if pieces_list:
-            self.pieces_list: List[PiecePos] = pieces_list  # pieces "stack"
-            self.length = len(pieces_list)
-            self.priority = pieces_list[0].peer_count
-            PriorityBucket.keys.append(self.priority)
-            PriorityBucket.keys.sort()
+        if update_availability:
+            self.availability -= bitfield & (self.availability > 0)
+        # an empty index, or one sorted after the seed connected, has no bucket of its own to drop
+        if self.is_sorted and self.pieces and len(self.bucket_ends) > 1 and self.bucket_ends[0] == 0 and bitfield.all():
+            self.bucket_ends.pop(0)
         else:
-            self.pieces_list: List[PiecePos] = []
-            self.length = 0
-            self.priority = None
+            self.is_sorted = False
 
-    @property
-    def is_empty(self):
-        return not self.length
+    def increment(self, piece_index: int) -> None:
+        """
+        increases the availability of a piece by one
+        """
+        if not self.is_sorted:
+            self.__sort()
+        priority = int(self.availability[piece_index])
+        self.availability[piece_index] += 1
+        if (position := self.positions[piece_index]) == -1:
+            return
 
-    def add_piece(self, piece: PiecePos):
-        self.length += 1
-        if self.priority is None:
-            self.priority = piece.peer_count
-            PriorityBucket.keys.append(piece.peer_count)
-            PriorityBucket.keys.sort()
+        if priority + 1 == len(self.bucket_ends):
+            self.bucket_ends.append(len(self.pieces))
+        # move the piece to the end of its bucket and shrink the bucket, so it becomes the first of the next one
+        self.__swap(position, self.bucket_ends[priority] - 1)
+        self.bucket_ends[priority] -= 1
 
-        self.pieces_list.append(piece)
+    def decrement(self, piece_index: int) -> None:
+        """
+        decreases the availability of a piece by one
+        """
+        if not self.is_sorted:
+            self.__sort()
+        priority = int(self.availability[piece_index])
+        if priority == 0:
+            return
+        self.availability[piece_index] -= 1
+        if (position := self.positions[piece_index]) == -1:
+            return
 
-    def remove(self, piece: PiecePos):
-        self.pieces_list.remove(piece)
-        self.length -= 1
+        # move the piece to the start of its bucket and grow the previous bucket over it
+        self.__swap(position, self.bucket_ends[priority - 1])
+        self.bucket_ends[priority - 1] += 1
 
-    def add_pieces(self, pieces: List[PiecePos]):
-        for piece in pieces:
-            self.add_piece(piece)
+    def remove(self, piece_index: int) -> None:
+        """
+        removes a piece from the index, usually because it was picked.
+        costs O(max availability), which is bounded by the number of connected peers
+        """
+        if not self.is_sorted:
+            self.__sort()
+        position = self.positions[piece_index]
+        # bubble the piece through the end of every higher bucket to the end of the list
+        for priority in range(self.availability[piece_index], len(self.bucket_ends)):
+            self.__swap(position, self.bucket_ends[priority] - 1)
+            position = self.bucket_ends[priority] - 1
+            self.bucket_ends[priority] -= 1
+
+        self.pieces.pop()
+        self.positions[piece_index] = -1
+
+    def add(self, piece_index: int) -> None:
+        """
+        adds a piece back to the index using its current availability
+        """
+        if self.positions[piece_index] != -1:
+            return
+        if not self.is_sorted:
+            self.__sort()
+
+        priority = int(self.availability[piece_index])
+        while len(self.bucket_ends) <= priority:
+            self.bucket_ends.append(len(self.pieces))
+
+        position = len(self.pieces)
+        self.pieces.append(piece_index)
+        self.positions[piece_index] = position
+        # bubble the piece down through the start of every higher bucket
+        for current in range(len(self.bucket_ends) - 1, priority, -1):
+            self.bucket_ends[current] += 1
+            self.__swap(position, self.bucket_ends[current - 1])
+            position = self.bucket_ends[current - 1]
+        self.bucket_ends[priority] += 1
+
+    def rarest(self, have_mask: np.ndarray) -> Union[int, None]:
+        """
+        finds the rarest pickable piece the peer has.
+        since the rarest pieces are in front, this is O(1) for peers that have most of the pieces (seeds)
+        :param have_mask: which pieces the peer can share
+        :return: piece index | None if the peer has none of the pickable pieces
+        """
+        if not self.is_sorted:
+            self.__sort()
+        for piece_index in self.pieces:
+            if have_mask[piece_index]:
+                return piece_index
+        return None
+
+    def count(self, priority: int) -> int:
+        """
+        :return: number of pickable pieces with the given availability
+        """
+        if not self.is_sorted:
+            self.__sort()
+        if priority >= len(self.bucket_ends):
+            return 0
+        return self.bucket_ends[priority] - (self.bucket_ends[priority - 1] if priority > 0 else 0)
 
 
 class PiecePicker:
@@ -97,12 +231,16 @@ class PiecePicker:
     """
     FILE_STATUS: Dict[bytes, bitstring.BitArray] = dict()
 
-    def __init__(self, TorrentData: Torrent, session, bitarray: bitstring.bitarray, index_range: List[int] = None) -> None:
+    def __init__(self, TorrentData: Torrent, session, bitarray: bitstring.bitarray, index_range: List[int] = None, streaming_window: int = 0, piece_priorities: np.ndarray = None, unshared_pieces: np.ndarray = None) -> None:
         """
         :param TorrentData: torrent data instance
         :param session: DownloadingSession instance with some stats
         :param bitarray: the initial position of the downloaded files
         :param index_range: the range of missing pieces for a faster partial download
+        :param streaming_window: number of pieces ahead of the read cursor to download first, 0 for rarest-first only
+        :param piece_priorities: priority of every piece, SKIP pieces are never picked. None for all NORMAL
+        :param unshared_pieces: boolean vector of the pieces that overlap a skipped file, they are never announced
+        or uploaded. None if no file is skipped
         :return: None
         """
         self.TorrentData = TorrentData
@@ -112,27 +250,37 @@ class PiecePicker:
         PiecePicker.FILE_STATUS[TorrentData.info_hash] = bitarray
 
         self.is_in_endgame = False
-        self.endgame_received_blocks: Set = set()  # blocks received while in endgame mode
-
-        # will be iterated like this: for key in sorted(self.buckets_dict.keys()): ...
-        # should not be extremely expensive because the availability range is usually 10-20
-        self.buckets_dict: Dict[int, PriorityBucket] = defaultdict(PriorityBucket)  # dict of priority (availability) -> priority buckets
-
-        index_range = range(len(TorrentData.piece_hashes)) if index_range is None else index_range
-        self.pieces_map: Dict[int, PiecePos] = {i: PiecePos(i) for i in index_range}  # list of PiecePos
-        items = list(self.pieces_map.items())
-        shuffle(items)
-        self.pieces_map = {item[0]: item[1] for item in items}
-
-        self.buckets_dict[0] = PriorityBucket(list(self.pieces_map.values()))  # all pieces start with availability 0
-        self.buckets_dict[0].priority = 0
-
+        self.endgame_blocks: Dict[int, Set[Peer]] = dict()  # keys of the remaining blocks in endgame mode -> peers they are requested from
+
+        num_pieces = len(TorrentData.piece_hashes)
+        index_range = np.arange(num_pieces) if index_range is None else np.array(index_range, dtype=np.int64)
+        self.piece_priorities = np.full(num_pieces, NORMAL, dtype=np.uint8) if piece_priorities is None else piece_priorities
+        self.unshared_pieces = np.zeros(num_pieces, dtype=bool) if unshared_pieces is None else unshared_pieces
+        self.shared_mask = bitstring.BitArray(bytes=np.packbits(~self.unshared_pieces).tobytes(), length=num_pieces)  # pieces I may upload
+
+        # one availability index for each priority level, highest first. all pieces start with availability 0
+        self.availability: np.ndarray = np.zeros(num_pieces, dtype=np.uint16)
+        self.availability_indexes: List[AvailabilityIndex] = [
+            AvailabilityIndex(num_pieces, index_range[self.piece_priorities[index_range] == priority].tolist(), self.availability)
+            for priority in (HIGH, NORMAL, LOW)]
+        self.num_of_pieces = sum(map(len, self.availability_indexes))  # number of pieces this download needs
+
+        self.buffer_pool = PieceBufferPool(TorrentData.info[b'piece length'])
         self.downloading: Dict[int, DownloadingPiece] = dict()  # piece index -> DownloadingPiece
-        self.pending_blocks: Dict[Block, Tuple[Block, float]] = dict()
+        self.pending_blocks: Dict[int, Tuple[Block, Peer, float]] = dict()  # block key -> (requested block, peer, time of request)
 
-        self.num_of_pieces_left = len(self.pieces_map)
+        self.num_of_pieces_left = self.num_of_pieces
         self.last_data_received = time.time()
 
+        # streaming mode
+        self.streaming_window = streaming_window
+        self.read_cursor = 0  # the piece the consumer reads next
+        self.deadlines: Dict[int, float] = dict()  # piece index -> deadline, for pieces in the streaming window
+        # speed classes
+        self.fast_threshold = 0  # minimal upload rate of a fast peer
+        self.fast_threshold_time = 0
+        self.max_open_pieces = _MIN_OPEN_PIECES  # new pieces are opened beyond it only if there is nothing else to request
+
     def sort_downloading(self):
         """
         sorts the self.downloading dict by priority
@@ -140,69 +288,220 @@ class PiecePicker:
         # prioritize pieces that are closest to completion
         self.downloading = dict(sorted(self.downloading.items(), key=lambda x: x[1].priority))
 
-    async def get_block(self, have_mask: bitstring.bitarray) -> Block:
+    def __new_piece(self, piece_index: int) -> DownloadingPiece:
+        """
+        moves a piece from the availability index to the downloading dict
+        :param piece_index: index of the picked piece
+        :return: the new DownloadingPiece instance
+        """
+        self.index_of(piece_index).remove(piece_index)
+
+        newPiece = DownloadingPiece(piece_index, self.TorrentData.info[b'piece length'], buffer_pool=self.buffer_pool)
+        # remove excessive blocks from the last piece
+        if piece_index == len(self.TorrentData.piece_hashes) - 1:
+            extra = len(self.TorrentData.piece_hashes) * self.TorrentData.info[b'piece length'] - self.TorrentData.length
+            while extra > BLOCK_SIZE:
+                extra -= BLOCK_SIZE
+                newPiece.blocks.pop()
+                newPiece.blocks_length -= 1
+            newPiece.blocks[-1].length -= extra
+
+        # transfer the piece to downloading dict
+        self.downloading[piece_index] = newPiece
+
+        # sort the downloading dict
+        # the most requested piece (in theory) will be the first one
+        # self.sort_downloading()  # no need to sort, the first pieces should be the most requested
+        return newPiece
+
+    def set_read_cursor(self, piece_index: int) -> None:
+        """
+        moves the read cursor of the streaming window, e.g. when the consumer seeks
+        :param piece_index: the piece the consumer reads next
+        :return: None
+        """
+        self.read_cursor = max(0, min(piece_index, len(self.TorrentData.piece_hashes)))
+        self.deadlines.clear()
+
+    def in_streaming_window(self, piece_index: int) -> bool:
+        return self.read_cursor <= piece_index < self.read_cursor + self.streaming_window
+
+    def is_fast_peer(self, peer: Peer) -> bool:
+        """
+        is the peer one of the faster half of the peers that unchoked me? snubbed peers are never fast.
+        the threshold, and the cap on open pieces, are recalculated at most once a second
+        """
+        if (rn := time.time()) - self.fast_threshold_time >= 1:
+            unchoked = [x for x in Peer.peer_instances.get(self.TorrentData.info_hash, []) if not x.is_choked]
+            rates = sorted(x.upload_rate for x in unchoked)
+            self.fast_threshold = rates[len(rates) // 2] if rates else 0
+            # enough pieces to fill the pipelines of all the peers that unchoked me, plus one partially received piece each
+            blocks_per_piece = ceil(self.TorrentData.info[b'piece length'] / BLOCK_SIZE)
+            self.max_open_pieces = max(_MIN_OPEN_PIECES, sum(ceil(x.MAX_PIPELINE_SIZE / blocks_per_piece) + 1 for x in unchoked))
+            self.fast_threshold_time = rn
+        return not peer.is_snubbed and peer.upload_rate >= self.fast_threshold
+
+    @staticmethod
+    def __in_speed_class(piece: DownloadingPiece, peer: Peer, is_fast: bool) -> bool:
+        """
+        fast peers download whole pieces of their own, slow peers share pieces with each other.
+        failed pieces and pieces of snubbed peers are open to everyone
+        :param piece: a downloading piece
+        :param peer: the requesting peer
+        :param is_fast: is the peer fast
+        :return: whether the peer should request blocks of the piece
+        """
+        if piece.urgent or piece.owner is peer:
+            return True
+        if piece.owner is None:
+            return not is_fast
+        return piece.owner.is_snubbed
+
+    def __is_held_back(self, piece: DownloadingPiece, is_fast: bool) -> bool:
+        """
+        slow peers don't hold back pieces in the streaming window
+        """
+        return self.streaming_window and not is_fast and not piece.urgent and self.in_streaming_window(piece.index)
+
+    def disown_pieces(self, peer: Peer) -> None:
+        """
+        opens the pieces a peer that disconnected was working on to all the peers, to be completed as fast as possible
+        :param peer: the disconnected peer
+        :return: None
+        """
+        requested = {block.index for block, _ in peer.pipelined_requests.values()}
+        for piece in self.downloading.values():
+            if piece.owner is peer or (piece.owner is None and piece.index in requested):
+                piece.owner = None
+                piece.urgent = True
+
+    def __get_streaming_block(self, peer: Peer) -> Union[Block, None]:
+        """
+        picks a block from the streaming window, closest to the read cursor first.
+        every piece in the window gets a deadline by its distance from the cursor.
+        only fast peers may request pieces in the window, until a piece's deadline passes
+        :param peer: the requesting peer
+        :return: a Block instance | None
+        """
+        file_status = PiecePicker.FILE_STATUS[self.TorrentData.info_hash]
+        num_pieces = len(self.TorrentData.piece_hashes)
+        # slide the window over completed pieces
+        while self.read_cursor < num_pieces and file_status[self.read_cursor]:
+            self.deadlines.pop(self.read_cursor, None)
+            self.read_cursor += 1
+
+        rn = time.time()
+        is_fast = self.is_fast_peer(peer)
+        for index in range(self.read_cursor, min(self.read_cursor + self.streaming_window, num_pieces)):
+            if file_status[index] or not peer.have_pieces[index]:
+                continue
+            deadline = self.deadlines.setdefault(index, rn + (index - self.read_cursor + 1) * _STREAMING_PIECE_DEADLINE)
+            if not is_fast and deadline > rn:
+                continue
+
+            if (piece := self.downloading.get(index)) is not None:
+                if deadline <= rn:
+                    piece.urgent = True
+                if isinstance((block := piece.get_next_request()), Block):
+                    return block
+            elif self.index_of(index) is not None:
+                return self.__new_piece(index).get_next_request()
+        return None
+
+    async def get_block(self, peer: Peer) -> Block:
         """
         request a block from the remaining blocks
-        a block is chosen using rarest-first strategy with priority to failed pieces
-        :param have_mask: which pieces the peer can share
+        a block is chosen from the streaming window if there is one,
+        and then using rarest-first strategy with priority to failed pieces.
+        fast peers get pieces of their own and slow peers share pieces, as long as there are not too many open pieces.
+        a snubbed peer is only given blocks of new pieces
+        :param peer: the requesting peer, its have mask tells which pieces it can share
         :return: a Block instance | None if all blocks have been requested
         """
         if self.is_in_endgame:
             return None
+        have_mask = peer.have_pieces
         async with asyncio.Lock():
-            # search the downloading pieces first
-            for index, piece in self.downloading.items():
-                if have_mask[index]:
-                    if isinstance((block := piece.get_next_request()), Block):
-                        self.pending_blocks[block] = (block, time.time())
+            is_fast = self.is_fast_peer(peer)
+            # a snubbed peer only gets pieces of its own, so it never holds back the pieces other peers work on
+            if not peer.is_snubbed:
+                # the pieces right ahead of the read cursor come first
+                if self.streaming_window:
+                    if isinstance((block := self.__get_streaming_block(peer)), Block):
+                        self.pending_blocks[block.key] = (block, peer, time.time())
                         return block
 
+                # search the downloading pieces of the peer's speed class first
+                for index, piece in self.downloading.items():
+                    if have_mask[index] and self.__in_speed_class(piece, peer, is_fast) and not self.__is_held_back(piece, is_fast):
+                        if isinstance((block := piece.get_next_request()), Block):
+                            self.pending_blocks[block.key] = (block, peer, time.time())
+                            return block
+
+                # join any other piece rather than opening too many pieces
+                if len(self.downloading) >= self.max_open_pieces:
+                    for index, piece in self.downloading.items():
+                        if have_mask[index] and not self.__is_held_back(piece, is_fast):
+                            if isinstance((block := piece.get_next_request()), Block):
+                                self.pending_blocks[block.key] = (block, peer, time.time())
+                                return block
+
             # add another piece to the downloading dict
-            endgame_time = True  # will stay true if there are no pieces
-            for key in PriorityBucket.keys:
-                bucket: PriorityBucket = self.buckets_dict[key]
-                for piece in bucket.pieces_list:
-                    endgame_time = False
-                    if have_mask[piece.piece_index]:
-                        bucket.remove(piece)
-
-                        newPiece = DownloadingPiece(piece.piece_index, self.TorrentData.info[b'piece length'])
-                        # remove excessive blocks from the last piece
-                        if piece.piece_index == len(self.TorrentData.piece_hashes) - 1:
-                            extra = len(self.TorrentData.piece_hashes) * self.TorrentData.info[b'piece length'] - self.TorrentData.length
-                            while extra > BLOCK_SIZE:
-                                extra -= BLOCK_SIZE
-                                newPiece.blocks.pop()
-                                newPiece.blocks_length -= 1
-                            newPiece.blocks[-1].length -= extra
-
-                        # transfer the piece to downloading dict
-                        self.downloading[piece.piece_index] = newPiece
-
-                        # sort the downloading dict
-                        # the most requested piece (in theory) will be the first one
-                        # self.sort_downloading()  # no need to sort, the first pieces should be the most requested
-
-                        block = newPiece.get_next_request()
-                        self.pending_blocks[block] = (block, time.time())
-                        return block
+            endgame_time = not any(self.availability_indexes)  # will stay true if there are no pieces
+            for availability_index in self.availability_indexes:
+                if (piece_index := availability_index.rarest(have_mask)) is not None:
+                    break
+            if piece_index is not None:
+                piece = self.__new_piece(piece_index)
+                if is_fast or peer.is_snubbed:  # the pieces of a snubbed peer are open to everyone
+                    piece.owner = peer
+                block = piece.get_next_request()
+                self.pending_blocks[block.key] = (block, peer, time.time())
+                return block
 
             if endgame_time and not self.is_in_endgame:
                 self.endgame()
             return None
 
-    async def report_block(self, block: Block, add_data_args: Tuple[bytes, Tuple[str, int]]) -> None:
+    async def get_allowed_fast_block(self, peer: Peer) -> Union[Block, None]:
+        """
+        picks a block a peer that chokes me still lets me request, from its allowed fast pieces (BEP 6).
+        allowed fast pieces that are already downloading come first, new ones belong to the peer
+        :param peer: the choking peer
+        :return: a Block instance | None if there is nothing to request from the allowed fast pieces
+        """
+        if self.is_in_endgame:
+            return None
+        async with asyncio.Lock():
+            for index in peer.allowed_fast:
+                if (piece := self.downloading.get(index)) is not None and isinstance((block := piece.get_next_request()), Block):
+                    self.pending_blocks[block.key] = (block, peer, time.time())
+                    return block
+            for index in peer.allowed_fast:
+                if peer.have_pieces[index] and self.index_of(index) is not None:
+                    piece = self.__new_piece(index)
+                    piece.owner = peer
+                    block = piece.get_next_request()
+                    self.pending_blocks[block.key] = (block, peer, time.time())
+                    return block
+            return None
+
+    async def report_block(self, block: Block, add_data_args: Tuple[bytes, Tuple[str, int]], peer: Peer = None) -> None:
         """
         report about receiving a block of data
         if the piece is complete send it to disk IO manager
         :param block: Block instance whose data has arrived
         :param add_data_args: data received + ip of sender (tuple)
+        :param peer: the peer that sent the block
         :return: None
         """
         async with asyncio.Lock():
             # the stream already verified the block and made sure we requested it
             self.last_data_received = time.time()
-            if not block.add_data(*add_data_args) or PiecePicker.FILE_STATUS[self.TorrentData.info_hash][block.index]:
+            self.session.downloading.add(len(add_data_args[0]))
+            # a late block of a cancelled request may belong to a piece that completed or was picked again since
+            if self.downloading.get(block.index) is not block.piece or not block.add_data(*add_data_args) \
+                    or PiecePicker.FILE_STATUS[self.TorrentData.info_hash][block.index]:
                 self.session.wasted += len(add_data_args[0])
                 print('got duplicate')
                 return
@@ -210,9 +509,15 @@ class PiecePicker:
             self.session.downloaded += len(add_data_args[0])
 
             if self.is_in_endgame:
-                self.endgame_received_blocks.add(block)
+                # cancel the duplicate requests right away
+                for other_peer in self.endgame_blocks.pop(block.key, ()):
+                    if other_peer is not peer:
+                        other_peer.cancel_request(block)
             else:
-                self.pending_blocks.pop(block)
+                # a timed out request can still arrive after the block was re-requested from another peer
+                _, requester, _ = self.pending_blocks.pop(block.key, (None, None, None))
+                if requester is not None and requester is not peer:
+                    requester.cancel_request(block)
 
             piece = self.downloading[block.index]  # all endgame pieces must be in this dict
             # check if the piece is complete
@@ -235,18 +540,16 @@ class PiecePicker:
         # re-add failed pieces directly to the download dict with a toggled urgent flag
         # to download it successfully and ban the responsible peers as soon as possible
         piece.urgent = True
+        piece.owner = None
         async with asyncio.Lock():
             self.downloading[piece.index] = piece
             if not self.is_in_endgame:
                 self.sort_downloading()
             else:
-                set_blocks = set(piece.blocks)
-                self.endgame_received_blocks -= set_blocks
-                for peer in Peer.peer_instances[self.TorrentData.info_hash]:
-                    peer.endgame_request_msg_sent -= set_blocks
-
                 for block in piece.blocks:
-                    self.add_endgame_block(block)
+                    self.endgame_blocks[block.key] = set()
+                    self.requeue_endgame_block(block)
+            self.wake_peers()
 
     def change_availability(self, piece_index: int, difference: int) -> None:
         """
@@ -256,64 +559,198 @@ class PiecePicker:
         :param difference: with what value to increase the availability (can be negative)
         :return: None
         """
-        if self.is_in_endgame:
-            return
+        # the availability of every piece is tracked, the index only moves pieces that are not picked yet
+        if (availability_index := self.index_of(piece_index)) is None:
+            availability_index = self.availability_indexes[0]  # only updates the shared availability vector
+        if difference > 0:
+            for _ in range(difference):
+                availability_index.increment(piece_index)
+        else:
+            for _ in range(-difference):
+                availability_index.decrement(piece_index)
 
-        if piece_index in self.downloading or PiecePicker.FILE_STATUS[self.TorrentData.info_hash][piece_index]:
-            return
+    def add_peer_bitfield(self, bitfield: np.ndarray) -> None:
+        """
+        increases the availability of all the pieces in a peer's bitfield at once
+        note: this function should be called from within an asyncio.Lock()
+        :param bitfield: boolean vector of the new pieces the peer has
+        :return: None
+        """
+        self.availability += bitfield
+        for availability_index in self.availability_indexes:
+            availability_index.add_bitfield(bitfield, update_availability=False)
 
-        # get the bucket the piece is in
-        piece: PiecePos = self.pieces_map[piece_index]
-        bucket: PriorityBucket = self.buckets_dict[piece.peer_count]
-        if piece in bucket.pieces_list:
-            bucket.remove(piece)
-            piece.peer_count += difference
-            self.buckets_dict[piece.peer_count].add_piece(piece)
+    def remove_peer_bitfield(self, bitfield: np.ndarray) -> None:
+        """
+        decreases the availability of all the pieces in a peer's bitfield at once, usually on disconnection
+        note: this function should be called from within an asyncio.Lock()
+        :param bitfield: boolean vector of the pieces the peer had
+        :return: None
+        """
+        self.availability -= bitfield & (self.availability > 0)
+        for availability_index in self.availability_indexes:
+            availability_index.subtract_bitfield(bitfield, update_availability=False)
+
+    def index_of(self, piece_index: int) -> Union[AvailabilityIndex, None]:
+        """
+        :return: the availability index the piece is in | None if it is not pickable
+        """
+        for availability_index in self.availability_indexes:
+            if piece_index in availability_index:
+                return availability_index
+        return None
 
-    def deselect_block(self, block: Block) -> None:
+    def deselect_block(self, block: Block, peer: Peer) -> None:
         """
         deselects a block and pass it to be requested again
+        :param block: the block that will not arrive
+        :param peer: the peer the block was requested from
+        :return: None
         """
         if not self.is_in_endgame:
-            self.pending_blocks.pop(block)
-        else:
-            self.add_endgame_block(block)
-        self.downloading[block.index].deselect_block(block)
+            self.pending_blocks.pop(block.key, None)
+            if (piece := self.downloading.get(block.index)) is not None:
+                piece.deselect_block(block)
+        elif (requesters := self.endgame_blocks.get(block.key)) is not None:
+            requesters.discard(peer)
+            self.requeue_endgame_block(block)
 
     def endgame(self) -> None:
         """
         toggles endgame mode.
-        calculates the remaining blocks and toggles endgame mode in all peers
+        collects the remaining blocks with the peers they are already requested from.
+        from now on every block can be requested from up to _ENDGAME_REDUNDANCY peers
         """
-        unfiltered_blocks = list(self.pending_blocks.keys())
+        for peer in Peer.peer_instances[self.TorrentData.info_hash]:
+            for block, _ in peer.pipelined_requests.values():
+                self.endgame_blocks.setdefault(block.key, set()).add(peer)
         for piece in self.downloading.values():
             while isinstance((block := piece.get_next_request()), Block):
-                unfiltered_blocks.append(block)
+                self.endgame_blocks[block.key] = set()
 
         # print('ENDGAME !!!')
         self.is_in_endgame = True
+        self.pending_blocks.clear()  # from now on requests are timed by the peers' pipelines
 
         for peer in Peer.peer_instances[self.TorrentData.info_hash]:
             peer.is_in_endgame = True
-            peer.endgame_blocks = set(filter(lambda x: peer.have_pieces[x.index], unfiltered_blocks))
+            peer.endgame_queue = None
+            peer.wake()
 
-    def add_endgame_block(self, block: Block):
+    def get_endgame_block(self, peer: Peer) -> Union[Block, None]:
         """
-        adds a deselected block to the endgame blocks set
+        picks a block for the peer in endgame mode.
+        every peer has a queue of candidate blocks, least requested and rarest first, which is built once
+        (and again only if the peer's pieces change), so picking a block is O(1) amortized
+        :param peer: the requesting peer
+        :return: a Block instance | None if there is nothing to request from this peer
         """
+        if peer.endgame_queue is None:
+            candidates = [block for piece in self.downloading.values() if peer.have_pieces[piece.index] for block in piece.blocks
+                          if (requesters := self.endgame_blocks.get(block.key)) is not None and peer not in requesters]
+            candidates.sort(key=lambda x: (len(self.endgame_blocks[x.key]), self.availability[x.index], random()))
+            peer.endgame_queue = deque(candidates)
+
+        while peer.endgame_queue:
+            block = peer.endgame_queue.popleft()
+            requesters = self.endgame_blocks.get(block.key)
+            # skip received blocks, blocks already requested from this peer
+            # and blocks that reached the redundancy bound (they are re-queued when a request is dropped)
+            if requesters is None or peer in requesters or len(requesters) >= _ENDGAME_REDUNDANCY:
+                continue
+            requesters.add(peer)
+            return block
+        return None
+
+    def requeue_endgame_block(self, block: Block) -> None:
+        """
+        puts a block in front of the candidate queues of the peers that have it, after one of its requests was dropped
+        """
+        requesters = self.endgame_blocks[block.key]
         for peer in Peer.peer_instances[self.TorrentData.info_hash]:
-            if peer.have_pieces[block.index]:
-                peer.endgame_blocks.add(block)
+            if peer.endgame_queue is not None and peer.have_pieces[block.index] and peer not in requesters:
+                peer.endgame_queue.appendleft(block)
+
+    def check_timeouts(self) -> int:
+        """
+        re-issues the requests that were not answered within the expected latency of their peer.
+        the request is cancelled, the block is passed to be requested from another peer
+        and the peer is snubbed, unless it choked me and dropped the requests by itself
+        note: this function should be called from within an asyncio.Lock()
+        :return: number of timed out requests
+        """
+        rn = time.time()
+        if not self.is_in_endgame:
+            timed_out = [(block, peer) for block, peer, requested_at in self.pending_blocks.values() if rn - requested_at > peer.request_timeout]
+        else:
+            timed_out = [(block, peer) for peer in Peer.peer_instances.get(self.TorrentData.info_hash, [])
+                         for block, requested_at in peer.pipelined_requests.values() if rn - requested_at > peer.request_timeout]
+
+        for block, peer in timed_out:
+            if not peer.is_choked:
+                peer.snub()
+            peer.cancel_request(block)
+            self.deselect_block(block, peer)
+        if timed_out:
+            self.wake_peers()
+        return len(timed_out)
+
+    def expire_cancelled_requests(self) -> None:
+        """
+        forgets cancelled requests once they could no longer be answered in time, or once their piece is no longer
+        downloading. a peer may drop cancelled requests without a word, they would pile up for the whole connection
+        :return: None
+        """
+        rn = time.time()
+        for peer in Peer.peer_instances.get(self.TorrentData.info_hash, []):
+            expired = [key for key, (block, cancelled_at) in peer.cancelled_requests.items()
+                       if rn - cancelled_at > peer.request_timeout or self.downloading.get(block.index) is not block.piece]
+            for key in expired:
+                del peer.cancelled_requests[key]
+
+    def wake_peers(self) -> None:
+        """
+        wakes the connections of all the peers, when there are blocks to request again
+        :return: None
+        """
+        for peer in Peer.peer_instances.get(self.TorrentData.info_hash, []):
+            peer.wake()
+
+    async def timeout_loop(self) -> None:
+        """
+        checks for timed out requests every _TIMEOUT_CHECK_INTERVAL seconds
+        :return: None
+        """
+        while True:
+            await asyncio.sleep(_TIMEOUT_CHECK_INTERVAL)
+            async with asyncio.Lock():
+                self.check_timeouts()
+                self.expire_cancelled_requests()
+
+    def shared_pieces(self) -> bitstring.BitArray:
+        """
+        the pieces I have and can upload, for the bitfield I send
+        """
+        return PiecePicker.FILE_STATUS[self.TorrentData.info_hash] & self.shared_mask
+
+    def is_shared(self, piece_index: int) -> bool:
+        """
+        do I have the piece and can I upload it?
+        """
+        return PiecePicker.FILE_STATUS[self.TorrentData.info_hash][piece_index] and not self.unshared_pieces[piece_index]
 
     async def send_have(self, piece_index: int):
         """
         adds 'have' message to the queues of all peers that don't already have this piece
         """
+        if self.unshared_pieces[piece_index]:
+            return
         async with asyncio.Lock():
             for peer in Peer.peer_instances[self.TorrentData.info_hash]:
                 if not peer.have_pieces[piece_index]:
                     have_msg: bytes = Have.encode(piece_index)
                     peer.control_msg_queue.append(have_msg)
+                    peer.wake()
 
     @staticmethod
     async def send_choke(peer: Peer):
@@ -325,6 +762,7 @@ class PiecePicker:
             choke_msg: bytes = Choke.encode()
             peer.control_msg_queue = list(filter(lambda x: x[4] == 4, peer.control_msg_queue))
             peer.control_msg_queue.append(choke_msg)
+            peer.wake()
             print('choked ', repr(peer))
 
     @staticmethod
@@ -337,11 +775,16 @@ class PiecePicker:
             unchoke_msg: bytes = Unchoke.encode()
             peer.control_msg_queue = list(filter(lambda x: x[4] == 4, peer.control_msg_queue))
             peer.control_msg_queue.append(unchoke_msg)
+            peer.wake()
             print('unchoked ', repr(peer))
 
     @property
     def get_health(self):
         """
-        health of a torrent: what percentage of all pieces is available to download for me
+        health of a torrent: what percentage of the pieces I still want is available to download for me.
+        skipped and completed pieces are not counted
         """
-        return round((1 - self.buckets_dict[0].length / len(self.TorrentData.piece_hashes)) * 100, 2)
+        if not self.num_of_pieces_left:
+            return 100.0
+        missing = sum(availability_index.count(0) for availability_index in self.availability_indexes)
+        return round((1 - missing / self.num_of_pieces_left) * 100, 2)
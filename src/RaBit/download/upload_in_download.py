@@ -21,7 +21,7 @@ class TitForTat:
         self.MAX_OPTIMISTIC_PEERS = db_utils.get_configuration('max_optimistic_unchoke')
 
         self.piece_picker: PiecePicker = piece_picker
-        Peer.peer_instances[piece_picker.TorrentData.info_hash] = []  # this init happens before any peer is connected
+        Peer.peer_instances.setdefault(piece_picker.TorrentData.info_hash, [])  # connections that fetched the metadata of a magnet link are already in it
         self.piece_picker.session.peers = Peer.peer_instances[piece_picker.TorrentData.info_hash]
         self.peers: List[Peer] = Peer.peer_instances[piece_picker.TorrentData.info_hash]  # all connected peers
         self.downloaders: List[Peer] = []  # downloaders interested in what I offer
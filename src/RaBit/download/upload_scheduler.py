@@ -0,0 +1,174 @@
+from ..file.file_object import File
+from ..peer.peer_object import Peer
+from ..peer.message_types import Piece, BLOCK_SIZE
+
+import asyncio
+from collections import deque
+from typing import Tuple, List, Dict, Set, Deque, Union
+
+_QUANTUM = BLOCK_SIZE  # bytes a peer may be sent more every turn
+_MAX_BATCH = 16  # blocks read from disk together
+_MAX_READS = 8  # batches read at once, the next batches are read while the event loop sends the previous ones
+_RETRY_DELAY = 0.05  # seconds, peers whose connections did not take more data are tried again after it
+
+
+class UploadScheduler:
+    """
+    serves the requests of the peers while the torrent downloads.
+    the requests of every peer are queued by block, in the order they arrived, so a cancel removes its request at once.
+    the peers take turns with deficit round-robin: every turn a peer may be sent a quantum of bytes more, so the
+    unchoked peers share the upload fairly whatever the size of their requests.
+    a peer whose connection does not take more data, a full socket or its upload rate limit, misses its turns.
+    the blocks are read from disk in worker threads, so the connections never wait for the disk
+    """
+    def __init__(self, file_manager: File, session) -> None:
+        """
+        :param file_manager: File instance the blocks are read from
+        :param session: DownloadingSession instance with session stats
+        :return: None
+        """
+        self.file_manager = file_manager
+        self.session = session
+        self.queues: Dict[Peer, Dict[Tuple[int, int, int], None]] = dict()  # peer -> its queued requests (index, begin, length)
+        self.reading: Dict[Peer, Set[Tuple[int, int, int]]] = dict()  # peer -> its requests being read from disk
+        self.turns: Deque[Peer] = deque()  # peers with queued requests, in round-robin order
+        self.deficits: Dict[Peer, int] = dict()  # bytes every peer in the turns may still be sent
+        self.has_requests = asyncio.Event()
+
+    def add_request(self, peer: Peer, request: Tuple[int, int, int]) -> int:
+        """
+        queues a request of an unchoked peer for a block I have
+        :param peer: the peer
+        :param request: piece index, begin, length
+        :return: number of requests the peer has queued
+        """
+        if (queue := self.queues.get(peer)) is None:
+            queue = self.queues[peer] = dict()
+        queue[request] = None
+        if peer not in self.deficits:
+            self.deficits[peer] = 0
+            self.turns.append(peer)
+        self.has_requests.set()
+        return len(queue)
+
+    def cancel_request(self, peer: Peer, request: Tuple[int, int, int]) -> bool:
+        """
+        cancels a request, even while its block is read from disk
+        :param peer: the peer
+        :param request: piece index, begin, length
+        :return: whether the request was cancelled before its block was sent
+        """
+        if (queue := self.queues.get(peer)) is not None and request in queue:
+            del queue[request]
+            return True
+        if (reading := self.reading.get(peer)) is not None and request in reading:
+            reading.discard(request)
+            return True
+        return False
+
+    def drop_requests(self, peer: Peer) -> List[Tuple[int, int, int]]:
+        """
+        drops all the requests of a peer, when it is choked or disconnected
+        :param peer: the peer
+        :return: the requests whose blocks will not be sent
+        """
+        dropped = list(self.queues.pop(peer, ()))
+        dropped += self.reading.pop(peer, ())  # read, but not sent
+        return dropped  # the peer leaves the turns on its next turn
+
+    def __next_batch(self) -> List[Tuple[Peer, Tuple[int, int, int]]]:
+        """
+        takes the requests to serve next, in the order of the turns
+        :return: (peer, request) pairs
+        """
+        batch = []
+        missed = 0  # consecutive peers that could not take more data
+        while self.turns and len(batch) < _MAX_BATCH and missed < len(self.turns):
+            peer = self.turns[0]
+            if not (queue := self.queues.get(peer)):  # served or dropped
+                self.turns.popleft()
+                del self.deficits[peer]
+                continue
+            if not peer.writer.can_write():
+                self.turns.rotate(-1)
+                missed += 1
+                continue
+            missed = 0
+
+            self.deficits[peer] += _QUANTUM
+            reading = self.reading.setdefault(peer, set())
+            while queue and len(batch) < _MAX_BATCH and (request := next(iter(queue)))[2] <= self.deficits[peer]:
+                del queue[request]
+                self.deficits[peer] -= request[2]
+                reading.add(request)
+                batch.append((peer, request))
+
+            if queue:
+                self.turns.rotate(-1)
+            else:  # an idle peer does not keep its deficit
+                self.turns.popleft()
+                del self.deficits[peer]
+        return batch
+
+    def __read(self, requests: List[Tuple[int, int, int]]) -> List[Union[bytes, None]]:
+        """
+        runs in a worker thread
+        :return: data of every block | None if it could not be read, the files are closed once the download completes
+        """
+        blocks = []
+        for request in requests:
+            try:
+                blocks.append(self.file_manager.get_piece(*request)[2])
+            except (OSError, IndexError):
+                blocks.append(None)
+        return blocks
+
+    async def loop(self) -> None:
+        """
+        serves the queued requests
+        :return: None
+        """
+        reads = asyncio.Semaphore(_MAX_READS)
+        serving: Set[asyncio.Task] = set()
+        try:
+            while True:
+                await reads.acquire()
+                if not (batch := self.__next_batch()):
+                    reads.release()
+                    self.has_requests.clear()
+                    try:  # peers that could not take more data are tried again soon
+                        await asyncio.wait_for(self.has_requests.wait(), _RETRY_DELAY if self.turns else None)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                task = asyncio.create_task(self.__serve(batch))
+                serving.add(task)
+                task.add_done_callback(lambda done: (serving.discard(done), reads.release()))
+        finally:
+            for task in serving:
+                task.cancel()
+
+    async def __serve(self, batch: List[Tuple[Peer, Tuple[int, int, int]]]) -> None:
+        """
+        reads the blocks of a batch and sends them
+        :param batch: (peer, request) pairs
+        :return: None
+        """
+        blocks = await asyncio.to_thread(self.__read, [request for _, request in batch])
+
+        served: Set[Peer] = set()
+        for (peer, request), data in zip(batch, blocks):
+            if (reading := self.reading.get(peer)) is None or request not in reading:  # cancelled or dropped meanwhile
+                continue
+            reading.discard(request)
+            if data is None:
+                continue
+            peer.outbox.put(Piece.encode(request[0], request[1], data))
+            # update statistics
+            self.session.add_uploaded(len(data))
+            peer.downloaded += len(data)
+            peer.downloading.add(len(data))
+            served.add(peer)
+        for peer in served:
+            peer.wake()
@@ -1,12 +1,13 @@
 from ..app_data import db_utils
-from ..download.data_structures import DownloadingPiece, FailedPiece
+from ..download.data_structures import DownloadingPiece, FailedPiece, SKIP, NORMAL
 from ..download.piece_picker import BetterQueue, PiecePicker
 from ..peer.peer_object import Peer
 from ..torrent.torrent_object import Torrent
+from ..bandwidth import RateEstimator
 
 import asyncio
-from hashlib import sha1
-from typing import Tuple
+from typing import Tuple, List
+import numpy as np
 import threading
 import os
 import re
@@ -31,12 +32,65 @@ def format_file_name(file_name: str) -> str:
     return file_name
 
 
+def get_piece_priorities(TorrentData: Torrent, file_priorities: List[int] = None) -> np.ndarray:
+    """
+    maps file priorities to piece priorities.
+    a piece gets the highest priority of the files it overlaps,
+    so boundary pieces shared by a wanted file and a skipped file are still downloaded
+    :param TorrentData: torrent data instance
+    :param file_priorities: priority of each file in the torrent (SKIP, LOW, NORMAL, HIGH) | None for all NORMAL
+    :return: vector of piece priorities
+    """
+    if file_priorities is None:
+        return np.full(len(TorrentData.piece_hashes), NORMAL, dtype=np.uint8)
+
+    file_lengths = _file_lengths(TorrentData, file_priorities)
+    piece_length = TorrentData.info[b'piece length']
+    piece_priorities = np.full(len(TorrentData.piece_hashes), SKIP, dtype=np.uint8)
+    begin = 0
+    for length, priority in zip(file_lengths, file_priorities):
+        if length:
+            first, last = begin // piece_length, (begin + length - 1) // piece_length
+            piece_priorities[first:last + 1] = np.maximum(piece_priorities[first:last + 1], priority)
+        begin += length
+    return piece_priorities
+
+
+def get_unshared_pieces(TorrentData: Torrent, file_priorities: List[int] = None) -> np.ndarray:
+    """
+    finds the pieces that overlap a skipped file.
+    the parts of skipped files are never written, so these pieces can't be read back whole and are never shared,
+    even when the boundary pieces among them were downloaded for the wanted files
+    :param TorrentData: torrent data instance
+    :param file_priorities: priority of each file in the torrent (SKIP, LOW, NORMAL, HIGH) | None for all NORMAL
+    :return: boolean vector of the pieces that are never shared
+    """
+    unshared = np.zeros(len(TorrentData.piece_hashes), dtype=bool)
+    if file_priorities is None:
+        return unshared
+
+    piece_length = TorrentData.info[b'piece length']
+    begin = 0
+    for length, priority in zip(_file_lengths(TorrentData, file_priorities), file_priorities):
+        if length and priority == SKIP:
+            unshared[begin // piece_length:(begin + length - 1) // piece_length + 1] = True
+        begin += length
+    return unshared
+
+
+def _file_lengths(TorrentData: Torrent, file_priorities: List[int]) -> List[int]:
+    file_lengths = [file[b'length'] for file in TorrentData.info[b'files']] if TorrentData.multi_file else [TorrentData.length]
+    if len(file_lengths) != len(file_priorities):
+        raise ValueError('a priority must be given for each file')
+    return file_lengths
+
+
 class File:
     """
     disk IO manager to read/write pieces and validate them.
     an instance is created for each download
     """
-    def __init__(self, TorrentData: Torrent, session, piece_picker: PiecePicker, results_queue: BetterQueue, torrent_path: str, path: str, skip_hash_check: bool = False) -> None:
+    def __init__(self, TorrentData: Torrent, session, piece_picker: PiecePicker, results_queue: BetterQueue, torrent_path: str, path: str, skip_hash_check: bool = False, file_priorities: List[int] = None) -> None:
         """
         :param TorrentData: torrent data instance
         :param session: DownloadingSession instance with session stats
@@ -46,6 +100,7 @@ class File:
         :param path: path to where downloaded files will be saved
         :param skip_hash_check: whatever to skip the hash check
         (not recommended to turn off)
+        :param file_priorities: priority of each file, skipped files are not created | None to download all files
         :return: None
         """
         self.TorrentData = TorrentData
@@ -54,6 +109,8 @@ class File:
         self.piece_picker = piece_picker
         self.torrent_path = torrent_path
         self.session = session
+        num_files = len(TorrentData.info[b'files']) if TorrentData.multi_file else 1
+        self.file_priorities = [NORMAL] * num_files if file_priorities is None else file_priorities
 
         if not TorrentData.multi_file:
             self.file_names = [os.path.join(path, format_file_name(TorrentData.info[b'name'].decode('utf-8')))]
@@ -65,7 +122,7 @@ class File:
             total = 0
             self.file_indices = []
             self.file_names = []
-            for name in TorrentData.info[b'files']:
+            for name, priority in zip(TorrentData.info[b'files'], self.file_priorities):
                 total += name[b'length']
                 self.file_indices.append(total)
                 tree = list(reversed(name[b'path']))
@@ -75,22 +132,34 @@ class File:
                     file_name = os.path.join(file_name, format_file_name(level.decode('utf-8')))
                     if not tree:
                         break
-                    os.makedirs(file_name, exist_ok=True)
+                    if priority != SKIP:
+                        os.makedirs(file_name, exist_ok=True)
                 self.file_names.append(file_name)
 
-        if "nt" == os.name:
-            self.fds = [os.open(file_name, os.O_RDWR | os.O_CREAT | os.O_BINARY) for file_name in self.file_names]
-        else:
-            self.fds = [os.open(file_name, os.O_RDWR | os.O_CREAT) for file_name in self.file_names]
+        # skipped files are never created. their parts of boundary pieces are read as zeros and not written,
+        # so these pieces are never shared (get_unshared_pieces)
+        flags = os.O_RDWR | os.O_CREAT | os.O_BINARY if "nt" == os.name else os.O_RDWR | os.O_CREAT
+        self.fds = [os.open(file_name, flags) if priority != SKIP else None for file_name, priority in zip(self.file_names, self.file_priorities)]
+        # blocks are read for uploads in a worker thread while pieces are written, a seek and its read or write go together
+        self.fds_lock = threading.Lock()
+
+    @property
+    def is_selective(self) -> bool:
+        """
+        are some of the files skipped?
+        """
+        return SKIP in self.file_priorities
 
     def close_files(self) -> None:
         """
         closes the file descriptors
         :return: None
         """
-        for fd in self.fds:
-            os.close(fd)
-        self.fds = []
+        with self.fds_lock:
+            for fd in self.fds:
+                if fd is not None:
+                    os.close(fd)
+            self.fds = []
 
     def get_piece(self, piece_index: int, begin: int, length: int) -> Tuple[int, int, bytes]:
         """
@@ -105,22 +174,26 @@ class File:
         current_piece_abs_index = reading_begin_index
         first = True
         data = b''
-        for index, indice in enumerate(self.file_indices):
-            if reading_begin_index >= indice:
-                continue
+        with self.fds_lock:
+            for index, indice in enumerate(self.file_indices):
+                if reading_begin_index >= indice:
+                    continue
 
-            len_for_indice = min(remaining_length, indice - current_piece_abs_index)
+                len_for_indice = min(remaining_length, indice - current_piece_abs_index)
 
-            relative_file_begin = 0 if not first else current_piece_abs_index - self.file_indices[index - 1] if index > 0 else current_piece_abs_index
+                relative_file_begin = 0 if not first else current_piece_abs_index - self.file_indices[index - 1] if index > 0 else current_piece_abs_index
 
-            os.lseek(self.fds[index], relative_file_begin, os.SEEK_SET)
-            data += os.read(self.fds[index], len_for_indice)
+                if self.fds[index] is not None:
+                    os.lseek(self.fds[index], relative_file_begin, os.SEEK_SET)
+                    data += os.read(self.fds[index], len_for_indice)
+                else:  # skipped file
+                    data += bytes(len_for_indice)
 
-            remaining_length -= len_for_indice
-            current_piece_abs_index += len_for_indice
-            first = False
-            if remaining_length == 0:
-                break
+                remaining_length -= len_for_indice
+                current_piece_abs_index += len_for_indice
+                first = False
+                if remaining_length == 0:
+                    break
 
         if len(data) < length:  # add padding to the last piece
             data += b'\x00' * (length - len(data))
@@ -135,10 +208,14 @@ class File:
             if self.piece_picker.num_of_pieces_left == 0:
                 # TODO a more elegant exit, let all interested disconnect and then switch to seeding in seeding server
                 self.close_files()
-                # add to completed torrents db
-                self.session.state = 'Seeding'
                 self.session.peers = []
-                db_utils.CompletedTorrentsDB().insert_torrent(PickleableFile(self))
+                if self.is_selective:
+                    # only some files were downloaded, there is nothing complete to seed
+                    self.session.state = 'Completed'
+                else:
+                    # add to completed torrents db
+                    self.session.state = 'Seeding'
+                    db_utils.CompletedTorrentsDB().insert_torrent(PickleableFile(self))
                 db_utils.remove_ongoing_torrent(self.torrent_path)
                 loop = asyncio.get_event_loop()
                 loop.stop()
@@ -150,7 +227,7 @@ class File:
 
             if not self.skip_hash_check:
                 # hash check
-                piece_hash = sha1(data).digest()
+                piece_hash = piece.digest()
                 torrent_piece_hash = self.TorrentData.piece_hashes[piece.index]
                 if piece_hash != torrent_piece_hash:
                     print('received corrupted piece ', piece.index)
@@ -158,12 +235,12 @@ class File:
                     self.session.corrupted += len(data)
 
                     piece.previous_tries.append(FailedPiece(piece))
-                    piece.reset()
+                    piece.reset(hash_incrementally=False)  # the retry is hashed as a whole
                     await self.piece_picker.add_failed_piece(piece)
 
                     continue
 
-            self.session.progress = round((1 - (self.piece_picker.num_of_pieces_left - 1) / len(self.piece_picker.pieces_map)) * 100, 2)
+            self.session.progress = round((1 - (self.piece_picker.num_of_pieces_left - 1) / self.piece_picker.num_of_pieces) * 100, 2)
             print("\033[90m{}\033[00m".format(f'got piece. {self.session.progress}%. have index: {piece.index}. from {len(Peer.peer_instances[self.piece_picker.TorrentData.info_hash])} peers.'))
 
             # ban bad peers if any
@@ -185,30 +262,33 @@ class File:
             current_piece_abs_index = piece_abs_index
             piece_relative_begin = 0
             first = True
-            for index, indice in enumerate(self.file_indices):
-                if piece_abs_index >= indice:
-                    continue
+            with self.fds_lock:
+                for index, indice in enumerate(self.file_indices):
+                    if piece_abs_index >= indice:
+                        continue
 
-                len_for_indice = min(remaining_length, indice - current_piece_abs_index)
-                piece_relative_end = piece_relative_begin + len_for_indice
+                    len_for_indice = min(remaining_length, indice - current_piece_abs_index)
+                    piece_relative_end = piece_relative_begin + len_for_indice
 
-                relative_file_begin = 0 if not first else current_piece_abs_index - self.file_indices[index - 1] if index > 0 else current_piece_abs_index
+                    relative_file_begin = 0 if not first else current_piece_abs_index - self.file_indices[index - 1] if index > 0 else current_piece_abs_index
 
-                os.lseek(self.fds[index], relative_file_begin, os.SEEK_SET)
-                os.write(self.fds[index], data[piece_relative_begin:piece_relative_end])
+                    if self.fds[index] is not None:  # the parts of skipped files are dropped
+                        os.lseek(self.fds[index], relative_file_begin, os.SEEK_SET)
+                        os.write(self.fds[index], data[piece_relative_begin:piece_relative_end])
 
-                piece_relative_begin += len_for_indice
-                remaining_length -= len_for_indice
-                current_piece_abs_index += len_for_indice
-                first = False
-                if remaining_length == 0:
-                    break
+                    piece_relative_begin += len_for_indice
+                    remaining_length -= len_for_indice
+                    current_piece_abs_index += len_for_indice
+                    first = False
+                    if remaining_length == 0:
+                        break
 
             self.piece_picker.num_of_pieces_left -= 1
             self.session.left -= len(data)
             self.piece_picker.FILE_STATUS[self.TorrentData.info_hash][piece.index] = True  # update primary bitfield
             await self.piece_picker.send_have(piece.index)
             piece.reset()
+            piece.release()
 
     def __del__(self):
         try:
@@ -235,6 +315,7 @@ class PickleableFile:
         self.peers = []
         self.piece_length = file_object.TorrentData.info[b'piece length']
         self.num_pieces = len(file_object.TorrentData.piece_hashes)
+        self.is_private = file_object.TorrentData.info.get(b'private') == 1
         # additional torrent data
         self.comment = file_object.TorrentData.comment
         self.created_by = file_object.TorrentData.created_by
@@ -245,6 +326,7 @@ class PickleableFile:
         self.corrupted = file_object.session.corrupted
         self.wasted = file_object.session.wasted
         self.uploaded = file_object.session.uploaded
+        self.uploading = RateEstimator()
         # file details
         self.file_names = file_object.file_names
         self.fds = []
@@ -311,6 +393,29 @@ class PickleableFile:
 
         return piece_index, begin, data
 
+    def add_uploaded(self, size: int) -> None:
+        """
+        counts a block uploaded to a leecher
+        :param size: length of the block
+        :return: None
+        """
+        self.uploaded += size
+        self.uploading.add(size)
+
+    @property
+    def download_rate(self) -> float:
+        """
+        :return: download rate, in KiB/s
+        """
+        return 0.0  # download is already complete
+
+    @property
+    def upload_rate(self) -> float:
+        """
+        :return: upload rate, in KiB/s
+        """
+        return self.uploading.rate / 1024
+
     @property
     def ETA(self) -> float:
         """
@@ -318,6 +423,11 @@ class PickleableFile:
         """
         return 3184622406  # a very long time (100.9y) because download is already complete
 
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if 'uploading' not in state:  # stored before upload rates were estimated
+            self.uploading = RateEstimator()
+
     def __repr__(self):
         return f"uploaded: {self.uploaded}, name: {self.name}, info hash: {self.info_hash}"
 
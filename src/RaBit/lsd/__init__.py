@@ -0,0 +1,3 @@
+from .local_discovery import LocalDiscovery, start_local_discovery, subscribe, unsubscribe, build_announce, parse_announce
+
+__all__ = ['LocalDiscovery', 'start_local_discovery', 'subscribe', 'unsubscribe', 'build_announce', 'parse_announce']
@@ -0,0 +1,213 @@
+from ..app_data import db_utils
+from ..seeding.utils import FileObjects, get_internal_ip
+
+import asyncio
+import os
+import socket
+import struct
+import time
+from typing import Tuple, List, Dict, Set, Callable, Iterable, Union
+
+LSD_GROUP = '239.192.152.143'
+LSD_PORT = 6771
+_ANNOUNCE_INTERVAL = 5 * 60  # BEP 14, every torrent is announced every 5 minutes
+# a seeded torrent is announced back to a peer that announced it. the seeding server cannot connect to the peer,
+# so the peer would wait for the next announce otherwise
+_MIN_REPLY_INTERVAL = 5
+_MAX_INFO_HASHES = 20  # info hashes in a single announce, so it fits in a datagram
+_TICK = 1
+
+
+def build_announce(info_hashes: Iterable[bytes], port: int, cookie: str) -> bytes:
+    """
+    builds a local service discovery announce (BEP 14)
+    :param info_hashes: info hashes of the torrents
+    :param port: the tcp port peers connect to
+    :param cookie: my cookie, to recognize my own announces
+    :return: the announce datagram
+    """
+    lines = ['BT-SEARCH * HTTP/1.1', f'Host: {LSD_GROUP}:{LSD_PORT}', f'Port: {port}']
+    lines += [f'Infohash: {info_hash.hex()}' for info_hash in info_hashes]
+    lines += [f'cookie: {cookie}', '', '', '']
+    return '\r\n'.join(lines).encode('ascii')
+
+
+def parse_announce(data: bytes) -> Union[Tuple[int, List[bytes], Union[str, None]], None]:
+    """
+    :param data: a datagram from the multicast group
+    :return: port, info hashes, cookie | None if it is not a valid announce
+    """
+    try:
+        lines = data.decode('ascii').split('\r\n')
+    except UnicodeDecodeError:
+        return None
+    if lines[0] != 'BT-SEARCH * HTTP/1.1':
+        return None
+
+    port, info_hashes, cookie = None, [], None
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name, value = name.strip().lower(), value.strip()
+        if name == 'port' and value.isdigit() and 0 < int(value) < 65536:
+            port = int(value)
+        elif name == 'infohash' and len(value) == 40 and len(info_hashes) < _MAX_INFO_HASHES:
+            try:
+                info_hashes.append(bytes.fromhex(value))
+            except ValueError:
+                pass
+        elif name == 'cookie':
+            cookie = value
+    if port is None or not info_hashes:
+        return None
+    return port, info_hashes, cookie
+
+
+class LocalDiscovery(asyncio.DatagramProtocol):
+    """
+    local service discovery (BEP 14): torrents are announced to the LAN with multicast,
+    and the peers on the LAN that announce the torrents I want are found within seconds
+    """
+    def __init__(self, on_peer: Callable[[bytes, Tuple[str, int]], None]) -> None:
+        """
+        :param on_peer: called with the info hash and the (ip, port) of every peer that announced a torrent
+        :return: None
+        """
+        self.on_peer = on_peer
+        self.cookie = os.urandom(8).hex()  # several clients can run on the same host
+        self.transport: Union[asyncio.DatagramTransport, None] = None
+
+    async def start(self, interface_ip: str = None) -> None:
+        """
+        joins the multicast group
+        :param interface_ip: ip of the LAN interface | None for the default interface
+        :return: None
+        """
+        interface = socket.inet_aton(interface_ip if interface_ip is not None else '0.0.0.0')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):  # every client on the host gets the announces
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', LSD_PORT))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack('4s4s', socket.inet_aton(LSD_GROUP), interface))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, interface)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        await asyncio.get_running_loop().create_datagram_endpoint(lambda: self, sock=sock)
+
+    def close(self) -> None:
+        if self.transport is not None:
+            self.transport.close()
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+
+    def connection_lost(self, exc: Union[Exception, None]) -> None:
+        self.transport = None
+
+    def error_received(self, exc: Exception) -> None:
+        pass
+
+    def datagram_received(self, data: bytes, address: Tuple[str, int]) -> None:
+        if (announce := parse_announce(data)) is None:
+            return
+        port, info_hashes, cookie = announce
+        if cookie == self.cookie:  # my own announce
+            return
+        for info_hash in info_hashes:
+            self.on_peer(info_hash, (address[0], port))
+
+    def announce(self, info_hashes: List[bytes], port: int) -> None:
+        """
+        announces torrents to the LAN
+        :param info_hashes: info hashes of the torrents
+        :param port: the tcp port peers connect to
+        :return: None
+        """
+        if self.transport is None:
+            return
+        for i in range(0, len(info_hashes), _MAX_INFO_HASHES):
+            self.transport.sendto(build_announce(info_hashes[i: i + _MAX_INFO_HASHES], port, self.cookie), (LSD_GROUP, LSD_PORT))
+
+
+# downloads that want local peers: info hash -> event loop of the download, callback with the address of a peer
+_subscribers: Dict[bytes, Tuple[asyncio.AbstractEventLoop, Callable[[Tuple[str, int]], None]]] = dict()
+_last_announce: Dict[bytes, float] = dict()
+_replies: Set[bytes] = set()  # seeded torrents that another peer just announced, I announce them back
+# the event loop of local service discovery, and the event that wakes it up to announce right away
+_lsd_loop: Union[asyncio.AbstractEventLoop, None] = None
+_wakeup: Union[asyncio.Event, None] = None
+
+
+def subscribe(info_hash: bytes, callback: Callable[[Tuple[str, int]], None]) -> None:
+    """
+    a download wants the peers on the LAN. the torrent is announced right away, so LAN seeders announce it back.
+    must be called from the event loop of the download, the callback is called in it
+    :param info_hash: info hash of the torrent
+    :param callback: called with the (ip, port) of every peer on the LAN that announces the torrent
+    :return: None
+    """
+    _subscribers[info_hash] = (asyncio.get_running_loop(), callback)
+    _last_announce.pop(info_hash, None)
+    if _lsd_loop is not None:
+        try:
+            _lsd_loop.call_soon_threadsafe(_wakeup.set)
+        except RuntimeError:  # the loop is closed
+            pass
+
+
+def unsubscribe(info_hash: bytes) -> None:
+    _subscribers.pop(info_hash, None)
+
+
+def __on_peer(info_hash: bytes, address: Tuple[str, int]) -> None:
+    """
+    passes a LAN peer to the download of the torrent, and answers the announces of torrents I seed
+    """
+    if (subscriber := _subscribers.get(info_hash)) is not None:
+        loop, callback = subscriber
+        try:
+            loop.call_soon_threadsafe(callback, address)
+        except RuntimeError:  # the download ended
+            _subscribers.pop(info_hash, None)
+    if info_hash in FileObjects:
+        _replies.add(info_hash)
+        _wakeup.set()
+
+
+async def start_local_discovery() -> None:
+    """
+    runs local service discovery for the client: the seeded torrents and the downloads are announced with the port
+    of the seeding server, which LAN peers reach without the port mapping
+    :return: None
+    """
+    global _lsd_loop, _wakeup
+    try:
+        _wakeup = asyncio.Event()
+        discovery = LocalDiscovery(__on_peer)
+        await discovery.start(get_internal_ip())
+        _lsd_loop = asyncio.get_running_loop()
+        print('local service discovery joined the multicast group')
+
+        while True:
+            _wakeup.clear()
+            now = time.time()
+            seeded = [info_hash for info_hash, file_object in list(FileObjects.items()) if not getattr(file_object, 'is_private', False)]
+            due = []
+            for info_hash in dict.fromkeys(seeded + list(_subscribers)):
+                since = now - _last_announce.get(info_hash, 0)
+                if since >= _ANNOUNCE_INTERVAL or (info_hash in _replies and since >= _MIN_REPLY_INTERVAL):
+                    due.append(info_hash)
+                    _last_announce[info_hash] = now
+                    _replies.discard(info_hash)
+            if due and (port := db_utils.get_configuration('v4_forward')['internal_port']):
+                discovery.announce(due, port)
+
+            # replies that are not due yet are sent on the next tick
+            try:
+                await asyncio.wait_for(_wakeup.wait(), _TICK)
+            except asyncio.TimeoutError:
+                pass
+
+    except Exception as e:
+        print(f'local service discovery stopped: {e}')
+    finally:
+        _lsd_loop = None
@@ -0,0 +1,288 @@
+from ..utp import open_utp_connection
+from ..bandwidth import RateLimiter, RateEstimator, UPLOAD, DOWNLOAD
+from .framing import MessageBuffer, _READ_SIZE
+
+import asyncio
+import struct
+from collections import deque
+from typing import Tuple, Callable, Any, Deque, Union
+
+_IDLE_TIMEOUT = 5  # seconds, receive() gives control back after it even if nothing happened
+_MAX_QUEUED_MESSAGES = 256  # reading is paused above it until the consumer catches up
+
+
+class PeerConnection(asyncio.BufferedProtocol):
+    """
+    a peer wire connection.
+    data is received straight into a MessageBuffer and every complete message is decoded and dispatched
+    to message_received() as soon as it arrives. the consumer waits for messages with receive(), which is woken
+    by new messages, by wake() or by a timer, instead of polling the socket.
+    the connection also acts as the reader and the writer of the connection, with the parts of
+    asyncio's StreamReader and StreamWriter interfaces the rest of the code uses.
+    once the torrent is known the connection gets a rate limiter: reading pauses while the download buckets are
+    in debt, and drain() waits while the upload buckets are.
+    the rates of all the bytes on the wire are estimated too, the messages and their headers included
+    """
+    def __init__(self, decode: Callable[[memoryview], Any], client_connected: Callable = None) -> None:
+        """
+        :param decode: turns a message into a message instance, None to ignore it. raises AssertionError or struct.error on protocol errors
+        :param client_connected: coroutine function to start with (reader, writer) once an incoming connection is made
+        :return: None
+        """
+        self.decode = decode
+        self.client_connected = client_connected
+        self.transport: Union[asyncio.Transport, None] = None
+
+        self.messages = MessageBuffer()
+        self.inbox: Deque = deque()  # decoded messages waiting for the consumer
+        self.is_consuming = False  # the consumer handles the last message receive() returned, it may point to the buffer
+        self.is_framing = False  # the handshake is not framed
+        self.reading_paused = False
+        self.receive_waiter: Union[asyncio.Future, None] = None
+        self.is_woken = False  # wake() was called while the consumer was busy
+        self.raw_size = 0  # number of unframed bytes the receive waiter waits for
+
+        self.writing_paused = False
+        self.drain_waiter: Union[asyncio.Future, None] = None
+
+        self.limiter: Union[RateLimiter, None] = None
+        self.throttled = False  # reading is paused by the download rate limit
+        self.written = 0  # bytes written since the upload rate limit was consulted
+        self.received = RateEstimator()  # all the bytes read from the connection
+        self.sent = RateEstimator()  # all the bytes written to the connection
+
+        self.is_eof = False
+        self.error: Union[Exception, None] = None
+        self.closed: Union[asyncio.Future, None] = None
+        self.handler_task: Union[asyncio.Task, None] = None  # a reference to the task of an incoming connection
+
+    # protocol callbacks
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        loop = asyncio.get_running_loop()
+        self.closed = loop.create_future()
+        if self.client_connected is not None:
+            self.handler_task = loop.create_task(self.client_connected(self, self))
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        # decoded messages in the inbox, and the one the consumer handles, may still point to the buffer.
+        # the consumer may yield before it copied the block of a piece message out of it
+        return self.messages.get_free_space(max(sizehint, _READ_SIZE), move=not self.inbox and not self.is_consuming)
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.messages.commit(nbytes)
+        self.received.add(nbytes)
+        if self.limiter is not None and (delay := self.limiter.consume(DOWNLOAD, nbytes)) > 0 and not self.throttled:
+            self.throttled = True
+            self.transport.pause_reading()
+            asyncio.get_running_loop().call_later(delay, self.__unthrottle)
+        if self.is_framing:
+            self.__dispatch()
+        elif len(self.messages) >= self.raw_size:
+            self.__wake_waiter()
+
+    def eof_received(self) -> bool:
+        self.is_eof = True
+        self.__wake_waiter()
+        return False  # close the transport
+
+    def connection_lost(self, exc: Union[Exception, None]) -> None:
+        self.is_eof = True
+        if not self.closed.done():
+            self.closed.set_result(None)
+        self.__wake_waiter()
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_exception(ConnectionResetError('Connection lost'))
+
+    def pause_writing(self) -> None:
+        self.writing_paused = True
+
+    def resume_writing(self) -> None:
+        self.writing_paused = False
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+    # receiving
+
+    def __unthrottle(self) -> None:
+        """
+        resumes reading once the download rate limit allows it
+        """
+        if (delay := self.limiter.consume(DOWNLOAD, 0)) > 0:
+            asyncio.get_running_loop().call_later(delay, self.__unthrottle)
+            return
+        self.throttled = False
+        if not self.reading_paused and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def __dispatch(self) -> None:
+        """
+        decodes all the complete messages in the buffer
+        """
+        try:
+            while (msg := self.messages.next_message()) is not None:
+                if (decoded := self.decode(msg)) is not None:
+                    self.message_received(decoded)
+        except (AssertionError, struct.error) as e:  # protocol error
+            self.error = e
+            self.transport.close()
+            self.__wake_waiter()
+
+    def message_received(self, msg: Any) -> None:
+        """
+        called for every decoded message. queues it for the consumer
+        :param msg: message instance
+        :return: None
+        """
+        self.inbox.append(msg)
+        if len(self.inbox) >= _MAX_QUEUED_MESSAGES and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+        self.__wake_waiter()
+
+    def wake(self) -> None:
+        """
+        wakes the consumer waiting in receive(), e.g. when there is something to send.
+        if the consumer is busy, its next receive() returns right away
+        :return: None
+        """
+        if self.receive_waiter is not None:
+            self.__wake_waiter()
+        else:
+            self.is_woken = True
+
+    def __wake_waiter(self) -> None:
+        if self.receive_waiter is not None and not self.receive_waiter.done():
+            self.receive_waiter.set_result(None)
+
+    async def __wait(self, timeout: float) -> None:
+        loop = asyncio.get_running_loop()
+        self.receive_waiter = loop.create_future()
+        timer = loop.call_later(timeout, self.__wake_waiter)
+        try:
+            await self.receive_waiter
+        finally:
+            timer.cancel()
+            self.receive_waiter = None
+
+    async def receive(self, timeout: float = _IDLE_TIMEOUT) -> Any:
+        """
+        waits for the next message. the message is valid until the next call
+        :param timeout: max time to wait, in seconds
+        :return: message instance | None if no message arrived in time or the consumer was woken
+        """
+        self.is_consuming = False  # done with the former message
+        if not self.is_framing:
+            self.is_framing = True
+            self.__dispatch()
+
+        is_woken, self.is_woken = self.is_woken, False
+        if not self.inbox:
+            if self.error is None and not self.is_eof and not is_woken:
+                await self.__wait(timeout)
+            if not self.inbox:
+                if self.error is not None:
+                    raise self.error
+                if self.is_eof:
+                    raise StopAsyncIteration
+                return None
+
+        msg = self.inbox.popleft()
+        self.is_consuming = True
+        if self.reading_paused and len(self.inbox) < _MAX_QUEUED_MESSAGES // 2:
+            self.reading_paused = False
+            if not self.throttled:
+                self.transport.resume_reading()
+        return msg
+
+    async def readexactly(self, size: int) -> bytes:
+        """
+        reads raw bytes before the messages start, i.e. the handshake
+        :param size: number of bytes to read
+        :return: the bytes
+        """
+        self.raw_size = size
+        while len(self.messages) < size:
+            if self.is_eof:
+                raise asyncio.IncompleteReadError(self.messages.take(len(self.messages)), size)
+            await self.__wait(_IDLE_TIMEOUT)
+        return self.messages.take(size)
+
+    # writing
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        self.written += len(data)
+        self.sent.add(len(data))
+        self.transport.write(data)
+
+    async def drain(self) -> None:
+        if self.transport.is_closing():
+            # let connection_lost() run, like StreamWriter.drain()
+            await asyncio.sleep(0)
+            if self.is_eof:
+                raise ConnectionResetError('Connection lost')
+        if self.writing_paused:
+            self.drain_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.drain_waiter
+            finally:
+                self.drain_waiter = None
+        if self.limiter is not None and self.written:
+            written, self.written = self.written, 0
+            if (delay := self.limiter.consume(UPLOAD, written)) > 0:
+                await asyncio.sleep(delay)
+
+    def can_write(self) -> bool:
+        """
+        can more data be written right away? not while the transport is full or the upload buckets are in debt
+        :return: whether the connection takes more data
+        """
+        if self.writing_paused or self.transport.is_closing():
+            return False
+        if self.limiter is not None:
+            written, self.written = self.written, 0
+            return self.limiter.consume(UPLOAD, written) == 0
+        return True
+
+    def close(self) -> None:
+        self.transport.close()
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    async def wait_closed(self) -> None:
+        await self.closed
+
+    def get_extra_info(self, name: str, default: Any = None) -> Any:
+        return self.transport.get_extra_info(name, default)
+
+    def set_torrent(self, info_hash: bytes) -> None:
+        """
+        the connection is limited by the rates of the torrent from now on
+        :param info_hash: info hash of the torrent
+        :return: None
+        """
+        self.limiter = RateLimiter(info_hash)
+
+
+async def open_peer_connection(address: Tuple[str, int], decode: Callable[[memoryview], Any]) -> PeerConnection:
+    """
+    opens an outgoing peer wire connection
+    :param address: (ip, port) of the peer
+    :param decode: message decoder of the connection
+    :return: the connection, both the reader and the writer
+    """
+    _, connection = await asyncio.get_running_loop().create_connection(lambda: PeerConnection(decode), *address)
+    return connection
+
+
+async def open_utp_peer_connection(address: Tuple[str, int], decode: Callable[[memoryview], Any]) -> PeerConnection:
+    """
+    opens an outgoing peer wire connection over uTP (BEP 29)
+    :param address: (ip, port) of the peer
+    :param decode: message decoder of the connection
+    :return: the connection, both the reader and the writer
+    """
+    _, connection = await open_utp_connection(address, lambda: PeerConnection(decode))
+    return connection
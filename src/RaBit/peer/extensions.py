@@ -0,0 +1,191 @@
+from .message_types import Extended
+
+import bencodepy
+import socket
+import struct
+import time
+from typing import Tuple, List, Dict, Set, Iterable, Union
+
+# extended message ids I assign to the extensions I support, sent in my extended handshake
+EXTENDED_HANDSHAKE = 0
+UT_PEX = 1
+UT_METADATA = 2
+LOCAL_EXTENSIONS = {b'ut_pex': UT_PEX, b'ut_metadata': UT_METADATA}
+
+# ut_metadata message types
+METADATA_REQUEST = 0
+METADATA_DATA = 1
+METADATA_REJECT = 2
+
+_CLIENT_NAME = b'RaBit 1.0.0'
+
+_PEX_INTERVAL = 60  # BEP 11, at most one pex message a minute
+_MIN_PEX_INTERVAL = 45  # incoming pex messages sooner than this are ignored
+_MAX_PEX_PEERS = 50  # BEP 11, added or dropped peers in a single message
+_COMPACT_V4 = struct.Struct('>4sH')
+_COMPACT_V6 = struct.Struct('>16sH')
+
+
+def extended_handshake(max_requests: int, is_private: bool, metadata_size: int = None) -> bytes:
+    """
+    builds my extended handshake
+    :param max_requests: number of outstanding requests I accept from the peer
+    :param is_private: private torrents (BEP 27) do not exchange peers
+    :param metadata_size: size of the info dict | None if I do not have it yet (magnet link)
+    :return: the extended message
+    """
+    payload = {
+        b'm': {b'ut_metadata': UT_METADATA} if is_private else LOCAL_EXTENSIONS,  # extension name -> my message id
+        b'v': _CLIENT_NAME,
+        b'reqq': max_requests
+    }
+    if metadata_size is not None:
+        payload[b'metadata_size'] = metadata_size
+    return Extended.encode(EXTENDED_HANDSHAKE, bencodepy.encode(payload))
+
+
+def parse_extended_handshake(payload: Union[bytes, memoryview]) -> Tuple[Dict[bytes, int], Union[int, None], Union[int, None]]:
+    """
+    gets the extensions of the peer out of its extended handshake
+    :param payload: bencoded payload of the extended handshake
+    :return: extension name -> message id of the peer, disabled extensions are left out,
+             size of the info dict | None if the peer did not tell,
+             number of outstanding requests the peer accepts (reqq) | None if the peer did not tell
+    """
+    handshake = _decode_payload(payload)
+    extensions = handshake.get(b'm', {})
+    assert isinstance(extensions, dict)
+    metadata_size = handshake.get(b'metadata_size')
+    max_requests = handshake.get(b'reqq')
+    return ({name: ext_id for name, ext_id in extensions.items() if isinstance(ext_id, int) and 0 < ext_id < 256},
+            metadata_size if isinstance(metadata_size, int) else None,
+            max_requests if isinstance(max_requests, int) and max_requests > 0 else None)
+
+
+def _decode_payload(payload: Union[bytes, memoryview]) -> dict:
+    """
+    :return: the bencoded dictionary of an extended message. raises AssertionError if it is not one
+    """
+    try:
+        message = bencodepy.decode(bytes(payload))
+    except bencodepy.DecodingError:
+        raise AssertionError
+    assert isinstance(message, dict)
+    return message
+
+
+def _encode_compact(addresses: Iterable[Tuple[str, int]]) -> Tuple[bytes, bytes]:
+    """
+    :return: compact ipv4 addresses, compact ipv6 addresses
+    """
+    v4, v6 = [], []
+    for ip, port in addresses:
+        if ':' in ip:
+            v6.append(_COMPACT_V6.pack(socket.inet_pton(socket.AF_INET6, ip), port))
+        else:
+            v4.append(_COMPACT_V4.pack(socket.inet_aton(ip), port))
+    return b''.join(v4), b''.join(v6)
+
+
+def _decode_compact(data: bytes, layout: struct.Struct, family: int) -> List[Tuple[str, int]]:
+    """
+    :return: (ip, port) addresses of a compact peers string, at most _MAX_PEX_PEERS of them
+    """
+    assert isinstance(data, bytes)
+    data = data[:len(data) - len(data) % layout.size][:_MAX_PEX_PEERS * layout.size]
+    return [(socket.inet_ntop(family, ip), port) for ip, port in layout.iter_unpack(data) if port != 0]
+
+
+def metadata_message(ext_id: int, msg_type: int, piece: int, total_size: int = None, data: bytes = b'') -> bytes:
+    """
+    builds a ut_metadata (BEP 9) message
+    :param ext_id: the peer's message id for ut_metadata
+    :param msg_type: METADATA_REQUEST | METADATA_DATA | METADATA_REJECT
+    :param piece: index of the 16 KiB metadata piece
+    :param total_size: size of the info dict, for data messages
+    :param data: the piece, for data messages. it follows the bencoded dictionary
+    :return: the extended message
+    """
+    payload = {b'msg_type': msg_type, b'piece': piece}
+    if total_size is not None:
+        payload[b'total_size'] = total_size
+    return Extended.encode(ext_id, bencodepy.encode(payload) + data)
+
+
+def parse_metadata_message(payload: Union[bytes, memoryview]) -> Tuple[int, int, bytes]:
+    """
+    :param payload: payload of a ut_metadata message
+    :return: message type, piece index, the piece of a data message
+    """
+    payload = bytes(payload)
+    message = _decode_payload(payload)  # the data after the dictionary is left out
+    msg_type, piece = message.get(b'msg_type'), message.get(b'piece')
+    assert isinstance(msg_type, int) and isinstance(piece, int)
+    # the dictionary is as long as its canonical encoding
+    return msg_type, piece, payload[len(bencodepy.encode(message)):]
+
+
+class PeerExchange:
+    """
+    ut_pex (BEP 11) state of a connection.
+    every minute the peer is told which peers I connected to and which I dropped since the last message,
+    and the peers it tells me about are passed on to the connection manager
+    """
+    def __init__(self, ext_id: int) -> None:
+        """
+        :param ext_id: the peer's message id for ut_pex
+        :return: None
+        """
+        self.ext_id = ext_id
+        self.advertised: Set[Tuple[str, int]] = set()  # the peers the other side knows from me
+        self.next_send = 0.0  # the first message is sent right away
+        self.last_received = -_MIN_PEX_INTERVAL
+
+    def is_due(self) -> bool:
+        """
+        :return: whether a minute has passed since the last pex message
+        """
+        return time.time() >= self.next_send
+
+    def build_message(self, connected: Iterable[Tuple[str, int]]) -> Union[bytes, None]:
+        """
+        builds the next pex message, the next one is due in a minute
+        :param connected: addresses of the peers I am connected to, without the peer itself
+        :return: the extended message | None if nothing changed since the last message
+        """
+        self.next_send = time.time() + _PEX_INTERVAL
+
+        connected = set(connected)
+        added = [address for address in connected if address not in self.advertised][:_MAX_PEX_PEERS]
+        dropped = [address for address in self.advertised if address not in connected][:_MAX_PEX_PEERS]
+        if not added and not dropped:
+            return None
+        self.advertised.difference_update(dropped)
+        self.advertised.update(added)
+
+        added_v4, added_v6 = _encode_compact(added)
+        dropped_v4, dropped_v6 = _encode_compact(dropped)
+        payload = {
+            b'added': added_v4,
+            b'added.f': bytes(len(added_v4) // _COMPACT_V4.size),  # no flags are known
+            b'added6': added_v6,
+            b'added6.f': bytes(len(added_v6) // _COMPACT_V6.size),
+            b'dropped': dropped_v4,
+            b'dropped6': dropped_v6
+        }
+        return Extended.encode(self.ext_id, bencodepy.encode(payload))
+
+    def parse_message(self, payload: Union[bytes, memoryview]) -> List[Tuple[str, int]]:
+        """
+        gets the new peers out of a pex message of the peer.
+        messages that come too often are ignored, and only the first _MAX_PEX_PEERS peers of every family are used
+        :param payload: bencoded payload of the pex message
+        :return: (ip, port) addresses of the added peers
+        """
+        if time.time() - self.last_received < _MIN_PEX_INTERVAL:
+            return []
+        self.last_received = time.time()
+
+        message = _decode_payload(payload)
+        return (_decode_compact(message.get(b'added', b''), _COMPACT_V4, socket.AF_INET) +
+                _decode_compact(message.get(b'added6', b''), _COMPACT_V6, socket.AF_INET6))
@@ -0,0 +1,105 @@
+from .message_types import MAX_ALLOWED_MSG_SIZE
+
+import struct
+from typing import Union
+
+_READ_SIZE = 2 ** 16
+_LENGTH = struct.Struct('>I')
+
+
+class MessageBuffer:
+    """
+    a receive buffer for length-prefixed peer wire messages.
+    data is written after the end offset and messages are sliced from the read offset as memoryviews,
+    so a message is never copied out of the buffer. the unread bytes are moved to the front only when
+    there is no room left at the end, and the buffer grows only if a single message doesn't fit in it
+    """
+    def __init__(self, capacity: int = 2 * MAX_ALLOWED_MSG_SIZE + _READ_SIZE, max_msg_size: int = MAX_ALLOWED_MSG_SIZE) -> None:
+        """
+        :param capacity: initial size of the buffer
+        :param max_msg_size: longer messages are a protocol error
+        :return: None
+        """
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.max_msg_size = max_msg_size
+        self.start = 0  # read offset
+        self.end = 0  # write offset
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def get_free_space(self, size: int, move: bool = True) -> memoryview:
+        """
+        makes room for at least size more bytes
+        :param size: number of bytes about to be written
+        :param move: false if views of former messages are still in use, so their bytes must not be overwritten
+        :return: a view of the free space at the end of the buffer
+        """
+        if len(self.buffer) - self.end < size:
+            unread = self.end - self.start
+            if move and unread + size <= len(self.buffer):
+                # move the unread bytes to the front
+                self.view[:unread] = self.view[self.start:self.end]
+            else:
+                # views of former messages keep the old buffer alive
+                capacity = len(self.buffer) if unread + size <= len(self.buffer) else max(2 * len(self.buffer), unread + size)
+                buffer = bytearray(capacity)
+                buffer[:unread] = self.view[self.start:self.end]
+                self.buffer = buffer
+                self.view = memoryview(self.buffer)
+            self.start, self.end = 0, unread
+        return self.view[self.end:]
+
+    def commit(self, size: int) -> None:
+        """
+        marks bytes written to the view returned by get_free_space() as received
+        :param size: number of bytes written
+        :return: None
+        """
+        self.end += size
+
+    def feed(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        """
+        appends received data to the buffer
+        :param data: the received data
+        :return: None
+        """
+        size = len(data)
+        self.get_free_space(size)[:size] = data
+        self.end += size
+
+    def take(self, size: int) -> bytes:
+        """
+        reads raw bytes that are not framed, like the handshake
+        :param size: number of bytes to read, must be buffered already
+        :return: the bytes
+        """
+        data = bytes(self.view[self.start:self.start + size])
+        self.start += size
+        return data
+
+    def next_message(self) -> Union[memoryview, None]:
+        """
+        slices the next complete message out of the buffer. keep-alives are skipped
+        note: the view is only valid until more data is written to the buffer
+        :return: a view of the message, length prefix included | None if the message is not complete yet
+        """
+        while self.end - self.start >= 4:
+            length = _LENGTH.unpack_from(self.buffer, self.start)[0] + 4
+            if length == 4:  # keepalive
+                self.start += 4
+                continue
+
+            # defend overflow
+            if length > self.max_msg_size:
+                raise AssertionError
+
+            if self.end - self.start < length:
+                return None
+
+            msg = self.view[self.start:self.start + length]
+            self.start += length
+            return msg
+
+        return None
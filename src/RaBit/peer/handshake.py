@@ -1,29 +1,45 @@
+from ..app_data import db_utils
 from ..torrent.torrent_object import Torrent
+from ..dht import get_dht_port
 
-from typing import Tuple, Union
+from .connection import open_peer_connection, open_utp_peer_connection
+from .message_types import DHT_EXTENSION, FAST_EXTENSION, EXTENSION_PROTOCOL
+
+from typing import Tuple, Union, Callable, Any
 import asyncio
 import struct
 
+_UTP_CONNECT_TIMEOUT = 1  # a peer that does not answer uTP in time is connected over tcp
+_TCP_CONNECT_TIMEOUT = 3
+
 
-async def open_tcp_connection(address: Tuple[str, int]) -> Tuple:
+async def open_connection(address: Tuple[str, int], decode: Callable[[memoryview], Any]) -> Tuple:
     """
-    opens a tcp connection to an address
+    opens a connection to an address, over uTP (BEP 29) if it is enabled and the peer answers it, otherwise over tcp
     :param address: (ip, port) of peer
-    :return: asyncio instances of (reader, writer) | (None, None)
+    :param decode: message decoder of the connection
+    :return: (reader, writer), both are the same PeerConnection instance | (None, None)
     """
+    if db_utils.get_configuration('utp_enabled'):
+        try:
+            connection = await asyncio.wait_for(open_utp_peer_connection(address, decode), _UTP_CONNECT_TIMEOUT)
+            return connection, connection
+        except (OSError, asyncio.TimeoutError):
+            pass
     try:
-        reader, writer = await asyncio.open_connection(*address)
-        return reader, writer
-    except OSError:
+        connection = await asyncio.wait_for(open_peer_connection(address, decode), _TCP_CONNECT_TIMEOUT)
+        return connection, connection
+    except (OSError, asyncio.TimeoutError):
         # print('connection refused')
         return None, None
 
 
-def __build__handshake_packet(info_hash: bytes, peer_id: bytes) -> bytes:
+def __build__handshake_packet(info_hash: bytes, peer_id: bytes, extensions: int) -> bytes:
     """
     builds the handshake packet
     :param info_hash: info hash of the requested torrent
     :param peer_id: peer id of the client for this torrent
+    :param extensions: reserved bits of the supported extensions
     :return: packet data in raw bytes
     """
     string_format = '>B19sQ20s20s'
@@ -31,42 +47,45 @@ def __build__handshake_packet(info_hash: bytes, peer_id: bytes) -> bytes:
     data = struct.pack(string_format,
                        19,  # len of protocol name
                        b'BitTorrent protocol',  # protocol name
-                       0,  # reserve 8 bytes for extensions, none will be used
+                       extensions,  # reserved 8 bytes, bits of the supported extensions
                        info_hash,  # info hash of info dictionary
                        peer_id)  # my id for this download
 
     return data
 
 
-def __validate_handshake(data: bytes, info_hash1: bytes) -> Union[bytes, None]:
+def __validate_handshake(data: bytes, info_hash1: bytes) -> Union[Tuple[bytes, int], Tuple[None, None]]:
     """
     validates the other peer actually "speaks" the protocol and has the file
     :param data: raw handshake bytes
     :param info_hash1: expected info hash to be returned
-    :return: peer id | None if operation failed
+    :return: peer id, reserved bits of the peer's extensions | None, None if operation failed
     """
     string_format = '>20sQ20s20s'
     len_n_protocol, extensions, info_hash2, peer_id = struct.unpack(string_format, data)
     if len_n_protocol == b'\x13BitTorrent protocol' and info_hash1 == info_hash2:
-        return peer_id
+        return peer_id, extensions
     else:
-        return None
+        return None, None
 
 
-async def handshake(TorrentData: Torrent, reader, writer) -> Union[bytes, None]:
+async def handshake(TorrentData: Torrent, reader, writer) -> Union[Tuple[bytes, int], Tuple[None, None]]:
     """
     performs the exchange of handshakes
     :param TorrentData: torrent data instance
     :param reader: asyncio reader instance
     :param writer: asyncio writer instance
-    :return: peer id | None if operation failed
+    :return: peer id, reserved bits of the peer's extensions | None, None if operation failed
     """
-    request_data = __build__handshake_packet(TorrentData.info_hash, TorrentData.peer_id)
+    extensions = FAST_EXTENSION | EXTENSION_PROTOCOL
+    # private torrents (BEP 27) do not use the DHT
+    if get_dht_port() is not None and not (TorrentData.info is not None and TorrentData.info.get(b'private') == 1):
+        extensions |= DHT_EXTENSION
+    request_data = __build__handshake_packet(TorrentData.info_hash, TorrentData.peer_id, extensions)
 
     writer.write(request_data)
     await writer.drain()
-    data = await reader.read(68)  # len of handshake
+    data = await reader.readexactly(68)  # len of handshake
 
     # validate the protocol
-    peer_id = __validate_handshake(data, TorrentData.info_hash)
-    return peer_id
+    return __validate_handshake(data, TorrentData.info_hash)
@@ -1,5 +1,7 @@
 import struct
 import bitstring
+import numpy as np
+from typing import Union, Iterable, Callable, List, Any, Dict, Awaitable
 
 # messages id
 CHOKE = 0
@@ -12,21 +14,50 @@ REQUEST = 6
 PIECE = 7
 CANCEL = 8
 PORT = 9
+# fast extension (BEP 6)
+SUGGEST_PIECE = 13
+HAVE_ALL = 14
+HAVE_NONE = 15
+REJECT_REQUEST = 16
+ALLOWED_FAST = 17
+FAST_MESSAGES = (SUGGEST_PIECE, HAVE_ALL, HAVE_NONE, REJECT_REQUEST, ALLOWED_FAST)
+# extension protocol (BEP 10)
+EXTENDED = 20
+
+# reserved handshake bits of the supported extensions
+DHT_EXTENSION = 0x01  # BEP 5, the last bit of the last reserved byte
+FAST_EXTENSION = 0x04  # BEP 6, the third bit of the last reserved byte
+EXTENSION_PROTOCOL = 0x100000  # BEP 10, the fifth bit of the sixth reserved byte
 
 # default request block size
 BLOCK_SIZE = 2 ** 14
 MAX_ALLOWED_MSG_SIZE = 2 ** 15 + 9
 
+# precompiled message layouts
+_HEADER = struct.Struct('>IB')  # <len><id>
+_HAVE = struct.Struct('>IBI')  # also the layout of suggest piece and allowed fast
+_REQUEST = struct.Struct('>IBIII')  # also the layout of cancel and reject request
+_PIECE_HEADER = struct.Struct('>IBII')
+_PORT = struct.Struct('>IBH')
+_EXTENDED_HEADER = struct.Struct('>IBB')
+
 
 class Choke:
     """
     I cannot send requests to this peer anymore
     choke: <len=0001><id=0>
     """
+    __slots__ = ()
+    ID = CHOKE
+    MESSAGE = _HEADER.pack(1, CHOKE)
 
     @staticmethod
     def encode() -> bytes:
-        return struct.pack('>IB', 1, CHOKE)
+        return Choke.MESSAGE
+
+    @classmethod
+    def decode(cls, msg: memoryview) -> object:
+        return cls()
 
 
 class Unchoke:
@@ -34,10 +65,17 @@ class Unchoke:
     I can now send requests to this peer
     unchoke: <len=0001><id=1>
     """
+    __slots__ = ()
+    ID = UNCHOKE
+    MESSAGE = _HEADER.pack(1, UNCHOKE)
 
     @staticmethod
     def encode() -> bytes:
-        return struct.pack('>IB', 1, UNCHOKE)
+        return Unchoke.MESSAGE
+
+    @classmethod
+    def decode(cls, msg: memoryview) -> object:
+        return cls()
 
 
 class Interested:
@@ -45,10 +83,17 @@ class Interested:
     let the peer know I want to download from it
     interested: <len=0001><id=2>
     """
+    __slots__ = ()
+    ID = INTERESTED
+    MESSAGE = _HEADER.pack(1, INTERESTED)
 
     @staticmethod
     def encode() -> bytes:
-        return struct.pack('>IB', 1, INTERESTED)
+        return Interested.MESSAGE
+
+    @classmethod
+    def decode(cls, msg: memoryview) -> object:
+        return cls()
 
 
 class NotInterested:
@@ -56,10 +101,17 @@ class NotInterested:
     let the peer know I do want to download from it
     not interested: <len=0001><id=3>
     """
+    __slots__ = ()
+    ID = NOT_INTERESTED
+    MESSAGE = _HEADER.pack(1, NOT_INTERESTED)
 
     @staticmethod
     def encode() -> bytes:
-        return struct.pack('>IB', 1, NOT_INTERESTED)
+        return NotInterested.MESSAGE
+
+    @classmethod
+    def decode(cls, msg: memoryview) -> object:
+        return cls()
 
 
 class Have:
@@ -67,20 +119,19 @@ class Have:
     to let the downloader know it can request this piece
     have: <len=0005><id=4><piece index>
     """
+    __slots__ = ('piece_index',)
+    ID = HAVE
 
     def __init__(self, piece_index):
         self.piece_index = piece_index
 
     @staticmethod
     def encode(piece_index: int) -> bytes:
-        return struct.pack('>IBI',
-                           5,
-                           HAVE,
-                           piece_index)
+        return _HAVE.pack(5, HAVE, piece_index)
 
     @classmethod
-    def decode(cls, msg: bytes) -> object:
-        _, _, index = struct.unpack('>IBI', msg)
+    def decode(cls, msg: memoryview) -> object:
+        _, _, index = _HAVE.unpack(msg)
         return cls(index)
 
 
@@ -89,27 +140,41 @@ class Bitfield:
     to let the downloader know which pieces it can request
     bitfield: <len=0001+X><id=5><bitfield>
     """
+    __slots__ = ('bitfield',)
+    ID = BITFIELD
 
-    def __init__(self, bitfield: bitstring.bitarray):
+    def __init__(self, bitfield: np.ndarray):
         self.bitfield = bitfield
 
     @staticmethod
-    def encode(org_bitfield: bitstring.BitArray) -> bytes:
-        bitfield = org_bitfield[:]
-        if len(bitfield) % 8 != 0:  # add padding
-            bitfield += bitstring.BitArray(uint=0, length=(8 - (len(bitfield) % 8)))
-
-        return struct.pack(f'>IB{len(bitfield.bytes)}s',
-                           len(bitfield.bytes) + 1,
-                           BITFIELD,
-                           bitfield.bytes)
+    def encode(bitfield: Union[bitstring.BitArray, np.ndarray]) -> bytes:
+        # spare bits at the end are padded with zeros
+        payload = np.packbits(bitfield).tobytes() if isinstance(bitfield, np.ndarray) else bitfield.tobytes()
+        return _HEADER.pack(len(payload) + 1, BITFIELD) + payload
 
     @classmethod
-    def decode(cls, msg: bytes, pieces_num: int) -> object:
-        _, _, bitfield = struct.unpack(f'>IB{len(msg) - 5}s', msg)
-        bitfield = bitstring.BitArray(bytes=bitfield)
-        bitfield = bitfield[:pieces_num]
-        return cls(bitfield)
+    def decode(cls, msg: memoryview, pieces_num: Union[int, None]) -> object:
+        # unpack straight to a boolean vector.
+        # all the bits are kept if the number of pieces is not known yet (magnet link)
+        bitfield = np.unpackbits(np.frombuffer(msg, dtype=np.uint8, offset=5)).astype(bool)
+        if pieces_num is None:
+            return cls(bitfield)
+        return cls(cls.trim(bitfield, pieces_num))
+
+    @staticmethod
+    def trim(bitfield: np.ndarray, pieces_num: int) -> np.ndarray:
+        """
+        checks all the bits of a bitfield against the number of pieces: exactly ceil(pieces_num / 8) bytes,
+        with the spare bits at the end cleared
+        :param bitfield: all the bits of the bitfield
+        :param pieces_num: number of pieces of the torrent
+        :return: the bitfield without the spare bits
+        """
+        if len(bitfield) != (pieces_num + 7) // 8 * 8:
+            raise struct.error('bitfield length does not match the number of pieces')
+        if bitfield[pieces_num:].any():
+            raise struct.error('bitfield has spare bits set')
+        return bitfield[:pieces_num]
 
 
 class Request:
@@ -117,6 +182,8 @@ class Request:
     request the data of a block
     request: <len=0013><id=6><index><begin><length>
     """
+    __slots__ = ('piece_index', 'begin', 'length')
+    ID = REQUEST
 
     def __init__(self, piece_index: int, begin: int, length: int):
         self.piece_index = piece_index
@@ -125,16 +192,11 @@ class Request:
 
     @staticmethod
     def encode(piece_index: int, begin: int, length: int = BLOCK_SIZE) -> bytes:
-        return struct.pack('>IBIII',
-                           13,
-                           REQUEST,
-                           piece_index,
-                           begin,
-                           length)
+        return _REQUEST.pack(13, REQUEST, piece_index, begin, length)
 
     @classmethod
-    def decode(cls, msg: bytes) -> object:
-        _, _, piece_index, begin, length = struct.unpack('>IBIII', msg)
+    def decode(cls, msg: memoryview) -> object:
+        _, _, piece_index, begin, length = _REQUEST.unpack(msg)
         return cls(piece_index, begin, length)
 
 
@@ -143,26 +205,25 @@ class Piece:
     contains the data of a requested block
     piece: <len=0009+X><id=7><index><begin><block>
     """
+    __slots__ = ('piece_index', 'begin', 'length', 'data')
+    ID = PIECE
 
-    def __init__(self, piece_index: int, begin: int, data: bytes):
+    def __init__(self, piece_index: int, begin: int, data: Union[bytes, memoryview]):
         self.piece_index = piece_index
         self.begin = begin
         self.length = len(data)
         self.data = data
 
     @staticmethod
-    def encode(piece_index, begin, data) -> bytes:
-        return struct.pack(f'>IBII{len(data)}s',
-                           len(data) + 9,
-                           PIECE,
-                           piece_index,
-                           begin,
-                           data)
+    def encode(piece_index: int, begin: int, data: Union[bytes, memoryview]) -> bytes:
+        # a single copy of the data, straight after the header
+        return _PIECE_HEADER.pack(len(data) + 9, PIECE, piece_index, begin) + data
 
     @classmethod
-    def decode(cls, msg: bytes) -> object:
-        _, _, piece_index, begin, data = struct.unpack(f'>IBII{len(msg) - 13}s', msg)
-        return cls(piece_index, begin, data)
+    def decode(cls, msg: memoryview) -> object:
+        _, _, piece_index, begin = _PIECE_HEADER.unpack_from(msg)
+        # the block's data is not copied until it is placed in the piece's buffer
+        return cls(piece_index, begin, memoryview(msg)[13:])
 
 
 class Cancel:
@@ -170,6 +231,8 @@ class Cancel:
     cancel the pending block request
     cancel: <len=0013><id=8><index><begin><length>
     """
+    __slots__ = ('piece_index', 'begin', 'length')
+    ID = CANCEL
 
     def __init__(self, piece_index: int, begin: int, length: int):
         self.piece_index = piece_index
@@ -178,16 +241,11 @@ class Cancel:
 
     @staticmethod
     def encode(piece_index: int, begin: int, length: int) -> bytes:
-        return struct.pack('>IBIII',
-                           13,
-                           CANCEL,
-                           piece_index,
-                           begin,
-                           length)
+        return _REQUEST.pack(13, CANCEL, piece_index, begin, length)
 
     @classmethod
-    def decode(cls, msg: bytes) -> object:
-        _, _, piece_index, begin, length = struct.unpack('>IBIII', msg)
+    def decode(cls, msg: memoryview) -> object:
+        _, _, piece_index, begin, length = _REQUEST.unpack(msg)
         return cls(piece_index, begin, length)
 
 
@@ -196,18 +254,197 @@ class Port:
     the port this peer's DHT node is listening on
     port: <len=0003><id=9><listen-port>
     """
+    __slots__ = ('port',)
+    ID = PORT
 
     def __init__(self, port: int):
         self.port = port
 
     @staticmethod
-    def encode(port: int):
-        return struct.pack('>IBH',
-                           3,
-                           PORT,
-                           port)
+    def encode(port: int) -> bytes:
+        return _PORT.pack(3, PORT, port)
 
     @classmethod
-    def decode(cls, msg: bytes) -> object:
-        _, _, port = struct.unpack('>IBH', msg)
+    def decode(cls, msg: memoryview) -> object:
+        _, _, port = _PORT.unpack(msg)
         return cls(port)
+
+
+class SuggestPiece:
+    """
+    a hint which piece is worth downloading, e.g. because it is in the peer's cache (fast extension)
+    suggest piece: <len=0005><id=13><piece index>
+    """
+    __slots__ = ('piece_index',)
+    ID = SUGGEST_PIECE
+
+    def __init__(self, piece_index: int):
+        self.piece_index = piece_index
+
+    @staticmethod
+    def encode(piece_index: int) -> bytes:
+        return _HAVE.pack(5, SUGGEST_PIECE, piece_index)
+
+    @classmethod
+    def decode(cls, msg: memoryview) -> object:
+        _, _, index = _HAVE.unpack(msg)
+        return cls(index)
+
+
+class HaveAll:
+    """
+    replaces the bitfield of a peer that has all the pieces (fast extension)
+    have all: <len=0001><id=14>
+    """
+    __slots__ = ()
+    ID = HAVE_ALL
+    MESSAGE = _HEADER.pack(1, HAVE_ALL)
+
+    @staticmethod
+    def encode() -> bytes:
+        return HaveAll.MESSAGE
+
+    @classmethod
+    def decode(cls, msg: memoryview) -> object:
+        return cls()
+
+
+class HaveNone:
+    """
+    replaces the bitfield of a peer that has no pieces (fast extension)
+    have none: <len=0001><id=15>
+    """
+    __slots__ = ()
+    ID = HAVE_NONE
+    MESSAGE = _HEADER.pack(1, HAVE_NONE)
+
+    @staticmethod
+    def encode() -> bytes:
+        return HaveNone.MESSAGE
+
+    @classmethod
+    def decode(cls, msg: memoryview) -> object:
+        return cls()
+
+
+class RejectRequest:
+    """
+    the request will not be answered, instead of dropping it silently (fast extension)
+    reject request: <len=0013><id=16><index><begin><length>
+    """
+    __slots__ = ('piece_index', 'begin', 'length')
+    ID = REJECT_REQUEST
+
+    def __init__(self, piece_index: int, begin: int, length: int):
+        self.piece_index = piece_index
+        self.begin = begin
+        self.length = length
+
+    @staticmethod
+    def encode(piece_index: int, begin: int, length: int) -> bytes:
+        return _REQUEST.pack(13, REJECT_REQUEST, piece_index, begin, length)
+
+    @classmethod
+    def decode(cls, msg: memoryview) -> object:
+        _, _, piece_index, begin, length = _REQUEST.unpack(msg)
+        return cls(piece_index, begin, length)
+
+
+class AllowedFast:
+    """
+    the piece can be requested even while choked (fast extension)
+    allowed fast: <len=0005><id=17><piece index>
+    """
+    __slots__ = ('piece_index',)
+    ID = ALLOWED_FAST
+
+    def __init__(self, piece_index: int):
+        self.piece_index = piece_index
+
+    @staticmethod
+    def encode(piece_index: int) -> bytes:
+        return _HAVE.pack(5, ALLOWED_FAST, piece_index)
+
+    @classmethod
+    def decode(cls, msg: memoryview) -> object:
+        _, _, index = _HAVE.unpack(msg)
+        return cls(index)
+
+
+class Extended:
+    """
+    a message of an extension negotiated in the extended handshake, which is extended message 0 (extension protocol)
+    extended: <len=0002+X><id=20><extended message id><bencoded payload>
+    """
+    __slots__ = ('ext_id', 'payload')
+    ID = EXTENDED
+
+    def __init__(self, ext_id: int, payload: memoryview):
+        self.ext_id = ext_id
+        self.payload = payload
+
+    @staticmethod
+    def encode(ext_id: int, payload: bytes) -> bytes:
+        return _EXTENDED_HEADER.pack(len(payload) + 2, EXTENDED, ext_id) + payload
+
+    @classmethod
+    def decode(cls, msg: memoryview) -> object:
+        _, _, ext_id = _EXTENDED_HEADER.unpack_from(msg)
+        return cls(ext_id, memoryview(msg)[6:])
+
+
+MESSAGE_TYPES = (Choke, Unchoke, Interested, NotInterested, Have, Bitfield, Request, Piece, Cancel, Port,
+                 SuggestPiece, HaveAll, HaveNone, RejectRequest, AllowedFast, Extended)
+
+
+def __unsupported_message(msg: memoryview) -> None:
+    raise AssertionError
+
+
+def __ignored_message(msg: memoryview) -> None:
+    return None
+
+
+def build_decoder(supported: Iterable[int], pieces_num: Union[int, None] = 0, ignored: Iterable[int] = ()) -> Callable[[memoryview], Any]:
+    """
+    builds a message decoder that dispatches with a table indexed by the message id.
+    the downloading and the seeding connections build their own decoder out of the same message types
+    :param supported: ids of the messages to decode
+    :param pieces_num: number of pieces in the torrent, for bitfields | None if it is not known yet
+    :param ignored: ids of messages that are allowed but not decoded
+    :return: decode(msg) -> msg instance corresponding to the type | None if the message is ignored
+    """
+    table: List[Callable[[memoryview], Any]] = [__unsupported_message] * 256
+    for msg_type in MESSAGE_TYPES:
+        if msg_type.ID in supported:
+            table[msg_type.ID] = msg_type.decode
+    if BITFIELD in supported:
+        table[BITFIELD] = lambda msg: Bitfield.decode(msg, pieces_num)
+    for msg_id in ignored:
+        table[msg_id] = __ignored_message
+
+    def decode(msg: memoryview) -> Any:
+        return table[msg[4]](msg)
+
+    return decode
+
+
+def build_dispatcher(handlers: Dict[int, Callable[[Any], Union[Awaitable[None], None]]]) -> Callable[[Any], Awaitable[bool]]:
+    """
+    builds a message dispatcher with a table indexed by the message id, like the decoder.
+    the downloading and the seeding connections register their own handlers, a handler can be a coroutine function
+    :param handlers: handler of each message id
+    :return: async dispatch(msg) -> whether a handler took the message
+    """
+    table: List[Union[Callable[[Any], Union[Awaitable[None], None]], None]] = [None] * 256
+    for msg_id, handler in handlers.items():
+        table[msg_id] = handler
+
+    async def dispatch(msg: Any) -> bool:
+        if msg is None or (handler := table[msg.ID]) is None:
+            return False
+        if (result := handler(msg)) is not None:
+            await result
+        return True
+
+    return dispatch
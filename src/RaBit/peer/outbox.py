@@ -0,0 +1,51 @@
+from typing import List, Union
+
+
+class Outbox:
+    """
+    coalesces the outgoing messages of a connection.
+    messages are queued and written together in a single write when the connection loop flushes
+    once per iteration, or as soon as the queued messages reach the flush threshold
+    """
+    def __init__(self, writer, flush_threshold: int) -> None:
+        """
+        :param writer: writer of the connection
+        :param flush_threshold: number of queued bytes that are written without waiting for a flush
+        :return: None
+        """
+        self.writer = writer
+        self.flush_threshold = flush_threshold
+        self.messages: List[Union[bytes, bytearray, memoryview]] = []
+        self.size = 0  # queued bytes
+
+    def __len__(self) -> int:
+        return self.size
+
+    def put(self, msg: Union[bytes, bytearray, memoryview]) -> None:
+        """
+        queues an encoded message
+        :param msg: the message
+        :return: None
+        """
+        self.messages.append(msg)
+        self.size += len(msg)
+        if self.size >= self.flush_threshold:
+            self.write()
+
+    def write(self) -> None:
+        """
+        writes all the queued messages to the transport
+        :return: None
+        """
+        if self.messages:
+            self.writer.write(self.messages[0] if len(self.messages) == 1 else b''.join(self.messages))
+            self.messages.clear()
+            self.size = 0
+
+    async def flush(self) -> None:
+        """
+        writes all the queued messages and waits for the writer to drain
+        :return: None
+        """
+        self.write()
+        await self.writer.drain()
@@ -1,292 +1,407 @@
 from ..app_data import db_utils
 from ..torrent.torrent_object import Torrent
 from ..download.piece_picker import PiecePicker, Block
+from ..download.data_structures import get_block_key
 from ..download.upload_in_download import TitForTat
+from ..download.upload_scheduler import UploadScheduler
 from ..file.file_object import File
+from ..dht import add_node, get_dht_port
 from .peer_object import Peer
-from .handshake import handshake, open_tcp_connection
+from .handshake import handshake, open_connection
 from .message_types import *
+from .extensions import *
+from .connection import PeerConnection
 
 import asyncio
 import struct
-from random import random, seed
-from typing import Tuple, List, Any
+import time
+import numpy as np
+from math import ceil
+from typing import Tuple, List, Set, Any, Callable, Union
 
-_BUFFER_SIZE = 4096
 _MAX_REQUESTS = 500
+_SUPPORTED_MESSAGES = (CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, HAVE, BITFIELD, REQUEST, PIECE, CANCEL, PORT)
 
 
 class Stream:
-    def __init__(self, reader, thisPeer, TorrentData: Torrent):
-        self.reader = reader
+    def __init__(self, connection: PeerConnection, thisPeer):
+        self.connection = connection
         self.thisPeer = thisPeer
-        self.buffer = b''
-        self.bitfield_len = len(TorrentData.piece_hashes)
-
-    def __consume(self, msg_length):
-        self.buffer = self.buffer[msg_length:]
 
     def __aiter__(self):
         return self
 
     async def __anext__(self) -> Any:
         """
-        reads and formats messages from an outgoing peer
-        :return: msg instance corresponding to the type
+        waits for the next message from an outgoing peer.
+        first, everything queued since the last message is sent in a single write
+        :return: msg instance corresponding to the type | None if the connection was idle or woken up
         """
-        while True:
-            assert not self.thisPeer.found_dirty  # get rid of a connection with a dirty peer
-
-            data = b''
-
-            async def send_control_msg():
-                async with asyncio.Lock():
-                    while self.thisPeer.control_msg_queue:
-                        self.thisPeer.writer.write(self.thisPeer.control_msg_queue.pop())
-                        await self.thisPeer.writer.drain()
-
-            async def get_data():
-                nonlocal data
-                data = await self.reader.read(_BUFFER_SIZE)
-
-            if self.thisPeer.control_msg_queue:
-                await send_control_msg()
-
-            insufficient = False
-            if len(self.buffer) >= 4:
-                length = struct.unpack('>I', self.buffer[0:4])[0] + 4
-                if length == 4:  # keepalive
-                    self.__consume(4)
-                    continue
-
-                # defend overflow
-                if length > MAX_ALLOWED_MSG_SIZE:
-                    raise AssertionError
-
-                if len(self.buffer) < length:
-                    insufficient = True
+        assert not self.thisPeer.found_dirty  # get rid of a connection with a dirty peer
 
-                else:
-                    msg = self.buffer[:length]
-                    msg_id = msg[4]
-
-            if insufficient or len(self.buffer) < 4:
-                try:
-                    await asyncio.wait_for(get_data(), 0.5)
-                except asyncio.TimeoutError:
-                    return None
-
-                self.buffer += data
-                if not self.buffer:
-                    raise StopAsyncIteration
-                continue
-
-            self.__consume(length)
-            if msg_id == CHOKE:
-                return Choke()
-            elif msg_id == UNCHOKE:
-                return Unchoke()
-            elif msg_id == INTERESTED:
-                return Interested()
-            elif msg_id == NOT_INTERESTED:
-                return NotInterested()
-            elif msg_id == HAVE:
-                return Have.decode(msg)
-            elif msg_id == BITFIELD:
-                return Bitfield.decode(msg, self.bitfield_len)
-            elif msg_id == REQUEST:
-                return Request.decode(msg)
-            elif msg_id == PIECE:
-                return Piece.decode(msg)
-            elif msg_id == CANCEL:
-                return Cancel.decode(msg)
+        if self.thisPeer.control_msg_queue:
+            for control_msg in self.thisPeer.control_msg_queue:
+                self.thisPeer.outbox.put(control_msg)
+            self.thisPeer.control_msg_queue.clear()
+        await self.thisPeer.outbox.flush()
 
-            else:
-                # unsupported message
-                raise AssertionError
+        return await self.connection.receive()
 
 
-async def tcp_wire_communication(peerData: Tuple, TorrentData: Torrent, session, file_manager: File, piece_picker: PiecePicker, choking_manager: TitForTat) -> None:
+async def tcp_wire_communication(peerData: Tuple, TorrentData: Torrent, session, file_manager: File, piece_picker: PiecePicker, choking_manager: TitForTat, upload_scheduler: UploadScheduler, on_connected: Callable[[], None] = None) -> None:
     """
     main function for communicating with a peer
     :param peerData: geodata of the peer
     :param TorrentData: torrent data instance
     :param session: DownloadingSession instance with session stats
-    :param file_manager: File instance managing disk IO operations
-    :param piece_picker: PiecePicker instance for requesting and reporting blocks
-    :param choking_manager: tit-for-tat algorithm for choking management
+    :param file_manager: File instance managing disk IO operations | None until the metadata of a magnet link arrives
+    :param piece_picker: PiecePicker instance for requesting and reporting blocks | None until the metadata of a magnet link arrives
+    :param choking_manager: tit-for-tat algorithm for choking management | None until the metadata of a magnet link arrives
+    :param upload_scheduler: serves the requests of the peer | None until the metadata of a magnet link arrives
+    :param on_connected: called once the handshake succeeded
     :return: None
     """
     address, city, distance = peerData
+    pieces_num = len(TorrentData.piece_hashes) if TorrentData.piece_hashes is not None else None
     try:
-        reader, writer = await asyncio.wait_for(open_tcp_connection(address), timeout=3)
+        reader, writer = await open_connection(address, build_decoder(_SUPPORTED_MESSAGES, pieces_num))
         if (reader, writer) == (None, None):
             return
+        reader.set_torrent(TorrentData.info_hash)
 
         thisPeer = Peer(writer, TorrentData, address, city)
-        request_queue: List[Tuple[int, int, int]] = []
+        metadata = session.metadata
+        metadata_requests: Set[int] = set()  # metadata pieces requested from the peer
         try:
             # start with a handshake
-            peer_id = await asyncio.wait_for(handshake(TorrentData, reader, writer), timeout=10)
+            peer_id, extensions = await asyncio.wait_for(handshake(TorrentData, reader, writer), timeout=10)
             # validate the protocol
             assert peer_id
 
             thisPeer.add_peer_id(peer_id)
+            if on_connected is not None:
+                on_connected()
+
+            # extensions are used if both sides support them
+            thisPeer.supports_fast = bool(extensions & FAST_EXTENSION)
+            thisPeer.supports_extensions = bool(extensions & EXTENSION_PROTOCOL)
+            supported_messages = _SUPPORTED_MESSAGES
+            if thisPeer.supports_fast:
+                supported_messages += FAST_MESSAGES
+            if thisPeer.supports_extensions:
+                supported_messages += (EXTENDED,)
+                thisPeer.outbox.put(extended_handshake(_MAX_REQUESTS, metadata.is_complete and metadata.info.get(b'private') == 1, metadata.size if metadata.is_complete else None))
+            reader.decode = build_decoder(supported_messages, pieces_num, ignored=(SUGGEST_PIECE,))
+            if extensions & DHT_EXTENSION and (dht_port := get_dht_port()) is not None and not (metadata.is_complete and metadata.info.get(b'private') == 1):
+                thisPeer.outbox.put(Port.encode(dht_port))  # the peer can add my DHT node
+            pex: Union[PeerExchange, None] = None
+
+            def handle_extended(msg: Extended) -> None:
+                """
+                handles the messages of the extension protocol
+                """
+                nonlocal pex
+                if msg.ext_id == EXTENDED_HANDSHAKE:
+                    thisPeer.extensions, metadata_size, max_requests = parse_extended_handshake(msg.payload)
+                    if max_requests is not None:
+                        thisPeer.set_max_requests(max_requests)
+                    if b'ut_pex' in thisPeer.extensions and not (metadata.is_complete and metadata.info.get(b'private') == 1):
+                        pex = PeerExchange(thisPeer.extensions[b'ut_pex'])
+                    if metadata_size is not None and not metadata.set_size(metadata_size):
+                        thisPeer.extensions.pop(b'ut_metadata', None)  # not the metadata I look for
+
+                elif msg.ext_id == UT_PEX and pex is not None:
+                    session.connection_manager.add_exchanged_peers(pex.parse_message(msg.payload))
+
+                elif msg.ext_id == UT_METADATA:
+                    msg_type, piece, data = parse_metadata_message(msg.payload)
+                    if msg_type == METADATA_REQUEST:
+                        if (ext_id := thisPeer.extensions.get(b'ut_metadata')) is not None:
+                            if (piece_data := metadata.get_piece(piece)) is not None:
+                                thisPeer.outbox.put(metadata_message(ext_id, METADATA_DATA, piece, metadata.size, piece_data))
+                            else:
+                                thisPeer.outbox.put(metadata_message(ext_id, METADATA_REJECT, piece))
+                    elif piece in metadata_requests:  # an answer to my request
+                        metadata_requests.discard(piece)
+                        metadata.release(piece)
+                        if msg_type == METADATA_DATA and metadata.add_piece(piece, data, thisPeer.key):
+                            print('got metadata!')
+
+            def handle_port(msg: Port) -> None:
+                """
+                pings the DHT node of the peer, so it can join my routing table
+                """
+                if not (metadata.is_complete and metadata.info.get(b'private') == 1):
+                    add_node((address[0], msg.port))
+
+            def send_pex() -> None:
+                """
+                tells the peer about my other peers, at most once a minute
+                """
+                if pex is not None and pex.is_due():
+                    connected = session.connection_manager.connected_addresses()
+                    if (pex_msg := pex.build_message(address for address in connected if address != thisPeer.address)) is not None:
+                        thisPeer.outbox.put(pex_msg)
+
+            if piece_picker is not None:
+                file_status = piece_picker.shared_pieces()
+                if thisPeer.supports_fast and file_status.all(True):
+                    thisPeer.outbox.put(HaveAll.encode())
+                elif thisPeer.supports_fast and not file_status.any(True):
+                    thisPeer.outbox.put(HaveNone.encode())
+                else:
+                    thisPeer.outbox.put(Bitfield.encode(file_status))
+
+            else:
+                # a magnet link. the metadata is fetched first, and what the peer tells about its pieces is kept until
+                # the number of pieces is known. no bitfield is sent, I have nothing yet
+                peer_bitfield, peer_haves, peer_has_all, peer_interested = None, [], False, False
+
+                def keep_bitfield(msg: Bitfield) -> None:
+                    nonlocal peer_bitfield
+                    peer_bitfield = msg.bitfield
+
+                def keep_have_all(msg: HaveAll) -> None:
+                    nonlocal peer_has_all
+                    peer_has_all = True
+
+                def keep_interest(msg: Union[Interested, NotInterested]) -> None:
+                    nonlocal peer_interested
+                    peer_interested = msg.ID == INTERESTED
+
+                def set_choked(msg: Union[Choke, Unchoke]) -> None:
+                    thisPeer.is_choked = msg.ID == CHOKE
+
+                def reject_request(msg: Request) -> None:
+                    if thisPeer.supports_fast:
+                        thisPeer.outbox.put(RejectRequest.encode(msg.piece_index, msg.begin, msg.length))
+
+                def unexpected_block(msg: Union[Piece, RejectRequest]) -> None:
+                    print('got a block I did not request!')
+                    raise AssertionError
+
+                dispatch = build_dispatcher({
+                    EXTENDED: handle_extended,
+                    BITFIELD: keep_bitfield,
+                    HAVE: lambda msg: peer_haves.append(msg.piece_index),
+                    HAVE_ALL: keep_have_all,
+                    ALLOWED_FAST: lambda msg: thisPeer.allowed_fast.add(msg.piece_index),
+                    PORT: handle_port,
+                    CHOKE: set_choked,
+                    UNCHOKE: set_choked,
+                    INTERESTED: keep_interest,
+                    NOT_INTERESTED: keep_interest,
+                    REQUEST: reject_request,
+                    PIECE: unexpected_block,
+                    REJECT_REQUEST: unexpected_block,
+                })
+                async for msg in Stream(reader, thisPeer):
+                    await dispatch(msg)
+
+                    # request the metadata pieces, the least requested first
+                    if (ext_id := thisPeer.extensions.get(b'ut_metadata')) is not None:
+                        while (piece := metadata.pick_piece(thisPeer.key, metadata_requests)) is not None:
+                            metadata_requests.add(piece)
+                            thisPeer.outbox.put(metadata_message(ext_id, METADATA_REQUEST, piece))
+                    send_pex()
+
+                    if session.connection_manager.piece_picker is not None:
+                        break
+                else:
+                    raise EOFError  # the connection was closed
+
+                # the download started
+                for piece in metadata_requests:
+                    metadata.release(piece)
+                metadata_requests.clear()
+                file_manager = session.connection_manager.file_manager
+                piece_picker = session.connection_manager.piece_picker
+                choking_manager = session.connection_manager.choking_manager
+                upload_scheduler = session.connection_manager.upload_scheduler
+                pieces_num = len(TorrentData.piece_hashes)
+                reader.decode = build_decoder(supported_messages, pieces_num, ignored=(SUGGEST_PIECE,))
+
+                thisPeer.have_pieces = np.zeros(pieces_num, dtype=bool)
+                if peer_has_all:
+                    thisPeer.have_pieces[:] = True
+                elif peer_bitfield is not None:
+                    thisPeer.have_pieces |= Bitfield.trim(peer_bitfield, pieces_num)
+                for index in peer_haves:
+                    assert index < pieces_num
+                    thisPeer.have_pieces[index] = True
+                thisPeer.allowed_fast = {index for index in thisPeer.allowed_fast if index < pieces_num}
+                thisPeer.is_seed = bool(thisPeer.have_pieces.all())
+                async with asyncio.Lock():
+                    piece_picker.add_peer_bitfield(thisPeer.have_pieces)
+                if peer_interested:
+                    await choking_manager.report_interested(thisPeer)
+
+                # pieces I had before (a resumed download) can only be announced one by one now
+                for index in piece_picker.shared_pieces().findall('0b1'):
+                    thisPeer.outbox.put(Have.encode(index))
+                thisPeer.wake()  # the first requests are sent without waiting for a message
 
-            writer.write(Bitfield.encode(piece_picker.FILE_STATUS[session.TorrentData.info_hash]))
-            await writer.drain()
+            blocks_per_piece = ceil(TorrentData.info[b'piece length'] / BLOCK_SIZE)
 
             # send interested
             # I am always interested in the peer
-            writer.write(Interested.encode())
-            await writer.drain()
+            thisPeer.outbox.put(Interested.encode())
             print("\033[92m{}\033[00m".format(f'connected {repr(thisPeer)}'))
 
-            async for msg in Stream(reader, thisPeer, TorrentData):
-                if isinstance(msg, Choke):
-                    thisPeer.is_choked = True
-                    # send interested
-                    writer.write(Interested.encode())
-                    await writer.drain()
-                elif isinstance(msg, Unchoke):
-                    thisPeer.is_choked = False
-
-                # the peer is interested in what I have
-                elif isinstance(msg, Interested):
-                    await choking_manager.report_interested(thisPeer)
-                elif isinstance(msg, NotInterested):
-                    await choking_manager.report_uninterested(thisPeer)
+            async def handle_piece(msg: Piece) -> None:
+                # update statistics
+                thisPeer.uploaded += len(msg.data)
+
+                # check if I requested this block?
+                key = get_block_key(msg.piece_index, msg.begin, blocks_per_piece)
+                if (request := thisPeer.pipelined_requests.get(key)) is not None and request[0].is_equal(msg.piece_index, msg.begin, msg.length):
+                    block, requested_at = thisPeer.pipelined_requests.pop(key)
+                    thisPeer.update_latency(time.time() - requested_at)
+                # a block I cancelled can still arrive
+                elif (request := thisPeer.cancelled_requests.get(key)) is not None and request[0].is_equal(msg.piece_index, msg.begin, msg.length):
+                    block, _ = thisPeer.cancelled_requests.pop(key)
+                else:
+                    print('received wrong block!')
+                    raise AssertionError
 
-                elif isinstance(msg, Have):
-                    msg: Have
-                    assert not thisPeer.is_seed  # a seed will not send have msg. if a peer completes its bitfield don't consider him a seed.
+                # update pipeline size
+                thisPeer.is_snubbed = False
+                thisPeer.update_upload_rate(len(msg.data))
+
+                await piece_picker.report_block(block, (msg.data, thisPeer.address), thisPeer)
+
+            async def handle_have(msg: Have) -> None:
+                assert not thisPeer.is_seed  # a seed will not send have msg. if a peer completes its bitfield don't consider him a seed.
+                if not thisPeer.have_pieces[msg.piece_index]:
                     thisPeer.have_pieces[msg.piece_index] = True
-                    if all(thisPeer.have_pieces):
+                    if thisPeer.have_pieces.all():
                         thisPeer.is_seed = True
                         print('seed')
 
                     async with asyncio.Lock():
                         piece_picker.change_availability(msg.piece_index, 1)
+                    thisPeer.endgame_queue = None  # rebuilt with the new piece in endgame mode
 
-                elif isinstance(msg, Bitfield):
-                    msg: Bitfield
-                    if all(msg.bitfield):
-                        thisPeer.is_seed = True
-                        print('seed')
-                    else:
-                        print('not seed')
+            def handle_choke(msg: Choke) -> None:
+                thisPeer.is_choked = True
+                # send interested
+                thisPeer.outbox.put(Interested.encode())
 
-                    async with asyncio.Lock():
-                        for index in range(len(msg.bitfield)):
-                            if msg.bitfield[index] and not thisPeer.have_pieces[index]:
-                                piece_picker.change_availability(index, 1)
-
-                    thisPeer.have_pieces |= msg.bitfield
-
-                elif isinstance(msg, Request):
-                    if not thisPeer.am_choked:
-                        if piece_picker.FILE_STATUS[TorrentData.info_hash][msg.piece_index]:
-                            request_queue.append((msg.piece_index, msg.begin, msg.length))
-                            if len(request_queue) > _MAX_REQUESTS:
-                                # attempted dos detected
-                                print('banned ', thisPeer.address[0])
-                                db_utils.BannedPeersDB().insert_ip(thisPeer.address[0])
-                                raise AssertionError
-                        else:
-                            pass
-
-                elif isinstance(msg, Cancel):
-                    if (details := (msg.piece_index, msg.begin, msg.length)) in request_queue:
-                        request_queue.remove(details)
-                    else:
-                        pass
-
-                # TODO add port type
-
-                elif isinstance(msg, Piece):
-                    msg: Piece
-                    # update statistics
-                    thisPeer.uploaded += len(msg.data)
-
-                    # check if I requested this block?
-                    for block in thisPeer.pipelined_requests:
-                        if block.is_equal(msg.piece_index, msg.begin, msg.length):
-                            thisPeer.pipelined_requests.remove(block)
-                            break
-                    else:
-                        for block in thisPeer.endgame_request_msg_sent:
-                            if block.is_equal(msg.piece_index, msg.begin, msg.length):
-                                break
-                        else:
-                            print('received wrong block!')
-                            raise AssertionError
+            def handle_unchoke(msg: Unchoke) -> None:
+                thisPeer.is_choked = False
 
-                    # update pipeline size
-                    thisPeer.update_upload_rate(len(msg.data))
+            # the peer is interested in what I have
+            async def handle_interested(msg: Interested) -> None:
+                await choking_manager.report_interested(thisPeer)
 
-                    if thisPeer.is_in_endgame:
-                        if block in thisPeer.endgame_cancel_msg_sent:
-                            thisPeer.MAX_PIPELINE_SIZE -= 1
-                            thisPeer.MAX_ENDGAME_REQUESTS -= 1
-                        else:
-                            thisPeer.endgame_cancel_msg_sent.add(block)
+            async def handle_not_interested(msg: NotInterested) -> None:
+                await choking_manager.report_uninterested(thisPeer)
 
-                    await piece_picker.report_block(block, (msg.data, thisPeer.address))
+            async def handle_bitfield(msg: Bitfield) -> None:
+                if msg.bitfield.all():
+                    thisPeer.is_seed = True
+                    print('seed')
+                else:
+                    print('not seed')
 
-                # send requests
-                if not thisPeer.is_in_endgame:
-                    if len(thisPeer.pipelined_requests) < thisPeer.MAX_PIPELINE_SIZE / 2:  # save some cpu usage
-                        while not thisPeer.is_choked and len(thisPeer.pipelined_requests) < thisPeer.MAX_PIPELINE_SIZE:
-                            if isinstance((request := await piece_picker.get_block(thisPeer.have_pieces)), Block):
-                                writer.write(Request.encode(request.index, request.begin, request.length))
-                                await writer.drain()
-                                thisPeer.pipelined_requests.add(request)
+                async with asyncio.Lock():
+                    piece_picker.add_peer_bitfield(msg.bitfield & ~thisPeer.have_pieces)
+
+                thisPeer.have_pieces |= msg.bitfield
+                thisPeer.endgame_queue = None
+
+            def handle_request(msg: Request) -> None:
+                if not thisPeer.am_choked and piece_picker.is_shared(msg.piece_index):
+                    if upload_scheduler.add_request(thisPeer, (msg.piece_index, msg.begin, msg.length)) > _MAX_REQUESTS:
+                        # attempted dos detected
+                        print('banned ', thisPeer.address[0])
+                        db_utils.BannedPeersDB().insert_ip(thisPeer.address[0])
+                        raise AssertionError
+                elif thisPeer.supports_fast:
+                    thisPeer.outbox.put(RejectRequest.encode(msg.piece_index, msg.begin, msg.length))
+
+            def handle_cancel(msg: Cancel) -> None:
+                details = (msg.piece_index, msg.begin, msg.length)
+                if upload_scheduler.cancel_request(thisPeer, details) and thisPeer.supports_fast:  # a cancelled request is answered too
+                    thisPeer.outbox.put(RejectRequest.encode(*details))
+
+            # fast extension
+            def handle_reject(msg: RejectRequest) -> None:
+                key = get_block_key(msg.piece_index, msg.begin, blocks_per_piece)
+                if (request := thisPeer.pipelined_requests.get(key)) is not None and request[0].is_equal(msg.piece_index, msg.begin, msg.length):
+                    block, _ = thisPeer.pipelined_requests.pop(key)
+                    # the block can be requested from other peers right away
+                    piece_picker.deselect_block(block, thisPeer)
+                    piece_picker.wake_peers()
+                elif (request := thisPeer.cancelled_requests.get(key)) is not None and request[0].is_equal(msg.piece_index, msg.begin, msg.length):
+                    thisPeer.cancelled_requests.pop(key)
+                else:
+                    print('rejected a block I did not request!')
+                    raise AssertionError
 
-                                await asyncio.sleep(0.01)  # giving time for other connections to get pieces
+            def handle_allowed_fast(msg: AllowedFast) -> None:
+                if msg.piece_index < len(TorrentData.piece_hashes):
+                    thisPeer.allowed_fast.add(msg.piece_index)
+
+            async def handle_have_all(msg: HaveAll) -> None:
+                thisPeer.is_seed = True
+                print('seed')
+                async with asyncio.Lock():
+                    piece_picker.add_peer_bitfield(~thisPeer.have_pieces)
+                thisPeer.have_pieces[:] = True
+                thisPeer.endgame_queue = None
+
+            dispatch = build_dispatcher({
+                PIECE: handle_piece,
+                HAVE: handle_have,
+                CHOKE: handle_choke,
+                UNCHOKE: handle_unchoke,
+                INTERESTED: handle_interested,
+                NOT_INTERESTED: handle_not_interested,
+                BITFIELD: handle_bitfield,
+                REQUEST: handle_request,
+                CANCEL: handle_cancel,
+                REJECT_REQUEST: handle_reject,
+                ALLOWED_FAST: handle_allowed_fast,
+                HAVE_ALL: handle_have_all,
+                HAVE_NONE: lambda msg: print('not seed'),
+                EXTENDED: handle_extended,  # extension protocol
+                PORT: handle_port,  # DHT node of the peer
+            })
+            async for msg in Stream(reader, thisPeer):
+                await dispatch(msg)
+
+                send_pex()
+
+                # send requests, they are written together on the next loop iteration.
+                # fairness between peers is up to the piece picker (piece ownership and the open pieces cap)
+                if not piece_picker.is_in_endgame:
+                    if len(thisPeer.pipelined_requests) < thisPeer.MAX_PIPELINE_SIZE / 2:  # save some cpu usage
+                        while len(thisPeer.pipelined_requests) < thisPeer.MAX_PIPELINE_SIZE:
+                            if not thisPeer.is_choked:
+                                request = await piece_picker.get_block(thisPeer)
+                            elif thisPeer.allowed_fast:  # a choking peer still serves its allowed fast pieces
+                                request = await piece_picker.get_allowed_fast_block(thisPeer)
+                            else:
+                                break
+                            if isinstance(request, Block):
+                                thisPeer.outbox.put(Request.encode(request.index, request.begin, request.length))
+                                thisPeer.pipelined_requests[request.key] = (request, time.time())
                             else:
                                 break
 
                 else:
+                    thisPeer.is_in_endgame = True
                     while not thisPeer.is_choked and len(thisPeer.pipelined_requests) < thisPeer.MAX_PIPELINE_SIZE:
-                        seed(hash(thisPeer))
-                        # available_blocks = all blocks - blocks I already requested - blocks somebody else got - pipelined requests (from before endgame)
-                        available_blocks = thisPeer.endgame_blocks - thisPeer.endgame_request_msg_sent - piece_picker.endgame_received_blocks - thisPeer.pipelined_requests
-                        available_blocks = list(available_blocks)
-                        available_blocks.sort(key=lambda x: piece_picker.pieces_map[x.index].peer_count + random(), reverse=True)
-                        if not available_blocks:
+                        if not isinstance((request := piece_picker.get_endgame_block(thisPeer)), Block):
                             break
+                        thisPeer.pipelined_requests[request.key] = (request, time.time())
+                        thisPeer.outbox.put(Request.encode(request.index, request.begin, request.length))
 
-                        request = available_blocks.pop()
-                        thisPeer.endgame_request_msg_sent.add(request)
-
-                        thisPeer.pipelined_requests.add(request)
-                        writer.write(Request.encode(request.index, request.begin, request.length))
-                        await writer.drain()
-
-                        await asyncio.sleep(0.1)  # giving *more* time for other connections to get pieces
-
-                    # send cancels
-                    requested_not_canceled = thisPeer.endgame_request_msg_sent - thisPeer.endgame_cancel_msg_sent
-                    need_to_cancel = requested_not_canceled.intersection(piece_picker.endgame_received_blocks)
-                    for block in need_to_cancel:
-                        writer.write(Cancel.encode(block.index, block.begin, block.length))
-                        await writer.drain()
-                    thisPeer.endgame_cancel_msg_sent.update(need_to_cancel)
-
-                    # request more blocks and don't get stuck on specific blocks
-                    thisPeer.MAX_ENDGAME_REQUESTS += len(need_to_cancel)
-                    thisPeer.MAX_PIPELINE_SIZE += len(need_to_cancel)
-
-                # fulfill 50% of requests
-                for _ in range(0, len(request_queue), 2):
-                    # don't contribute more than the peer's contribution
-                    params = file_manager.get_piece(*request_queue.pop())
-                    writer.write(Piece.encode(*params))
-                    await writer.drain()
-                    # update statistics
-                    session.uploaded += len(params[2])
-                    thisPeer.downloaded += len(params[2])
-                    print('fulfilled request!')
+                # choking the peer discards its requests, a fast peer is told about each of them
+                if thisPeer.am_choked and (dropped := upload_scheduler.drop_requests(thisPeer)) and thisPeer.supports_fast:
+                    for details in dropped:
+                        thisPeer.outbox.put(RejectRequest.encode(*details))
 
                 '''
                 writer.write(b'\x00\x00\x00\x00')
@@ -297,7 +412,7 @@ async def tcp_wire_communication(peerData: Tuple, TorrentData: Torrent, session,
             print('bad peer! ', e)
             ...
 
-        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+        except (asyncio.CancelledError, asyncio.TimeoutError, EOFError, ConnectionError) as e:
             pass
 
         except Exception as e:  # general error
@@ -314,23 +429,29 @@ async def tcp_wire_communication(peerData: Tuple, TorrentData: Torrent, session,
             except:
                 pass
 
+            for piece in metadata_requests:
+                metadata.release(piece)
+            metadata.release_peer(thisPeer.key)
+
             if thisPeer in Peer.peer_instances[session.TorrentData.info_hash]:
                 Peer.peer_instances[session.TorrentData.info_hash].remove(thisPeer)
             else:
                 return
+            if piece_picker is None:  # the download did not start
+                return
 
+            upload_scheduler.drop_requests(thisPeer)
             await choking_manager.report_uninterested(thisPeer)
 
             # return requested blocks
-            for block in thisPeer.pipelined_requests:
-                piece_picker.deselect_block(block)
+            for block, _ in thisPeer.pipelined_requests.values():
+                piece_picker.deselect_block(block, thisPeer)
+            piece_picker.disown_pieces(thisPeer)
+            piece_picker.wake_peers()
 
             # change availability
-            if not thisPeer.is_in_endgame:
-                async with asyncio.Lock():
-                    for bit in thisPeer.have_pieces:
-                        if bit:
-                            piece_picker.change_availability(bit, -1)
+            async with asyncio.Lock():
+                piece_picker.remove_peer_bitfield(thisPeer.have_pieces)
 
             del thisPeer
 
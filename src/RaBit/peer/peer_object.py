@@ -1,9 +1,26 @@
 from ..app_data import db_utils
 from ..torrent.torrent_object import Torrent
+from ..bandwidth import RateEstimator
+from .message_types import Cancel
+from .outbox import Outbox
 
 import time
-from typing import Tuple, List, Set, Dict
-import bitstring
+from itertools import count
+from typing import Tuple, List, Dict, Set, Deque, Any
+import numpy as np
+
+# request timeouts, in seconds
+_DEFAULT_REQUEST_TIMEOUT = 15  # until the latency of the peer is known
+_MIN_REQUEST_TIMEOUT = 2
+_MAX_REQUEST_TIMEOUT = 30
+
+# request pipelining
+_INITIAL_PIPELINE_SIZE = 10  # requests of a new connection, the pipeline grows from there
+_MIN_PIPELINE_SIZE = 2
+_DEFAULT_MAX_REQUESTS = 250  # requests a peer accepts if it does not tell (reqq, BEP 10)
+_MAX_PIPELINE_SIZE = 500  # even if the peer accepts more
+_MIN_QUEUEING_TARGET = 0.05  # seconds of requests queued at the peer, enough to hide its disk reads
+_PIPELINE_GAIN = 2  # requests added for every block that arrives without queueing
 
 
 class Peer:
@@ -11,6 +28,7 @@ class Peer:
     object to store attributes of a peer and some stats
     """
     peer_instances: Dict[bytes, List] = dict()
+    __keys = count()
 
     def __init__(self, writer, TorrentData: Torrent, address: Tuple[str, int], geodata: Tuple[str, str, float, float]) -> None:
         """
@@ -21,10 +39,14 @@ class Peer:
         :return: None
         """
         self.writer = writer
+        self.outbox = Outbox(writer, db_utils.get_configuration('outbound_flush_threshold'))  # outgoing messages, written once per loop iteration
+        self.key = next(Peer.__keys)  # stable integer id, the peer's hash
 
         self.TorrentData = TorrentData
 
-        self.MAX_PIPELINE_SIZE = 10  # 10 is default
+        self.MAX_PIPELINE_SIZE = _INITIAL_PIPELINE_SIZE  # outstanding requests, smaller than the pipeline size in endgame or when snubbed
+        self.pipeline_size: float = _INITIAL_PIPELINE_SIZE
+        self.max_requests = _DEFAULT_MAX_REQUESTS
         self.MAX_ENDGAME_REQUESTS = 5
         self.address = address
 
@@ -33,20 +55,31 @@ class Peer:
         self.am_choked = True  # have I choked the peer?
         self.am_interested = False  # is the peer interested in what I offer?
 
-        self.have_pieces = bitstring.BitArray(bin='0' * len(self.TorrentData.piece_hashes))
+        self.have_pieces = np.zeros(len(self.TorrentData.piece_hashes) if self.TorrentData.piece_hashes is not None else 0, dtype=bool)  # sized once the metadata of a magnet link arrives
         self.is_seed = False
-        self.pipelined_requests: Set = set()
+        self.pipelined_requests: Dict[int, Tuple[Any, float]] = dict()  # block key -> (requested Block, time of request)
         self.control_msg_queue: List[bytes] = []
 
-        self.endgame_cancel_msg_sent: Set = set()  # blocks I already sent Cancel to
-        self.endgame_request_msg_sent: Set = set()  # blocks I requested
-        self.endgame_blocks: Set = set()  # blocks available to request
+        self.cancelled_requests: Dict[int, Tuple[Any, float]] = dict()  # block key -> (Block I sent Cancel to, time of cancel), it might still arrive
+        self.endgame_queue: Deque = None  # candidate blocks to request in endgame mode, built by the piece picker
         self.is_in_endgame = False
 
-        self.last_data_sent = time.time()
+        # fast extension (BEP 6)
+        self.supports_fast = False
+        self.allowed_fast: Set[int] = set()  # pieces I can request while choked
+
+        # extension protocol (BEP 10)
+        self.supports_extensions = False
+        self.extensions: Dict[bytes, int] = dict()  # extension name -> the peer's message id, from its extended handshake
 
-        self.download_rate = 0  # in KiB/s
-        self.upload_rate = 0  # in KiB/s
+        # latency of requests, smoothed like tcp's round trip time (rfc 6298)
+        self.latency: float = None
+        self.latency_variance: float = None
+        self.base_latency: float = None  # the lowest latency, a round trip without requests queued at the peer
+        self.is_snubbed = False  # a request from the peer timed out
+
+        self.uploading = RateEstimator()  # piece payload the peer uploads to me
+        self.downloading = RateEstimator()  # piece payload the peer downloads from me
         self.downloaded = 0  # in bytes
         self.uploaded = 0  # in bytes
 
@@ -65,34 +98,119 @@ class Peer:
         self.client = db_utils.get_client(peer_id)
         Peer.peer_instances[self.TorrentData.info_hash].append(self)
 
-    def update_upload_rate(self, len_bytes_sent: int) -> None:
+    def cancel_request(self, block: Any) -> None:
         """
-        calculate upload rate and adjust pipeline size
-        :param len_bytes_sent: size of data received
+        cancels a pipelined request immediately, because the block arrived from another peer
+        :param block: Block instance to cancel
+        :return: None
+        """
+        if self.pipelined_requests.pop(block.key, None) is not None:
+            self.cancelled_requests[block.key] = (block, time.time())
+            self.outbox.put(Cancel.encode(block.index, block.begin, block.length))
+            self.wake()
+
+    def wake(self) -> None:
+        """
+        wakes the handler of the connection, to flush queued messages or send new requests
         :return: None
         """
-        # TODO make real upload rate using a counter
-        # idk how but this function generates ridiculously incredible downloading on account of cpu usage
-        # and breaks when working with real download rate (not len)
-        rn = time.time()
-        if (dt := rn - self.last_data_sent) < 0.05:
+        self.writer.wake()
+
+    def update_latency(self, sample: float) -> None:
+        """
+        updates the expected latency of the peer with a new measurement, and sizes the pipeline with it.
+        the pipeline should cover the bandwidth-delay product of the peer, plus a short queue of requests at the peer.
+        the latency above the base latency is the time my requests waited in that queue, so the pipeline grows while
+        the queue is shorter than the target and shrinks while it is longer. the target is a round trip, so the
+        pipeline settles at twice the bandwidth-delay product, but at least _MIN_QUEUEING_TARGET
+        :param sample: time from a request until its block arrived, in seconds
+        :return: None
+        """
+        if self.latency is None:
+            self.latency = sample
+            self.latency_variance = sample / 2
+            self.base_latency = sample
+        else:
+            self.latency_variance = 0.75 * self.latency_variance + 0.25 * abs(self.latency - sample)
+            self.latency = 0.875 * self.latency + 0.125 * sample
+            self.base_latency = min(self.base_latency, sample)
+
+        target = max(self.base_latency, _MIN_QUEUEING_TARGET)
+        off_target = (target - (sample - self.base_latency)) / target
+        # a pipeline that was not filled does not grow, its latency says nothing about the queue
+        if off_target > 0 and len(self.pipelined_requests) + 1 < self.pipeline_size / 2:
             return
-        rate = (len_bytes_sent / 1024) / dt
+        # up to two requests more for every block, a new connection ramps up quickly, but the pipeline halves at most every round trip
+        change = _PIPELINE_GAIN * off_target if off_target > 0 else max(off_target, -0.5)
+        self.pipeline_size = min(max(self.pipeline_size + change, _MIN_PIPELINE_SIZE), self.max_requests)
+
+    def set_max_requests(self, max_requests: int) -> None:
+        """
+        caps the pipeline by the number of outstanding requests the peer accepts
+        :param max_requests: reqq of the peer's extended handshake
+        :return: None
+        """
+        self.max_requests = min(max_requests, _MAX_PIPELINE_SIZE)
+        self.pipeline_size = min(self.pipeline_size, self.max_requests)
+        self.MAX_PIPELINE_SIZE = min(self.MAX_PIPELINE_SIZE, self.max_requests)
+
+    @property
+    def request_timeout(self) -> float:
+        """
+        how long a request may stay unanswered before it is given to another peer
+        """
+        if self.latency is None:
+            return _DEFAULT_REQUEST_TIMEOUT
+        return min(max(self.latency + 4 * self.latency_variance, _MIN_REQUEST_TIMEOUT), _MAX_REQUEST_TIMEOUT)
+
+    def snub(self) -> None:
+        """
+        marks the peer as snubbed after a request timed out, and shrinks its pipeline to its minimum of
+        _MIN_PIPELINE_SIZE requests. the pipeline grows back from there once the peer sends data again
+        :return: None
+        """
+        if not self.is_snubbed:
+            print('snubbed ', repr(self))
+        self.is_snubbed = True
+        self.MAX_PIPELINE_SIZE = _MIN_PIPELINE_SIZE
+        self.pipeline_size = _MIN_PIPELINE_SIZE
+
+    @property
+    def upload_rate(self) -> float:
+        """
+        the rate the peer uploads pieces to me, in KiB/s
+        """
+        return self.uploading.rate / 1024
+
+    @property
+    def download_rate(self) -> float:
+        """
+        the rate the peer downloads pieces from me, in KiB/s
+        """
+        return self.downloading.rate / 1024
 
+    @property
+    def overhead_rate(self) -> Tuple[float, float]:
+        """
+        the protocol overhead of the connection in KiB/s, received and sent: every byte on the wire that is not piece payload
+        """
+        return (max(self.writer.received.rate / 1024 - self.upload_rate, 0.0),
+                max(self.writer.sent.rate / 1024 - self.download_rate, 0.0))
+
+    def update_upload_rate(self, len_bytes_sent: int) -> None:
+        """
+        counts a block the peer sent me and applies the pipeline size
+        :param len_bytes_sent: size of data received
+        :return: None
+        """
+        self.uploading.add(len_bytes_sent)
         if self.is_in_endgame:
-            self.MAX_PIPELINE_SIZE = min(rate + 2, self.MAX_ENDGAME_REQUESTS)
+            self.MAX_PIPELINE_SIZE = min(self.pipeline_size, self.MAX_ENDGAME_REQUESTS)
         else:
-            # update pipeline size using rtorrent algorithm
-            if rate < 20:
-                self.MAX_PIPELINE_SIZE = rate + 2
-            else:
-                self.MAX_PIPELINE_SIZE = rate / 5 + 18
-
-        self.last_data_sent = rn
-        self.upload_rate = rate
+            self.MAX_PIPELINE_SIZE = self.pipeline_size
 
     def __repr__(self):
         return f"peer id: {self.peer_id}, address: {self.address}, geodata: {self.geodata}"
 
     def __hash__(self):
-        return hash(repr(self))
+        return self.key
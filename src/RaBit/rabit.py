@@ -2,7 +2,10 @@ from .app_data.db_utils import *
 from .seeding.server import start_seeding_server, add_completed_torrent
 from .seeding.utils import FileObjects
 from .download.download_session_object import DownloadSession
+from .dht import start_dht_node
+from .lsd import start_local_discovery
 from .file.file_object import PickleableFile
+from .bandwidth import load_rate_limits, set_global_rates, set_torrent_rates, remove_torrent_rates, set_peer_rates
 
 # view helper, not part of module
 from .view_helper import raise_error
@@ -41,6 +44,12 @@ class Client(_Singleton):
         if self.started:
             return False
         try:
+            load_rate_limits()
+
+            # the DHT node joins the network meanwhile, lookups wait for it
+            if get_configuration('dht_enabled'):
+                threading.Thread(target=lambda: asyncio.run(start_dht_node()), daemon=True).start()
+
             seeding_thread = threading.Thread(target=lambda: asyncio.run(start_seeding_server()), daemon=True)
             seeding_thread.start()
 
@@ -53,6 +62,10 @@ class Client(_Singleton):
                     break
                 time.sleep(0.25)
 
+            # LAN peers connect to the seeding server
+            if get_configuration('lsd_enabled'):
+                threading.Thread(target=lambda: asyncio.run(start_local_discovery()), daemon=True).start()
+
             # add torrents for seeding
             completed_torrents = CompletedTorrentsDB().get_all_torrents()
             for torrent in completed_torrents:
@@ -63,8 +76,8 @@ class Client(_Singleton):
             # start unfinished torrents
             ongoing_torrents = get_ongoing_torrents()
             self.torrents: Set[Union[DownloadSession, PickleableFile]] = set()
-            for torrent, path in ongoing_torrents:
-                session = DownloadSession(torrent, path, False)
+            for torrent, path, *file_priorities in ongoing_torrents:
+                session = DownloadSession(torrent, path, False, file_priorities=file_priorities[0] if file_priorities else None)
                 self.torrents.add(session)
                 download_thread = threading.Thread(target=lambda: asyncio.run(session.download()), daemon=True)
                 time.sleep(0.05)
@@ -80,10 +93,10 @@ class Client(_Singleton):
         self.started = True
         return True
 
-    def add_torrent(self, torrent_path: str, download_dir: str, skip_hash_check: bool) -> threading.Thread:
+    def add_torrent(self, torrent_path: str, download_dir: str, skip_hash_check: bool, streaming_window: int = 0, file_priorities: List[int] = None) -> threading.Thread:
         if not self.started:
             return None
-        session = DownloadSession(torrent_path, download_dir, skip_hash_check)
+        session = DownloadSession(torrent_path, download_dir, skip_hash_check, streaming_window, file_priorities)
         self.torrents.add(session)
         download_thread = threading.Thread(target=lambda: asyncio.run(session.download()), daemon=True)
         time.sleep(0.05)
@@ -96,7 +109,9 @@ class Client(_Singleton):
         for torrent in self.torrents.copy():
             if torrent.info_hash == info_hash and hash(torrent) == obj_hash:
                 if isinstance(torrent, DownloadSession):
-                    # close all connections
+                    # stop connecting to new peers and close all connections
+                    if torrent.connection_manager is not None:
+                        torrent.connection_manager.stop()
                     for peer in torrent.peers:
                         try:
                             peer.found_dirty = True  # not really, just to terminate the connection
@@ -115,6 +130,7 @@ class Client(_Singleton):
                             pass
                     CompletedTorrentsDB().delete_torrent(torrent.info_hash)
                     FileObjects.pop(torrent.info_hash)
+                    remove_torrent_rates(torrent.info_hash)
 
                 # stop the announce task
                 if (task := torrent.announce_task) is not None:
@@ -153,6 +169,44 @@ class Client(_Singleton):
     async def set_configuration(config: str, new_value: Any):
         await set_configuration(config, new_value)
 
+    @staticmethod
+    async def set_rate_limits(upload: int, download: int) -> None:
+        """
+        limits the traffic of the whole client, takes effect right away
+        :param upload: bytes per second, 0 for unlimited
+        :param download: bytes per second, 0 for unlimited
+        :return: None
+        """
+        set_global_rates(upload, download)
+        await set_configuration('max_upload_rate', upload)
+        await set_configuration('max_download_rate', download)
+
+    @staticmethod
+    async def set_torrent_rate_limits(upload: int, download: int, info_hash: bytes = None) -> None:
+        """
+        limits the traffic of a torrent, takes effect right away
+        :param upload: bytes per second, 0 for unlimited
+        :param download: bytes per second, 0 for unlimited
+        :param info_hash: the torrent, until the client restarts or the torrent is removed | None for the default of every torrent
+        :return: None
+        """
+        set_torrent_rates(upload, download, info_hash)
+        if info_hash is None:
+            await set_configuration('max_torrent_upload_rate', upload)
+            await set_configuration('max_torrent_download_rate', download)
+
+    @staticmethod
+    async def set_peer_rate_limits(upload: int, download: int) -> None:
+        """
+        limits the traffic of every peer connection, takes effect right away
+        :param upload: bytes per second, 0 for unlimited
+        :param download: bytes per second, 0 for unlimited
+        :return: None
+        """
+        set_peer_rates(upload, download)
+        await set_configuration('max_peer_upload_rate', upload)
+        await set_configuration('max_peer_download_rate', download)
+
     @staticmethod
     def get_banned_countries() -> List[str]:
         return get_banned_countries()
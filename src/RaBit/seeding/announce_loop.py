@@ -1,23 +1,32 @@
 from ..app_data import db_utils
 from ..file.file_object import PickleableFile
 from ..tracker.tracker_object import Tracker, WORKING
+from ..dht import announce, get_dht_port
 from .utils import FileObjects
 
 from typing import List
 import time
 import asyncio
 
+_DHT_ANNOUNCE_INTERVAL = 15 * 60  # the DHT forgets peers that were not announced for 30 minutes
+
 
 async def announce_loop(trackers: List[Tracker], session) -> None:
     """
-    a loop for an info hash: re-announces for each tracker interval with relevant stats
+    a loop for an info hash: re-announces for each tracker interval with relevant stats.
+    a seeded torrent is also announced in the DHT, unless it is private
     :param trackers: a list of Tracker instances
     :param session: DownloadingSession or PickleableFile instance with stats
     :return: None
     """
+    last_dht_announce = 0
     while True:
         if session.info_hash not in FileObjects:
             return
+        if isinstance(session, PickleableFile) and not getattr(session, 'is_private', False) and get_dht_port() is not None:
+            if time.time() - last_dht_announce >= _DHT_ANNOUNCE_INTERVAL:
+                last_dht_announce = time.time()
+                asyncio.create_task(announce(session.info_hash, db_utils.get_configuration('v4_forward')['external_port']))
         new_trackers = list(filter(lambda x: x.state == WORKING, trackers))
         new_trackers.sort(key=lambda x: x.last_announce + x.interval, reverse=False)
         for tracker in new_trackers:
@@ -2,6 +2,8 @@ from ..app_data import db_utils
 from ..file.file_object import PickleableFile
 from ..seeding.utils import FileObjects
 from ..geoip.utils import get_info
+from ..peer.message_types import FAST_EXTENSION
+from ..bandwidth import remove_torrent_rates
 
 from typing import Tuple, Union
 import struct
@@ -38,53 +40,54 @@ def __build__handshake_packet(info_hash: bytes, peer_id: bytes) -> bytes:
     data = struct.pack(string_format,
                        19,  # len of protocol name
                        b'BitTorrent protocol',  # protocol name
-                       0,  # reserve 8 bytes for extensions, none will be used
+                       FAST_EXTENSION,  # reserved 8 bytes, bits of the supported extensions
                        info_hash,  # info hash of info dictionary
                        peer_id)  # my id for this download
 
     return data
 
 
-def __get_handshake_data(data: bytes) -> Union[Tuple[bytes, bytes], Tuple[None, None]]:
+def __get_handshake_data(data: bytes) -> Union[Tuple[bytes, bytes, int], Tuple[None, None, None]]:
     """
     gets info hash and peer id from the incoming handshake packet
     :param data: raw packet bytes
-    :return: info hash, peer id | None, None if packet is invalid
+    :return: info hash, peer id, reserved bits of the peer's extensions | None, None, None if packet is invalid
     """
     string_format = '>20sQ20s20s'
     len_n_protocol, extensions, info_hash, peer_id = struct.unpack(string_format, data)
     if len_n_protocol == b'\x13BitTorrent protocol':
-        return info_hash, peer_id
+        return info_hash, peer_id, extensions
     else:
-        return None, None
+        return None, None, None
 
 
-async def handshake(reader, writer) -> Union[Tuple[bytes, bytes], Tuple[None, None]]:
+async def handshake(reader, writer) -> Union[Tuple[bytes, bytes, int], Tuple[None, None, None]]:
     """
     performs the exchange of handshakes
     if the requested info hash is in the completed torrents' db, accept the connection and send handshake
     :param reader: asyncio reader instance
     :param writer: asyncio writer instance
-    :return: info hash, peer id | None, None
+    :return: info hash, peer id, reserved bits of the peer's extensions | None, None, None
     """
-    data = await reader.read(68)  # len of handshake
-    info_hash, peer_id = __get_handshake_data(data)
+    data = await reader.readexactly(68)  # len of handshake
+    info_hash, peer_id, extensions = __get_handshake_data(data)
     # validate the protocol
     if not info_hash:
-        return None, None
+        return None, None, None
 
     # check if I have this torrent
     file_object: PickleableFile = db_utils.CompletedTorrentsDB().get_torrent(info_hash)
     if not file_object:
-        return None, None
+        return None, None, None
 
     # check if all files exist
     for path in file_object.file_names:
         if not os.path.exists(path):
             db_utils.CompletedTorrentsDB().delete_torrent(info_hash)
             FileObjects.pop(info_hash)
+            remove_torrent_rates(info_hash)
             print('files not found!')
-            return None, None
+            return None, None, None
 
     # send handshake
     handshake_packet = __build__handshake_packet(info_hash, file_object.peer_id)
@@ -92,5 +95,5 @@ async def handshake(reader, writer) -> Union[Tuple[bytes, bytes], Tuple[None, No
     writer.write(handshake_packet)
     await writer.drain()
 
-    return info_hash, peer_id
+    return info_hash, peer_id, extensions
 
@@ -1,7 +1,7 @@
 from ..app_data import db_utils
+from ..bandwidth import RateEstimator
 
-import time
-from typing import Tuple, List
+from typing import Tuple, List, Set
 
 
 class Leecher:
@@ -31,31 +31,31 @@ class Leecher:
 
         self.pipelined_requests: List[Tuple[int, int, int]] = []
 
-        self.last_data_sent = time.time()
+        self.supports_fast = False  # fast extension (BEP 6)
+        self.allowed_fast: Set[int] = set()  # pieces served even while the peer is choked
 
-        self.download_rate = 0  # in KiB/s
+        self.downloading = RateEstimator()  # piece payload the peer downloads from me
         self.downloaded = 0  # in bytes
-        self.download_counter = 0
 
         self.geodata = geodata
         self.peer_id = peer_id
         self.client = db_utils.get_client(peer_id)
 
+    @property
+    def download_rate(self) -> float:
+        """
+        the rate the peer downloads pieces from me, in KiB/s
+        """
+        return self.downloading.rate / 1024
+
     def update_download_rate(self, len_bytes_sent: int) -> None:
         """
-        updates the downloading rate of a peer
-        :param len_bytes_sent: length of data received
+        counts a block sent to the peer
+        :param len_bytes_sent: length of data sent
         :return: None
         """
-        self.download_counter += len_bytes_sent
-        rn = time.time()
-        if (dt := rn - self.last_data_sent) < 0.05:
-            return
-        rate = (self.download_counter / 1024) / dt
-
-        self.last_data_sent = rn
-        self.download_rate = rate
-        self.download_counter = 0
+        self.downloaded += len_bytes_sent
+        self.downloading.add(len_bytes_sent)
 
     def __repr__(self):
         return f"peer id: {self.peer_id}, address: {self.address}, geodata: {self.geodata}"
@@ -1,7 +1,9 @@
 from ..peer.message_types import *
+from ..peer.connection import PeerConnection
 from ..seeding.leecher_object import Leecher
 from ..seeding.handshake import handshake, validate_peer_ip
 from ..tracker import WORKING
+from ..utp import start_utp_server
 from .utils import *
 from .announce_loop import announce_loop
 
@@ -16,89 +18,34 @@ import time
 import threading
 
 
-_BUFFER_SIZE = 4096
 _MAX_REQUESTS = 500
 _LEASE_DURATION = 600  # 10 minutes
 _MAX_LEECHER_PEERS = db_utils.get_configuration('max_leecher_peers')
+# a seeder only answers requests, the state of the leecher is ignored
+_DECODER = build_decoder((INTERESTED, NOT_INTERESTED, REQUEST, CANCEL), ignored=(CHOKE, UNCHOKE, HAVE, BITFIELD, PORT, EXTENDED))
+_FAST_DECODER = build_decoder((INTERESTED, NOT_INTERESTED, REQUEST, CANCEL), ignored=(CHOKE, UNCHOKE, HAVE, BITFIELD, PORT, EXTENDED) + FAST_MESSAGES)
 
 
 class Stream:
-    def __init__(self, reader):
-        self.reader = reader
-        self.buffer = b''
-
-    def __consume(self, msg_length):
-        self.buffer = self.buffer[msg_length:]
+    def __init__(self, connection: PeerConnection):
+        self.connection = connection
 
     def __aiter__(self):
         return self
 
     async def __anext__(self) -> Any:
         """
-        reads and formats requests and other messages from an incoming peer
-        :return: msg instance corresponding to the type
+        waits for the next message from an incoming peer
+        :return: msg instance corresponding to the type | None if the connection was idle
         """
-        while True:
-            data = b''
-
-            async def get_data():
-                nonlocal data
-                data = await self.reader.read(_BUFFER_SIZE)
-
-            insufficient = False
-            if len(self.buffer) >= 4:
-                length = struct.unpack('>I', self.buffer[0:4])[0] + 4
-                if length == 4:  # keepalive
-                    self.__consume(4)
-                    continue
-
-                # defend overflow
-                if length > MAX_ALLOWED_MSG_SIZE:
-                    raise AssertionError
-
-                if len(self.buffer) < length:
-                    insufficient = True
-
-                else:
-                    msg = self.buffer[:length]
-                    msg_id = msg[4]
-
-            if insufficient or len(self.buffer) < 4:
-                try:
-                    await asyncio.wait_for(get_data(), 0.5)
-                except asyncio.TimeoutError:
-                    return None
-
-                self.buffer += data
-                if not self.buffer:
-                    raise StopAsyncIteration
-                continue
-
-            self.__consume(length)
-
-            if msg_id == INTERESTED:
-                return Interested()
-            elif msg_id == NOT_INTERESTED:
-                return NotInterested()
-
-            elif msg_id == REQUEST:
-                return Request.decode(msg)
-            elif msg_id == CANCEL:
-                return Cancel.decode(msg)
-
-            elif msg_id in [CHOKE, UNCHOKE, HAVE, BITFIELD]:
-                continue
-
-            else:
-                # unsupported message
-                raise AssertionError
+        return await self.connection.receive()
 
 
 async def handle_leecher(reader, writer) -> None:
     """
     main function for incoming connection handling
-    :param reader: asyncio reader instance
-    :param writer: asyncio writer instance
+    :param reader: PeerConnection of the leecher
+    :param writer: the same PeerConnection, it is also the writer
     :return: None
     """
     leecher = None
@@ -120,8 +67,12 @@ async def handle_leecher(reader, writer) -> None:
                 raise ConnectionRefusedError
 
         # handshake
-        info_hash, peer_id = await handshake(reader, writer)
+        info_hash, peer_id, extensions = await handshake(reader, writer)
         assert info_hash
+        reader.set_torrent(info_hash)
+        supports_fast = bool(extensions & FAST_EXTENSION)
+        if supports_fast:
+            reader.decode = _FAST_DECODER
 
         file_object = copy.deepcopy(FileObjects[info_hash])
         file_object.reopen_files()
@@ -138,40 +89,54 @@ async def handle_leecher(reader, writer) -> None:
             await writer.drain()
 
         leecher = Leecher(writer, peer_address, geodata, peer_id, ip_priority)
+        if supports_fast:
+            # let the leecher start downloading before it is unchoked
+            leecher.supports_fast = True
+            leecher.allowed_fast = allowed_fast_set(peer_address[0], info_hash, file_object.num_pieces)
+            writer.write(b''.join(AllowedFast.encode(index) for index in leecher.allowed_fast))
+            await writer.drain()
         FileObjects[file_object.info_hash].peers.append(leecher)
         normalize = lambda value, max_value, new_min, new_max: (value / max_value) * (new_max - new_min) + new_min
         last_seen = time.time()
-        async for msg in Stream(reader):
-            received = True
 
-            if isinstance(msg, Interested):
-                leecher.am_interested = True
-                leecher.am_choked = False
-                writer.write(Unchoke.encode())
-                await writer.drain()
-            elif isinstance(msg, NotInterested):
-                leecher.am_interested = False
-                leecher.am_choked = True
-                writer.write(Choke.encode())
+        async def handle_request(msg: Request) -> None:
+            if not leecher.am_choked or msg.piece_index in leecher.allowed_fast:
+                leecher.pipelined_requests.append((msg.piece_index, msg.begin, msg.length))
+                if len(leecher.pipelined_requests) > _MAX_REQUESTS:
+                    # attempted dos detected
+                    db_utils.BannedPeersDB().insert_ip(leecher.address[0])
+                    raise AssertionError
+            elif leecher.supports_fast:
+                writer.write(RejectRequest.encode(msg.piece_index, msg.begin, msg.length))
                 await writer.drain()
 
-            elif isinstance(msg, Request):
-                if not leecher.am_choked:
-                    leecher.pipelined_requests.append((msg.piece_index, msg.begin, msg.length))
-                    if len(leecher.pipelined_requests) > _MAX_REQUESTS:
-                        # attempted dos detected
-                        db_utils.BannedPeersDB().insert_ip(leecher.address[0])
-                        raise AssertionError
+        async def handle_cancel(msg: Cancel) -> None:
+            if (details := (msg.piece_index, msg.begin, msg.length)) in leecher.pipelined_requests:
+                leecher.pipelined_requests.remove(details)
+                if leecher.supports_fast:  # a cancelled request is answered too
+                    writer.write(RejectRequest.encode(*details))
+                    await writer.drain()
+
+        async def handle_interested(msg: Interested) -> None:
+            leecher.am_interested = True
+            leecher.am_choked = False
+            writer.write(Unchoke.encode())
+            await writer.drain()
 
-            elif isinstance(msg, Cancel):
-                if (details := (msg.piece_index, msg.begin, msg.length)) in leecher.pipelined_requests:
-                    leecher.pipelined_requests.remove(details)
-                else:
-                    pass
+        async def handle_not_interested(msg: NotInterested) -> None:
+            leecher.am_interested = False
+            leecher.am_choked = True
+            # requests of pieces that are not allowed fast are dropped
+            rejected = [details for details in leecher.pipelined_requests if details[0] not in leecher.allowed_fast]
+            leecher.pipelined_requests = [details for details in leecher.pipelined_requests if details[0] in leecher.allowed_fast]
+            writer.write(Choke.encode())
+            if leecher.supports_fast:
+                writer.write(b''.join(RejectRequest.encode(*details) for details in rejected))
+            await writer.drain()
 
-            else:
-                received = False
-            if received:
+        dispatch = build_dispatcher({REQUEST: handle_request, CANCEL: handle_cancel, INTERESTED: handle_interested, NOT_INTERESTED: handle_not_interested})
+        async for msg in Stream(reader):
+            if await dispatch(msg):
                 last_seen = time.time()
 
             # fulfill 50% of request
@@ -181,8 +146,7 @@ async def handle_leecher(reader, writer) -> None:
                 await writer.drain()
                 # update statistics
                 last_seen = time.time()
-                FileObjects[file_object.info_hash].uploaded += len(piece_params[2])
-                leecher.downloaded += len(piece_params[2])
+                FileObjects[file_object.info_hash].add_uploaded(len(piece_params[2]))
                 leecher.update_download_rate(len(piece_params[2]))
 
                 # introduce more delay as peer is more and more demanding
@@ -226,10 +190,11 @@ async def start_seeding_server() -> None:
         assert internal_ipv4
 
         async def forward_port(internal_ip: str, internal_port, external_port, last_forward, version: str) -> Tuple[asyncio.base_events.Server, float]:
+            loop = asyncio.get_running_loop()
             try:
-                server = await asyncio.start_server(handle_leecher, internal_ip, internal_port)
+                server = await loop.create_server(lambda: PeerConnection(_DECODER, handle_leecher), internal_ip, internal_port)
             except:  # the port is occupied
-                server = await asyncio.start_server(handle_leecher, internal_ip, 0)
+                server = await loop.create_server(lambda: PeerConnection(_DECODER, handle_leecher), internal_ip, 0)
                 internal_port = server.sockets[0].getsockname()[1]
                 # forward a new port
                 last_forward = 0
@@ -250,6 +215,7 @@ async def start_seeding_server() -> None:
                         continue
 
                     if res:
+                        await forward_utp_port(devices, new_external_port, internal_port, internal_ip)
                         await save_forward(internal_port, new_external_port, version)
                         last_forward = time.time()
                         if new_external_port != external_port:
@@ -273,6 +239,12 @@ async def start_seeding_server() -> None:
             internal_port_v4 = -1
 
         server_v4, last_forward_v4 = await forward_port(internal_ipv4, internal_port_v4, external_port_v4, last_forward_v4, 'v4')
+        if db_utils.get_configuration('utp_enabled'):
+            # uTP (BEP 29) connections come to the same port over udp
+            try:
+                await start_utp_server(lambda: PeerConnection(_DECODER, handle_leecher), internal_ipv4, server_v4.sockets[0].getsockname()[1])
+            except OSError as e:
+                print(f'seeding without uTP: {e}')
         await db_utils.set_configuration('seeding_server_is_up', True)
 
         # run server and updates thread
@@ -290,6 +262,23 @@ async def start_seeding_server() -> None:
         return
 
 
+async def forward_utp_port(devices, external_port: int, internal_port: int, internal_ip: str) -> None:
+    """
+    forwards the udp port of uTP connections along with the tcp port of the seeding server.
+    without it the peers outside the NAT connect over tcp
+    :param devices: devices responded to ssdp discovery
+    :param external_port: the external tcp port
+    :param internal_port: the internal tcp port
+    :param internal_ip: nat ip of the machine
+    :return: None
+    """
+    if db_utils.get_configuration('utp_enabled'):
+        try:
+            await forward_port_upnp(devices, external_port, internal_port, 'UDP', internal_ip, _LEASE_DURATION)
+        except:  # conflict found
+            pass
+
+
 async def add_completed_torrent(pickleable_file: PickleableFile) -> None:
     """
     adds a newly downloaded torrent available for seeding
@@ -337,6 +326,7 @@ async def update_mapping(internal_port: int, external_port: int, internal_ip: st
                 continue
 
             if res:
+                await forward_utp_port(devices, new_external_port, internal_port, internal_ip)
                 await save_forward(internal_port, new_external_port, version)
                 last_forward = time.time()
                 if new_external_port != external_port:
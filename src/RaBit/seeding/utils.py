@@ -2,7 +2,8 @@ from ..app_data import db_utils
 from ..file.file_object import PickleableFile
 
 import socket
-from typing import Union, Tuple, Dict
+import hashlib
+from typing import Union, Tuple, Dict, Set
 import time
 import crc32c
 
@@ -134,6 +135,29 @@ def crc32c_sort_v4(peer_ip: str) -> int:
     return priority
 
 
+def allowed_fast_set(peer_ip: str, info_hash: bytes, num_pieces: int, k: int = 10) -> Set[int]:
+    """
+    generates the canonical allowed fast set of a peer as specified in BEP 6.
+    the set depends only on the peer's /24 network, so reconnecting does not grant other pieces
+    :param peer_ip: ipv4 address of the peer
+    :param info_hash: info hash of the torrent
+    :param num_pieces: number of pieces in the torrent
+    :param k: size of the set
+    :return: piece indexes the peer can request while choked
+    """
+    allowed_fast = set()
+    k = min(k, num_pieces)
+    x = (socket.inet_aton(peer_ip)[:3] + b'\x00') + info_hash
+    while len(allowed_fast) < k:
+        x = hashlib.sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(allowed_fast) == k:
+                break
+            allowed_fast.add(int.from_bytes(x[i:i + 4], 'big') % num_pieces)
+
+    return allowed_fast
+
+
 def re_announce_all_trackers():
     """
     if a port mapping has changed re-announce with the new external port
@@ -2,8 +2,11 @@ from .torrent_object import Torrent
 
 import bencodepy
 from hashlib import sha1
+from urllib.parse import urlsplit, parse_qs
+import base64
 import random
 import string
+from typing import Union
 
 
 def read_torrent(path: str) -> Torrent:
@@ -19,11 +22,11 @@ def read_torrent(path: str) -> Torrent:
         content = bencodepy.decode(content)
 
     # create a Torrent instance
-    # need to add support for distributed torrents and magnet links, non multi-file torrents and no announcers
-    torrent_data = Torrent(info=content[b'info'],
+    # need to add support for distributed torrents, non multi-file torrents and no announcers
+    torrent_data = Torrent(info=None,
                                  info_hash=None,
                                  piece_hashes=None,
-                                 multi_file=bool(content[b'info'].get(b'files')),
+                                 multi_file=False,
                                  peer_id=None,
                                  announce=content.get(b'announce'),
                                  comment=content.get(b'comment').decode('utf-8') if content.get(b'comment') else '',
@@ -31,22 +34,71 @@ def read_torrent(path: str) -> Torrent:
                                  date_created=content.get(b'date created').decode('utf-8') if content.get(b'date created') else '',
                                  announce_list=content.get(b'announce-list'))
 
+    # set info_hash, piece_hashes and peer_id:
+    # hashes are in sha1, 20 bytes long
+    torrent_data.info_hash = sha1(bencodepy.encode(content[b'info'])).digest()
+    set_info(torrent_data, content[b'info'])
+    torrent_data.peer_id = __generate_peer_id()
+
+    return torrent_data
+
+
+def read_magnet(uri: str) -> Torrent:
+    """
+    function to read a magnet link into a TorrentData object without the info dict, which is fetched from peers later
+    :param uri: magnet:?xt=urn:btih:<info hash>&dn=<name>&tr=<tracker>...
+    :return: Torrent instance with the info hash and the trackers of the link
+    """
+    params = parse_qs(urlsplit(uri).query)
+    info_hash = None
+    for topic in params.get('xt', []):
+        if topic.lower().startswith('urn:btih:'):
+            info_hash = topic[9:]
+    if info_hash is None:
+        raise ValueError('not a bittorrent magnet link')
+    # 40 hex characters or 32 base32 characters
+    info_hash = bytes.fromhex(info_hash) if len(info_hash) == 40 else base64.b32decode(info_hash.upper())
+    if len(info_hash) != 20:
+        raise ValueError('invalid info hash')
+
+    trackers = [url.encode() for url in dict.fromkeys(params.get('tr', []))]
+    torrent_data = Torrent(info=None,
+                           info_hash=info_hash,
+                           piece_hashes=None,
+                           multi_file=False,
+                           peer_id=__generate_peer_id(),
+                           announce=trackers[0] if trackers else None,
+                           announce_list=[[url] for url in trackers])
+    return torrent_data
+
+
+def get_magnet_name(uri: str) -> Union[str, None]:
+    """
+    :param uri: magnet link
+    :return: the display name of the magnet link | None if it has none
+    """
+    names = parse_qs(urlsplit(uri).query).get('dn')
+    return names[0] if names else None
+
+
+def set_info(torrent_data: Torrent, info: dict) -> None:
+    """
+    fills a TorrentData object with the data of its info dict
+    :param torrent_data: Torrent instance, its info hash is already known
+    :param info: the decoded info dict
+    :return: None
+    """
+    torrent_data.info = info
+    torrent_data.multi_file = bool(info.get(b'files'))
     if torrent_data.multi_file:
-        for file in torrent_data.info[b'files']:
-            torrent_data.length += file[b'length']
+        torrent_data.length = sum(file[b'length'] for file in info[b'files'])
     else:
-        torrent_data.length = content[b'info'].get(b'length')
+        torrent_data.length = info.get(b'length')
 
-    # set info_hash, piece_hashes and peer_id:
-    # hashes are in sha1, 20 bytes long
-    pieces = torrent_data.info[b'pieces']
+    pieces = info[b'pieces']
     torrent_data.piece_hashes = [pieces[i: i + 20] for i in range(0, len(pieces), 20)]
 
-    data = bencodepy.encode(torrent_data.info)
-    sha1_hash = sha1(data).digest()
-    torrent_data.info_hash = sha1_hash
 
+def __generate_peer_id() -> bytes:
     # Azureus - style peer id encoding : 8 bytes. rest is random 8 alphanumeric bytes
-    torrent_data.peer_id = b'-RB1000-EPIC' + ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(8)).encode()
-
-    return torrent_data
+    return b'-RB1000-EPIC' + ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(8)).encode()
@@ -1,7 +1,7 @@
 from .initial_announce import initial_announce
 from .tracker_object import Tracker, ANNOUNCING, WORKING, UNREACHABLE, NONE
-from .utils import format_peers_list
+from .utils import format_peers_list, is_lan_address
 
 __all__ = ['initial_announce',
            'Tracker', 'ANNOUNCING', 'WORKING', 'UNREACHABLE', 'NONE',
-           'format_peers_list']
+           'format_peers_list', 'is_lan_address']
@@ -22,7 +22,7 @@ async def initial_announce(TorrentData: Torrent, downloaded: int, uploaded: int,
     """
     # initial announce
     if not TorrentData.announce_list:
-        TorrentData.announce_list = [[TorrentData.announce]]
+        TorrentData.announce_list = [[TorrentData.announce]] if TorrentData.announce else []  # a magnet link can have no trackers
 
     peers_list: List[Tuple[str, int]] = []
     tracker_list: List[Tracker] = []
@@ -4,6 +4,7 @@ from .udp_tracker import udp_tracker_announce
 
 import math
 import time
+from typing import List, Tuple
 
 
 UNREACHABLE = 0
@@ -32,13 +33,14 @@ class Tracker:
         self.client_peer_id = peer_id
         self.state = NONE
 
-    async def re_announce(self, download: int, uploaded: int, left: int, event: int = 0):
+    async def re_announce(self, download: int, uploaded: int, left: int, event: int = 0) -> List[Tuple[str, int]]:
         """
         announces the tracker with given stats and an event
         :param download: in bytes
         :param uploaded: in bytes
         :param left: in bytes
         :param event: 0: none; 1: completed; 2: started; 3: stopped
+        :return: peer addresses (ip, port) returned by the tracker | [] if the announce failed
         """
         self.state = ANNOUNCING
         port = db_utils.get_configuration('v4_forward')['external_port']
@@ -53,12 +55,14 @@ class Tracker:
             if not isinstance(response, str):
                 self.state = WORKING
                 self.interval = response[1]
+                return response[0]
             else:
                 raise
 
         except:
             self.state = UNREACHABLE
             self.interval = math.inf
+            return []
         finally:
             self.last_announce = time.time()
 
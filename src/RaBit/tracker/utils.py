@@ -3,10 +3,23 @@ from ..geoip.utils import calc_distance, get_info
 
 import struct
 import socket
+import ipaddress
 from typing import Tuple, List
 from math import inf as INF
 
 
+def is_lan_address(ip: str) -> bool:
+    """
+    :param ip: ip address of a peer
+    :return: whether the peer is on my LAN
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return (address.is_private or address.is_link_local) and not address.is_loopback
+
+
 def format_peers_list(peers: List[Tuple[str, int]], my_ip: str) -> List[Tuple[Tuple[str, int], None, None]]:
     """
     formats the peers' list received from the trackers
@@ -30,8 +43,8 @@ def format_peers_list(peers: List[Tuple[str, int]], my_ip: str) -> List[Tuple[Tu
     # remove peers with distance 0 (could be me)
     filtered_peers = list(filter(lambda x: x[2] > 0 if x[2] is not None else True, peers))
 
-    # sort by distance
-    sorted_peers = sorted(filtered_peers, key=lambda x: x[2] if x[2] is not None else INF)
+    # sort by distance, LAN peers first
+    sorted_peers = sorted(filtered_peers, key=lambda x: (not is_lan_address(x[0][0]), x[2] if x[2] is not None else INF))
 
     # new peer structure: [0]: address. [1]: city, country, latitude, longitude. [2]: distance from me
     return sorted_peers
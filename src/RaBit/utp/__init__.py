@@ -0,0 +1,5 @@
+from .socket import UTPSocket, open_utp_connection, start_utp_server
+from .connection import UTPConnection, PACKET_SIZE
+from .ledbat import Ledbat, TARGET_DELAY
+
+__all__ = ['UTPSocket', 'open_utp_connection', 'start_utp_server', 'UTPConnection', 'PACKET_SIZE', 'Ledbat', 'TARGET_DELAY']
@@ -0,0 +1,546 @@
+from .packet import *
+from .ledbat import Ledbat
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Tuple, Dict, Union
+
+PACKET_SIZE = 1400  # max payload, a packet with its ip, udp and uTP headers fits in a 1500 bytes MTU
+_RECEIVE_WINDOW = 2 ** 20  # bytes received but not passed to the protocol yet
+_MAX_IN_FLIGHT = 4096  # packets, the sequence numbers of a window must not wrap around
+_HIGH_WATER = 2 ** 16  # unsent bytes above which the protocol is asked to pause writing
+_LOW_WATER = 2 ** 14
+_INITIAL_TIMEOUT = 1
+_MIN_TIMEOUT = 0.5
+_MAX_TIMEOUT = 8
+_MAX_TIMEOUTS = 5  # retransmission timeouts in a row before the connection is dead
+_DUPLICATE_ACKS = 3  # packets that arrived after a missing packet before it is resent (fast retransmit)
+_DELAYED_ACK = 0.005  # seconds an ack may wait for a second data packet to acknowledge together
+
+# states of a connection
+_SYN_SENT = 0
+_CONNECTED = 1
+_FIN_WAIT = 2  # my FIN was acknowledged, the FIN of the peer is acknowledged before the connection is removed
+_CLOSED = 3
+
+
+def micros() -> int:
+    """
+    :return: the time in microseconds, for the timestamps of packets
+    """
+    return time.monotonic_ns() // 1000
+
+
+@dataclass(slots=True)
+class _Packet:
+    """
+    a sent packet waiting to be acknowledged
+    """
+    seq_nr: int
+    packet_type: int
+    payload: bytes
+    size: int  # with the header, counted in the window
+    sent_at: float = 0.0
+    transmissions: int = 0
+    need_resend: bool = False
+
+
+class UTPConnection(asyncio.Transport):
+    """
+    a uTP connection (BEP 29), a reliable byte stream over the udp socket of a UTPSocket.
+    it is a transport for an asyncio protocol like the transports of tcp connections, so the peer wire code runs
+    over it unchanged. data is cut into packets that are sent as the LEDBAT congestion window and the window
+    of the receiver allow. packets are acknowledged cumulatively and selectively (selective acks), a packet is resent
+    when later packets arrived without it (fast retransmit) or when nothing was acknowledged for a timeout.
+    received packets are put back in order and passed to the protocol, reading can be paused like on tcp
+    """
+    def __init__(self, socket, address: Tuple[str, int], recv_id: int, send_id: int, seq_nr: int, protocol: asyncio.BaseProtocol) -> None:
+        """
+        :param socket: the UTPSocket of the connection
+        :param address: (ip, port) of the peer
+        :param recv_id: connection id of the packets I receive
+        :param send_id: connection id of the packets I send
+        :param seq_nr: my first sequence number
+        :param protocol: the protocol the connection serves
+        :return: None
+        """
+        super().__init__({'peername': address, 'sockname': socket.sockname})
+        self.socket = socket
+        self.address = address
+        self.recv_id = recv_id
+        self.send_id = send_id
+        self.protocol = protocol
+        self.state = _SYN_SENT
+        self.is_made = False  # connection_made() was called
+        self.connected: Union[asyncio.Future, None] = None  # the waiter of an outgoing connection
+
+        # sending
+        self.seq_nr = seq_nr  # of the next packet
+        self.congestion = Ledbat(PACKET_SIZE)
+        self.in_flight: Dict[int, _Packet] = dict()  # sent and not acknowledged, in the order of sequence numbers
+        self.flight_size = 0  # bytes in flight, without packets that wait to be resent
+        self.resends = 0  # packets that wait to be resent
+        self.send_buffer = bytearray()  # bytearray deletes from the front without moving the rest
+        self.peer_window = _RECEIVE_WINDOW  # bytes the peer can receive, as it advertised
+        self.loss_seq_nr = (seq_nr - 1) & SEQ_MASK  # the window is halved once for the losses of a window
+        self.last_ack_nr = None
+        self.duplicate_acks = 0
+        self.last_acked_sent_at = 0.0  # send time of the latest sent packet that was acknowledged
+        self.writing_paused = False
+        self.fin_seq_nr = None  # my FIN
+
+        # round trip time, by the estimation of tcp
+        self.rtt = 0.0
+        self.rtt_var = 0.0
+        self.timeout = _INITIAL_TIMEOUT
+        self.timeout_at = 0.0  # no packets in flight
+        self.timeouts = 0
+
+        # receiving
+        self.ack_nr = 0  # last sequence number received in order
+        self.reply_micro = 0  # the one way delay of the last packet I received, sent back in every packet
+        self.out_of_order: Dict[int, bytes] = dict()
+        self.out_of_order_size = 0
+        self.undelivered = bytearray()  # received in order while reading is paused
+        self.reading_paused = False
+        self.unacked = 0  # data packets received since my last ack
+        self.ack_timer: Union[asyncio.TimerHandle, None] = None
+        self.eof_seq_nr = None  # FIN of the peer
+        self.is_eof = False
+        self.closing = False
+
+    # connection setup
+
+    async def connect(self) -> None:
+        """
+        opens an outgoing connection with a SYN
+        :return: None
+        """
+        self.connected = asyncio.get_running_loop().create_future()
+        self.__send_packet(ST_SYN, b'')
+        await self.connected
+
+    def accept(self, seq_nr: int) -> None:
+        """
+        accepts an incoming connection, the SYN is acknowledged and the protocol starts
+        :param seq_nr: sequence number of the SYN
+        :return: None
+        """
+        self.state = _CONNECTED
+        self.ack_nr = seq_nr
+        self.send_ack()
+        self.is_made = True
+        self.protocol.connection_made(self)
+
+    # packets
+
+    def __transmit(self, packet: _Packet) -> None:
+        now = time.monotonic()
+        packet.sent_at = now
+        packet.transmissions += 1
+        if not self.timeout_at:
+            self.timeout_at = now + self.timeout
+        # every packet acknowledges what I received
+        self.unacked = 0
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        # a SYN carries the id I receive with, the peer sends with it
+        connection_id = self.recv_id if packet.packet_type == ST_SYN else self.send_id
+        self.socket.send(encode_packet(packet.packet_type, connection_id, micros(), self.reply_micro, self.__receive_window(),
+                                       packet.seq_nr, self.ack_nr, self.__selective_ack(), packet.payload), self.address)
+
+    def __send_packet(self, packet_type: int, payload: bytes) -> None:
+        packet = _Packet(self.seq_nr, packet_type, payload, len(payload) + HEADER_SIZE)
+        self.in_flight[packet.seq_nr] = packet
+        self.flight_size += packet.size
+        self.seq_nr = (self.seq_nr + 1) & SEQ_MASK
+        self.__transmit(packet)
+
+    def send_ack(self) -> None:
+        """
+        sends an ST_STATE packet, its sequence number is not used up
+        :return: None
+        """
+        self.unacked = 0
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        if self.state != _CLOSED:
+            self.socket.send(encode_packet(ST_STATE, self.send_id, micros(), self.reply_micro, self.__receive_window(),
+                                           self.seq_nr, self.ack_nr, self.__selective_ack()), self.address)
+
+    def __receive_window(self) -> int:
+        return max(_RECEIVE_WINDOW - len(self.undelivered) - self.out_of_order_size, 0)
+
+    def __selective_ack(self) -> Union[bytes, None]:
+        return encode_sack(self.ack_nr, self.out_of_order) if self.out_of_order else None
+
+    def packet_received(self, packet_type: int, timestamp: int, timestamp_difference: int, window: int,
+                        seq_nr: int, ack_nr: int, sack: Union[bytes, None], payload: memoryview) -> None:
+        """
+        handles a packet of the connection
+        :param packet_type: type of the packet
+        :param timestamp: send time of the packet, by the clock of the peer
+        :param timestamp_difference: the one way delay of my last packet the peer received
+        :param window: bytes the peer can receive
+        :param seq_nr: sequence number of the packet
+        :param ack_nr: last sequence number the peer received in order
+        :param sack: selective ack bitmask | None
+        :param payload: data of the packet
+        :return: None
+        """
+        if self.state == _CLOSED:
+            return
+        if packet_type == ST_RESET:
+            self.__destroy(ConnectionResetError('Connection reset by peer'))
+            return
+        if timestamp:
+            self.reply_micro = (micros() - timestamp) & 0xFFFFFFFF
+        self.peer_window = window
+
+        if self.state == _SYN_SENT:
+            if packet_type != ST_STATE:
+                return
+            # the ST_STATE of the SYN carries the first sequence number of the peer, not used up yet
+            self.state = _CONNECTED
+            self.ack_nr = (seq_nr - 1) & SEQ_MASK
+            self.__acknowledge(ack_nr, sack, timestamp_difference, False)
+            self.is_made = True
+            self.protocol.connection_made(self)
+            self.connected.set_result(None)
+            return
+        if self.state == _FIN_WAIT:
+            if packet_type in (ST_DATA, ST_FIN):
+                self.__receive(packet_type, seq_nr, payload)
+            return
+
+        self.__acknowledge(ack_nr, sack, timestamp_difference, packet_type == ST_STATE)
+        if self.state == _CLOSED:
+            return
+        if packet_type in (ST_DATA, ST_FIN):
+            self.__receive(packet_type, seq_nr, payload)
+        self.__flush()
+
+    # sending
+
+    def __acknowledge(self, ack_nr: int, sack: Union[bytes, None], delay: int, is_state: bool) -> None:
+        """
+        removes the acknowledged packets from the packets in flight, updates the window and resends lost packets
+        :param ack_nr: last sequence number the peer received in order
+        :param sack: selective ack bitmask | None
+        :param delay: the one way delay of my packets the peer measured
+        :param is_state: whether it is an ST_STATE packet, a duplicate ack counts towards a fast retransmit
+        :return: None
+        """
+        flight_size = self.flight_size
+        acked = 0
+        now = time.monotonic()
+        while self.in_flight:
+            seq_nr = next(iter(self.in_flight))
+            if seq_after(seq_nr, ack_nr):
+                break
+            acked += self.__remove_packet(seq_nr, now)
+
+        first_missing = (ack_nr + 1) & SEQ_MASK
+        if sack:
+            received_after = 0
+            for seq_nr in decode_sack(ack_nr, sack):
+                received_after += 1
+                if seq_nr in self.in_flight:
+                    acked += self.__remove_packet(seq_nr, now)
+            # a resent packet is lost again if packets sent after it arrived
+            if received_after >= _DUPLICATE_ACKS and (packet := self.in_flight.get(first_missing)) is not None \
+                    and packet.sent_at < self.last_acked_sent_at:
+                self.__lost(packet)
+        elif is_state and acked == 0 and ack_nr == self.last_ack_nr and self.in_flight:
+            self.duplicate_acks += 1
+            if self.duplicate_acks == _DUPLICATE_ACKS and (packet := self.in_flight.get(first_missing)) is not None \
+                    and packet.transmissions == 1:
+                self.__lost(packet)
+        if acked:
+            self.duplicate_acks = 0
+        self.last_ack_nr = ack_nr
+
+        if self.fin_seq_nr is not None and self.fin_seq_nr not in self.in_flight:
+            # the peer got all my data and my FIN
+            if self.is_eof:
+                self.__destroy(None)
+            else:
+                self.__fin_wait()
+            return
+        if acked:
+            self.timeouts = 0
+            self.timeout_at = now + self.timeout if self.in_flight else 0.0
+            if delay:
+                self.congestion.on_ack(acked, delay, flight_size)
+
+    def __remove_packet(self, seq_nr: int, now: float) -> int:
+        """
+        :return: bytes of the acknowledged packet
+        """
+        packet = self.in_flight.pop(seq_nr)
+        if packet.need_resend:
+            self.resends -= 1
+        else:
+            self.flight_size -= packet.size
+        if packet.transmissions == 1:  # the round trip of a resent packet is ambiguous
+            self.__update_rtt(now - packet.sent_at)
+        self.last_acked_sent_at = max(self.last_acked_sent_at, packet.sent_at)
+        return packet.size
+
+    def __update_rtt(self, rtt: float) -> None:
+        if self.rtt == 0:
+            self.rtt, self.rtt_var = rtt, rtt / 2
+        else:
+            self.rtt_var += (abs(self.rtt - rtt) - self.rtt_var) / 4
+            self.rtt += (rtt - self.rtt) / 8
+        self.timeout = max(self.rtt + 4 * self.rtt_var, _MIN_TIMEOUT)
+
+    def __lost(self, packet: _Packet) -> None:
+        """
+        a packet was lost, it is resent as soon as the window allows
+        :param packet: the packet
+        :return: None
+        """
+        if packet.need_resend:
+            return
+        packet.need_resend = True
+        self.resends += 1
+        self.flight_size -= packet.size
+        if seq_after(packet.seq_nr, self.loss_seq_nr):
+            self.congestion.on_loss()
+            self.loss_seq_nr = (self.seq_nr - 1) & SEQ_MASK
+
+    def check_timeout(self, now: float) -> None:
+        """
+        called by the socket periodically. if nothing was acknowledged for a timeout all the packets in flight are
+        resent, and the connection is dead after a few timeouts in a row
+        :param now: monotonic time
+        :return: None
+        """
+        if not self.timeout_at or now < self.timeout_at or self.state == _CLOSED:
+            return
+        if self.state == _FIN_WAIT:  # the peer did not close its side
+            self.__destroy(None)
+            return
+        self.timeouts += 1
+        if self.timeouts > _MAX_TIMEOUTS:
+            self.__destroy(TimeoutError('uTP connection timed out'))
+            return
+        self.congestion.on_timeout()
+        self.timeout = min(self.timeout * 2, _MAX_TIMEOUT)
+        self.timeout_at = now + self.timeout
+        for packet in self.in_flight.values():
+            if packet.transmissions and not packet.need_resend:
+                packet.need_resend = True
+                self.resends += 1
+                self.flight_size -= packet.size
+        self.loss_seq_nr = (self.seq_nr - 1) & SEQ_MASK
+        if self.state == _SYN_SENT:
+            syn = self.in_flight[(self.seq_nr - 1) & SEQ_MASK]
+            syn.need_resend = False
+            self.resends -= 1
+            self.__transmit(syn)
+        self.__flush()
+
+    def __flush(self) -> None:
+        """
+        sends what the window allows: packets to resend first, then new data, then my FIN once all data was sent
+        """
+        if self.state != _CONNECTED:
+            return
+        window = min(self.congestion.window, self.peer_window)
+        if self.resends:
+            for packet in self.in_flight.values():
+                if packet.need_resend:
+                    if self.flight_size and self.flight_size + packet.size > window:
+                        return
+                    packet.need_resend = False
+                    self.resends -= 1
+                    self.flight_size += packet.size
+                    self.__transmit(packet)
+
+        while self.send_buffer:
+            size = min(len(self.send_buffer), PACKET_SIZE)
+            # a packet is always sent with nothing in flight, it probes a zero window too
+            if self.flight_size and (self.flight_size + size + HEADER_SIZE > window or len(self.in_flight) >= _MAX_IN_FLIGHT):
+                break
+            payload = bytes(self.send_buffer[:size])
+            del self.send_buffer[:size]
+            self.__send_packet(ST_DATA, payload)
+
+        if self.closing and not self.send_buffer and self.fin_seq_nr is None:
+            self.fin_seq_nr = self.seq_nr
+            self.__send_packet(ST_FIN, b'')
+        if self.writing_paused and len(self.send_buffer) <= _LOW_WATER:
+            self.writing_paused = False
+            self.protocol.resume_writing()
+
+    # receiving
+
+    def __receive(self, packet_type: int, seq_nr: int, payload: memoryview) -> None:
+        """
+        passes the data to the protocol in order, and acknowledges it
+        """
+        if packet_type == ST_FIN and self.eof_seq_nr is None:
+            self.eof_seq_nr = seq_nr
+        expected = (self.ack_nr + 1) & SEQ_MASK
+        if seq_nr == expected:
+            self.ack_nr = seq_nr
+            if payload:
+                self.__deliver(payload)
+            while (data := self.out_of_order.pop((self.ack_nr + 1) & SEQ_MASK, None)) is not None:
+                self.out_of_order_size -= len(data)
+                self.ack_nr = (self.ack_nr + 1) & SEQ_MASK
+                if data:
+                    self.__deliver(data)
+            if self.ack_nr == self.eof_seq_nr and not self.is_eof:
+                self.send_ack()
+                self.__eof()
+                return
+            self.unacked += 1
+            # the first packet after a gap is acknowledged right away, the sender waits for it
+            if self.out_of_order or self.unacked >= 2:
+                self.send_ack()
+            elif self.ack_timer is None:
+                self.ack_timer = asyncio.get_running_loop().call_later(_DELAYED_ACK, self.send_ack)
+        else:
+            if (seq_nr - expected) & SEQ_MASK < _MAX_IN_FLIGHT and seq_nr not in self.out_of_order:
+                self.out_of_order[seq_nr] = bytes(payload)
+                self.out_of_order_size += len(payload)
+            self.send_ack()  # a duplicate or a packet after a gap, the sender learns what is missing
+
+    def __deliver(self, data: Union[bytes, memoryview]) -> None:
+        """
+        passes received data to the protocol, or keeps it while reading is paused
+        """
+        if self.reading_paused or self.closing:
+            if not self.closing:
+                self.undelivered += data
+            return
+        if not isinstance(self.protocol, asyncio.BufferedProtocol):
+            self.protocol.data_received(bytes(data))
+            return
+        view = memoryview(data)
+        while view:
+            buffer = self.protocol.get_buffer(len(view))
+            size = min(len(buffer), len(view))
+            buffer[:size] = view[:size]
+            self.protocol.buffer_updated(size)
+            view = view[size:]
+            if self.reading_paused and view:  # the protocol paused reading in the middle
+                self.undelivered += view
+                return
+
+    def __eof(self) -> None:
+        self.is_eof = True
+        if self.state == _FIN_WAIT:
+            self.__destroy(None)
+        elif not self.protocol.eof_received():
+            self.close()
+
+    # closing
+
+    def __fin_wait(self) -> None:
+        """
+        my side is closed, the protocol loses the connection. it stays in the socket to acknowledge the FIN of the peer
+        """
+        self.state = _FIN_WAIT
+        self.in_flight.clear()
+        self.timeout_at = time.monotonic() + _MAX_TIMEOUT
+        if self.is_made:
+            self.is_made = False
+            asyncio.get_running_loop().call_soon(self.protocol.connection_lost, None)
+
+    def __destroy(self, exc: Union[Exception, None]) -> None:
+        """
+        closes the connection right away and tells the protocol
+        :param exc: the error that closed the connection | None
+        :return: None
+        """
+        if self.state == _CLOSED:
+            return
+        self.state = _CLOSED
+        self.closing = True
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        self.in_flight.clear()
+        self.send_buffer.clear()
+        self.socket.remove(self)
+        if self.connected is not None and not self.connected.done():
+            self.connected.set_exception(exc if exc is not None else ConnectionRefusedError('uTP connection refused'))
+        if self.is_made:
+            asyncio.get_running_loop().call_soon(self.protocol.connection_lost, exc)
+
+    # transport interface
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> None:
+        if self.closing or not data:
+            return
+        self.send_buffer += data
+        self.__flush()
+        if not self.writing_paused and len(self.send_buffer) > _HIGH_WATER:
+            self.writing_paused = True
+            self.protocol.pause_writing()
+
+    def writelines(self, list_of_data) -> None:
+        self.write(b''.join(list_of_data))
+
+    def can_write_eof(self) -> bool:
+        return False
+
+    def get_write_buffer_size(self) -> int:
+        return len(self.send_buffer)
+
+    def get_write_buffer_limits(self) -> Tuple[int, int]:
+        return _LOW_WATER, _HIGH_WATER
+
+    def close(self) -> None:
+        """
+        sends the unsent data and a FIN, the protocol loses the connection once the FIN is acknowledged
+        :return: None
+        """
+        if self.closing:
+            return
+        self.closing = True
+        self.undelivered.clear()
+        if self.state == _SYN_SENT:
+            self.__destroy(None)
+        else:
+            self.__flush()
+
+    def abort(self) -> None:
+        """
+        closes the connection right away with a reset
+        :return: None
+        """
+        if self.state == _CONNECTED:
+            self.socket.send(encode_packet(ST_RESET, self.send_id, micros(), self.reply_micro, 0, self.seq_nr, self.ack_nr), self.address)
+        self.__destroy(None)
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def pause_reading(self) -> None:
+        self.reading_paused = True
+
+    def resume_reading(self) -> None:
+        if not self.reading_paused:
+            return
+        self.reading_paused = False
+        data, self.undelivered = self.undelivered, bytearray()
+        if data:
+            self.__deliver(data)
+            self.send_ack()  # the window opened
+
+    def is_reading(self) -> bool:
+        return not self.reading_paused and not self.closing
+
+    def set_protocol(self, protocol: asyncio.BaseProtocol) -> None:
+        self.protocol = protocol
+
+    def get_protocol(self) -> asyncio.BaseProtocol:
+        return self.protocol
@@ -0,0 +1,88 @@
+import time
+from collections import deque
+from typing import Deque, Tuple
+
+TARGET_DELAY = 100000  # BEP 29, the queueing delay uTP aims for, in microseconds
+_GAIN = 1  # max window increase per round trip, in packets
+_BASE_DELAY_HISTORY = 2  # minutes, the base delay is the lowest delay of the last two minutes
+_MIN_WINDOW_PACKETS = 2
+_MAX_WINDOW = 2 ** 22
+
+
+class Ledbat:
+    """
+    LEDBAT congestion control (RFC 6817), the delay based congestion control of uTP.
+    the one way delay of my packets minus the lowest delay seen lately is the time they waited in queues.
+    below the target delay the window grows like tcp would, above it the window shrinks, so uTP only
+    takes the bandwidth other traffic leaves free and keeps the queues of the link short.
+    like libtorrent's uTP, a connection starts with a slow start that doubles the window every round trip,
+    until the first loss or until the queues start to fill
+    """
+    def __init__(self, packet_size: int) -> None:
+        """
+        :param packet_size: max payload of a packet
+        :return: None
+        """
+        self.packet_size = packet_size
+        self.min_window = _MIN_WINDOW_PACKETS * packet_size
+        self.window = float(self.min_window)  # congestion window, in bytes
+        # lowest delay of every minute, as (minute, delay), the delays are microseconds modulo 2^32
+        self.base_delays: Deque[Tuple[int, int]] = deque()
+        self.queueing_delay = 0  # of the last acknowledged packet, in microseconds
+        self.slow_start = True
+
+    def __base_delay(self, delay: int) -> int:
+        """
+        adds a delay sample to the history
+        :param delay: one way delay, includes the clock offset between the hosts
+        :return: the base delay
+        """
+        minute = int(time.monotonic() // 60)
+        if not self.base_delays or self.base_delays[-1][0] != minute:
+            self.base_delays.append((minute, delay))
+            while self.base_delays[0][0] <= minute - _BASE_DELAY_HISTORY:
+                self.base_delays.popleft()
+        elif (delay - self.base_delays[-1][1]) & 0xFFFFFFFF > 0x7FFFFFFF:  # a lower delay, modulo 2^32
+            self.base_delays[-1] = (minute, delay)
+        base_delay = self.base_delays[0][1]
+        for _, minimum in self.base_delays:
+            if (minimum - base_delay) & 0xFFFFFFFF > 0x7FFFFFFF:
+                base_delay = minimum
+        return base_delay
+
+    def on_ack(self, acked: int, delay: int, in_flight: int) -> None:
+        """
+        updates the window when packets were acknowledged
+        :param acked: acknowledged bytes
+        :param delay: the one way delay the receiver measured, from the timestamp difference of the ack
+        :param in_flight: bytes that were in flight before the ack
+        :return: None
+        """
+        self.queueing_delay = (delay - self.__base_delay(delay)) & 0xFFFFFFFF
+        off_target = (TARGET_DELAY - self.queueing_delay) / TARGET_DELAY
+        # a window that was not used does not grow, it says nothing about the link
+        if off_target > 0 and in_flight + acked < self.window / 2:
+            return
+        if self.slow_start and self.queueing_delay > TARGET_DELAY / 2:
+            self.slow_start = False
+        if self.slow_start:
+            self.window += acked
+        else:
+            self.window += _GAIN * off_target * acked * self.packet_size / self.window
+        self.window = min(max(self.window, self.min_window), _MAX_WINDOW)
+
+    def on_loss(self) -> None:
+        """
+        a packet was lost, the window is halved like tcp
+        :return: None
+        """
+        self.slow_start = False
+        self.window = max(self.window / 2, self.min_window)
+
+    def on_timeout(self) -> None:
+        """
+        nothing was acknowledged for a whole timeout, the window starts over
+        :return: None
+        """
+        self.slow_start = False
+        self.window = float(self.min_window)
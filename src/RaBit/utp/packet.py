@@ -0,0 +1,105 @@
+import struct
+from typing import Tuple, Iterable, Union
+
+# packet types (BEP 29)
+ST_DATA = 0
+ST_FIN = 1
+ST_STATE = 2
+ST_RESET = 3
+ST_SYN = 4
+
+_VERSION = 1
+_SELECTIVE_ACK = 1
+_HEADER = struct.Struct('>BBHIIIHH')  # type and version, extension, connection id, timestamp, timestamp difference, window, seq_nr, ack_nr
+HEADER_SIZE = _HEADER.size
+SEQ_MASK = 0xFFFF
+_SACK_BITS = 32  # packets a selective ack covers, in multiples of 32
+
+
+def seq_after(a: int, b: int) -> bool:
+    """
+    :return: whether sequence number a comes after b, sequence numbers wrap around
+    """
+    return 0 < (a - b) & SEQ_MASK < 0x8000
+
+
+def encode_packet(packet_type: int, connection_id: int, timestamp: int, timestamp_difference: int, window: int,
+                  seq_nr: int, ack_nr: int, sack: bytes = None, payload: Union[bytes, memoryview] = b'') -> bytes:
+    """
+    builds a uTP packet
+    :param packet_type: ST_DATA | ST_FIN | ST_STATE | ST_RESET | ST_SYN
+    :param connection_id: connection id of the receiver
+    :param timestamp: send time in microseconds
+    :param timestamp_difference: the one way delay of the last packet I received, in microseconds
+    :param window: bytes I can still receive
+    :param seq_nr: sequence number of the packet
+    :param ack_nr: last sequence number I received in order
+    :param sack: selective ack bitmask | None
+    :param payload: data of the packet
+    :return: the datagram
+    """
+    header = _HEADER.pack(packet_type << 4 | _VERSION, _SELECTIVE_ACK if sack else 0, connection_id,
+                          timestamp & 0xFFFFFFFF, timestamp_difference & 0xFFFFFFFF, min(window, 0xFFFFFFFF), seq_nr, ack_nr)
+    if sack:
+        header += bytes((0, len(sack))) + sack
+    return header + payload if payload else header
+
+
+def decode_packet(data: bytes) -> Union[Tuple[int, int, int, int, int, int, int, Union[bytes, None], memoryview], None]:
+    """
+    :param data: a datagram
+    :return: type, connection id, timestamp, timestamp difference, window, seq_nr, ack_nr, selective ack bitmask | None,
+     payload | None if it is not a uTP packet
+    """
+    if len(data) < HEADER_SIZE:
+        return None
+    type_version, extension, connection_id, timestamp, timestamp_difference, window, seq_nr, ack_nr = _HEADER.unpack_from(data)
+    if type_version & 0xF != _VERSION or type_version >> 4 > ST_SYN:
+        return None
+
+    # walk the extension chain, only the selective ack is understood
+    sack = None
+    offset = HEADER_SIZE
+    while extension:
+        if offset + 2 > len(data):
+            return None
+        next_extension, length = data[offset], data[offset + 1]
+        if offset + 2 + length > len(data):
+            return None
+        if extension == _SELECTIVE_ACK:
+            sack = data[offset + 2: offset + 2 + length]
+        extension = next_extension
+        offset += 2 + length
+    return type_version >> 4, connection_id, timestamp, timestamp_difference, window, seq_nr, ack_nr, sack, memoryview(data)[offset:]
+
+
+def encode_sack(ack_nr: int, received: Iterable[int]) -> Union[bytes, None]:
+    """
+    builds a selective ack bitmask. bit i stands for packet ack_nr + 2 + i, the least significant bit of every byte first
+    :param ack_nr: last sequence number received in order
+    :param received: sequence numbers received out of order
+    :return: the bitmask | None if nothing was received out of order
+    """
+    offsets = [(seq_nr - ack_nr - 2) & SEQ_MASK for seq_nr in received]
+    offsets = [offset for offset in offsets if offset < 0x8000]
+    if not offsets:
+        return None
+    size = min(max(offsets) // _SACK_BITS + 1, 8) * _SACK_BITS // 8
+    bitmask = bytearray(size)
+    for offset in offsets:
+        if offset < size * 8:
+            bitmask[offset // 8] |= 1 << (offset % 8)
+    return bytes(bitmask)
+
+
+def decode_sack(ack_nr: int, bitmask: bytes) -> Iterable[int]:
+    """
+    :param ack_nr: ack_nr of the packet
+    :param bitmask: its selective ack bitmask
+    :return: the sequence numbers the bitmask acknowledges
+    """
+    for index, byte in enumerate(bitmask):
+        while byte:
+            bit = (byte & -byte).bit_length() - 1
+            byte &= byte - 1
+            yield (ack_nr + 2 + index * 8 + bit) & SEQ_MASK
@@ -0,0 +1,183 @@
+from .packet import ST_SYN, ST_RESET, SEQ_MASK, encode_packet, decode_packet
+from .connection import UTPConnection, micros
+
+import asyncio
+import random
+import socket
+import time
+from typing import Tuple, Dict, Set, Callable, Union
+
+_TICK = 0.1  # seconds between retransmission timeout checks
+_SOCKET_BUFFER = 2 ** 21  # the windows of all the connections go through a single socket
+
+
+class UTPSocket(asyncio.DatagramProtocol):
+    """
+    a udp socket shared by uTP connections.
+    datagrams are passed to their connection by the address of the peer and the connection id (the connection
+    demultiplexer), and a SYN of an unknown connection opens an incoming connection if the socket accepts them.
+    a single timer checks the retransmission timeouts of all the connections.
+    a socket that only opens connections closes itself once it has none left
+    """
+    def __init__(self, protocol_factory: Callable[[], asyncio.BaseProtocol] = None) -> None:
+        """
+        :param protocol_factory: makes the protocol of an incoming connection | None to refuse incoming connections
+        :return: None
+        """
+        self.protocol_factory = protocol_factory
+        self.connections: Dict[Tuple[Tuple[str, int], int], UTPConnection] = dict()  # (address, receive connection id) -> connection
+        self.unreachable: Set[Tuple[str, int]] = set()  # peers that did not answer a SYN
+        self.transport: Union[asyncio.DatagramTransport, None] = None
+        self.sockname: Union[Tuple[str, int], None] = None
+        self.timer: Union[asyncio.TimerHandle, None] = None
+
+    async def start(self, host: str, port: int) -> None:
+        """
+        binds the socket
+        :param host: ip to listen on
+        :param port: udp port, 0 for any port
+        :return: None
+        """
+        await asyncio.get_running_loop().create_datagram_endpoint(lambda: self, local_addr=(host, port))
+
+    def close(self) -> None:
+        for connection in list(self.connections.values()):
+            connection.abort()
+        loop = asyncio.get_running_loop()
+        if (opening := _sockets.get(loop)) is not None and opening.done() and not opening.cancelled() and opening.result() is self:
+            del _sockets[loop]  # the next connection opens a new socket
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+        self.sockname = transport.get_extra_info('sockname')
+        sock = transport.get_extra_info('socket')
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, _SOCKET_BUFFER)
+            except OSError:
+                pass
+
+    def connection_lost(self, exc: Union[Exception, None]) -> None:
+        self.transport = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def error_received(self, exc: Exception) -> None:
+        pass
+
+    def send(self, data: bytes, address: Tuple[str, int]) -> None:
+        if self.transport is not None:
+            self.transport.sendto(data, address)
+
+    def datagram_received(self, data: bytes, address: Tuple[str, int]) -> None:
+        if (packet := decode_packet(data)) is None:
+            return
+        packet_type, connection_id, timestamp, timestamp_difference, window, seq_nr, ack_nr, sack, payload = packet
+
+        if (connection := self.connections.get((address, connection_id))) is not None:
+            connection.packet_received(packet_type, timestamp, timestamp_difference, window, seq_nr, ack_nr, sack, payload)
+        elif packet_type == ST_SYN:
+            if (connection := self.connections.get((address, (connection_id + 1) & SEQ_MASK))) is not None:
+                connection.send_ack()  # my ack of the SYN was lost
+            elif self.protocol_factory is not None:
+                self.__accept(address, connection_id, seq_nr)
+        elif packet_type != ST_RESET:
+            self.send(encode_packet(ST_RESET, connection_id, micros(), 0, 0, random.getrandbits(16), seq_nr), address)
+
+    def __accept(self, address: Tuple[str, int], connection_id: int, seq_nr: int) -> None:
+        """
+        opens an incoming connection
+        :param address: (ip, port) of the peer
+        :param connection_id: connection id of the SYN, the peer receives with it and sends with the next one
+        :param seq_nr: sequence number of the SYN
+        :return: None
+        """
+        connection = UTPConnection(self, address, (connection_id + 1) & SEQ_MASK, connection_id, random.getrandbits(16), self.protocol_factory())
+        self.__add(connection)
+        connection.accept(seq_nr)
+
+    async def connect(self, address: Tuple[str, int], protocol_factory: Callable[[], asyncio.BaseProtocol]) -> Tuple[UTPConnection, asyncio.BaseProtocol]:
+        """
+        opens an outgoing connection
+        :param address: (ip, port) of the peer
+        :param protocol_factory: makes the protocol of the connection
+        :return: the connection (transport) and its protocol
+        """
+        if self.transport is None:
+            raise ConnectionRefusedError('the uTP socket is closed')
+        if address in self.unreachable:
+            raise ConnectionRefusedError('the peer does not answer uTP')
+        recv_id = random.getrandbits(16)
+        while (address, recv_id) in self.connections or (address, (recv_id + 1) & SEQ_MASK) in self.connections:
+            recv_id = random.getrandbits(16)
+        protocol = protocol_factory()
+        connection = UTPConnection(self, address, recv_id, (recv_id + 1) & SEQ_MASK, 1, protocol)
+        self.__add(connection)
+        try:
+            await connection.connect()
+        except BaseException:  # refused, timed out or cancelled
+            self.unreachable.add(address)
+            connection.abort()
+            raise
+        return connection, protocol
+
+    def __add(self, connection: UTPConnection) -> None:
+        self.connections[(connection.address, connection.recv_id)] = connection
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(_TICK, self.__check_timeouts)
+
+    def remove(self, connection: UTPConnection) -> None:
+        self.connections.pop((connection.address, connection.recv_id), None)
+
+    def __check_timeouts(self) -> None:
+        now = time.monotonic()
+        for connection in list(self.connections.values()):
+            connection.check_timeout(now)
+        if self.connections:
+            self.timer = asyncio.get_running_loop().call_later(_TICK, self.__check_timeouts)
+        else:
+            self.timer = None
+            if self.protocol_factory is None:
+                self.close()
+
+
+# the socket of the outgoing connections of every event loop, opened by the first connection
+_sockets: Dict[asyncio.AbstractEventLoop, asyncio.Task] = dict()
+
+
+async def __open_socket() -> UTPSocket:
+    utp_socket = UTPSocket()
+    await utp_socket.start('0.0.0.0', 0)
+    return utp_socket
+
+
+async def open_utp_connection(address: Tuple[str, int], protocol_factory: Callable[[], asyncio.BaseProtocol]) -> Tuple[UTPConnection, asyncio.BaseProtocol]:
+    """
+    opens a uTP connection, like loop.create_connection() opens a tcp connection.
+    the connections of an event loop share a single udp socket
+    :param address: (ip, port) of the peer
+    :param protocol_factory: makes the protocol of the connection
+    :return: the connection (transport) and its protocol
+    """
+    loop = asyncio.get_running_loop()
+    if (opening := _sockets.get(loop)) is None or (opening.done() and (opening.cancelled() or opening.exception() is not None)):
+        opening = _sockets[loop] = loop.create_task(__open_socket())
+    # the first connection may be cancelled while the socket opens, the others still wait for it
+    return await (await asyncio.shield(opening)).connect(address, protocol_factory)
+
+
+async def start_utp_server(protocol_factory: Callable[[], asyncio.BaseProtocol], host: str, port: int) -> UTPSocket:
+    """
+    listens for incoming uTP connections, like loop.create_server() does for tcp
+    :param protocol_factory: makes the protocol of every incoming connection
+    :param host: ip to listen on
+    :param port: udp port
+    :return: the socket, close() stops it
+    """
+    utp_socket = UTPSocket(protocol_factory)
+    await utp_socket.start(host, port)
+    return utp_socket
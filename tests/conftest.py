@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the client is run from src/, where RaBit is a top-level package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
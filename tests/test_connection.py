@@ -0,0 +1,54 @@
+import asyncio
+
+from RaBit.peer.connection import PeerConnection
+from RaBit.peer.message_types import build_decoder, Piece, PIECE, BLOCK_SIZE
+
+
+class _Transport:
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+def _receive_data(connection: PeerConnection, data: bytes) -> None:
+    """
+    what the event loop does when data arrives
+    """
+    while data:
+        buffer = connection.get_buffer(len(data))
+        size = min(len(buffer), len(data))
+        buffer[:size] = data[:size]
+        connection.buffer_updated(size)
+        data = data[size:]
+
+
+def test_message_is_valid_until_the_next_receive():
+    async def main():
+        connection = PeerConnection(build_decoder((PIECE,), 1))
+        connection.connection_made(_Transport())
+        connection.is_framing = True
+
+        # fill the buffer up to its end, the consumer keeps the last block while it yields
+        capacity = len(connection.messages.buffer)
+        messages = [Piece.encode(0, 0, bytes([index]) * BLOCK_SIZE) for index in range(capacity // (BLOCK_SIZE + 13))]
+        _receive_data(connection, b''.join(messages))
+        while len(connection.inbox) > 1:
+            await connection.receive()
+        msg = await connection.receive()
+        held = bytes(msg.data)
+
+        # a large read arrives while the consumer still handles the message
+        _receive_data(connection, b''.join([Piece.encode(0, 0, b'\xff' * BLOCK_SIZE)] * (capacity // (BLOCK_SIZE + 13))))
+        assert bytes(msg.data) == held
+
+        # once the consumer is done with it, the buffer is reused
+        assert (await connection.receive()).data[0] == 0xff
+    asyncio.run(main())
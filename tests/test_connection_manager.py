@@ -0,0 +1,44 @@
+import asyncio
+
+import bitstring
+
+from RaBit.torrent.torrent_object import Torrent
+from RaBit.download.connection_manager import ConnectionManager
+from RaBit.download.piece_picker import PiecePicker
+from RaBit.peer.message_types import Have
+from RaBit.peer.peer_object import Peer
+
+_PIECE_LENGTH = 2 ** 16
+
+
+class _Writer:
+    def wake(self):
+        pass
+
+
+class _Session:
+    pass
+
+
+def test_metadata_peers_get_haves():
+    # a magnet link: the peers connect before the number of pieces is known
+    torrent = Torrent(info=None, info_hash=b'm' * 20, piece_hashes=None, multi_file=False, peer_id=b'i' * 20, length=None)
+    Peer.peer_instances[torrent.info_hash] = []
+    try:
+        peer = Peer(_Writer(), torrent, ('127.0.0.1', 6881), None)
+        Peer.peer_instances[torrent.info_hash].append(peer)
+        assert len(peer.have_pieces) == 0
+        connection_manager = ConnectionManager(torrent, _Session(), None, None, None, None, [], '127.0.0.1')
+
+        # the metadata arrived, the peer is still in the metadata phase of its connection
+        torrent.info = {b'piece length': _PIECE_LENGTH}
+        torrent.piece_hashes = [b''] * 4
+        torrent.length = 4 * _PIECE_LENGTH
+        piece_picker = PiecePicker(torrent, _Session(), bitstring.BitArray(4))
+        connection_manager.start_download(None, piece_picker, None, None)
+        assert len(peer.have_pieces) == 4 and not peer.have_pieces.any()
+
+        asyncio.run(piece_picker.send_have(2))  # the first verified piece
+        assert peer.control_msg_queue == [Have.encode(2)]
+    finally:
+        Peer.peer_instances.pop(torrent.info_hash)
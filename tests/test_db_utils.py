@@ -0,0 +1,30 @@
+import asyncio
+import json
+
+import pytest
+
+from RaBit.app_data import db_utils
+
+
+@pytest.fixture
+def app_data(tmp_path, monkeypatch):
+    """
+    a config.json of an older version, without the settings added since
+    """
+    (tmp_path / 'config.json').write_text(json.dumps({'max_peer_connections': 40}))
+    (tmp_path / 'default_config.json').write_text(json.dumps({'max_peer_connections': 100, 'outbound_flush_threshold': 16384}))
+    monkeypatch.setattr(db_utils, 'abs_db_path', lambda file_name: str(tmp_path / file_name))
+    return tmp_path
+
+
+def test_missing_settings_fall_back_to_defaults(app_data):
+    assert db_utils.get_configuration('max_peer_connections') == 40
+    assert db_utils.get_configuration('outbound_flush_threshold') == 16384
+    assert db_utils.get_configuration('no_such_setting') is None
+
+
+def test_missing_settings_can_be_set(app_data):
+    assert asyncio.run(db_utils.set_configuration('outbound_flush_threshold', 4096))
+    assert not asyncio.run(db_utils.set_configuration('no_such_setting', 1))
+    assert json.loads((app_data / 'config.json').read_text()) == {'max_peer_connections': 40, 'outbound_flush_threshold': 4096}
+    assert db_utils.get_configuration('outbound_flush_threshold') == 4096
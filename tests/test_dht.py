@@ -0,0 +1,94 @@
+import asyncio
+import os
+import random
+import threading
+from typing import List
+
+from RaBit.dht import DHTNode, K
+from RaBit.dht import node as dht_node
+
+_NETWORK_SIZE = 200
+
+
+async def _network(size: int = _NETWORK_SIZE) -> List[DHTNode]:
+    """
+    a network of DHT nodes on loopback. every node joins through a random node that joined before it
+    """
+    nodes = []
+    for _ in range(size):
+        node = DHTNode()
+        await node.start('127.0.0.1', 0)
+        nodes.append(node)
+    await nodes[0].bootstrap([])
+    for index, node in enumerate(nodes[1:], 1):
+        await node.bootstrap([('127.0.0.1', nodes[random.randrange(index)].port)])
+    return nodes
+
+
+def _close(nodes: List[DHTNode]) -> None:
+    for node in nodes:
+        node.close()
+
+
+def test_bootstrap():
+    async def main():
+        nodes = await _network()
+        try:
+            assert all(node.is_bootstrapped.is_set() for node in nodes)
+            assert sorted(len(node.routing_table) for node in nodes)[len(nodes) // 2] >= K
+        finally:
+            _close(nodes)
+    asyncio.run(main())
+
+
+def test_lookups_find_announced_peers():
+    async def main():
+        nodes = await _network()
+        try:
+            for _ in range(10):
+                info_hash = os.urandom(20)
+                seeders = random.sample(nodes, 3)
+                for port, seeder in enumerate(seeders, 10000):
+                    await seeder.announce_peer(info_hash, port)
+                searcher = random.choice([node for node in nodes if node not in seeders])
+                assert {port for _, port in await searcher.get_peers(info_hash)} == {10000, 10001, 10002}
+        finally:
+            _close(nodes)
+    asyncio.run(main())
+
+
+def test_lookups_survive_dead_nodes(monkeypatch):
+    monkeypatch.setattr(dht_node, '_QUERY_TIMEOUT', 0.2)
+
+    async def main():
+        nodes = await _network()
+        try:
+            for node in random.sample(nodes[1:], len(nodes) // 3):  # a third of the network goes away
+                node.close()
+                nodes.remove(node)
+            info_hash = os.urandom(20)
+            await nodes[1].announce_peer(info_hash, 12345)
+            assert await nodes[-1].get_peers(info_hash) == [('127.0.0.1', 12345)]
+        finally:
+            _close(nodes)
+    asyncio.run(main())
+
+
+def test_find_peers_from_another_thread(monkeypatch):
+    async def main():
+        nodes = await _network(30)
+        try:
+            info_hash = os.urandom(20)
+            await nodes[1].announce_peer(info_hash, 12345)
+            # the client's node runs in its own thread, the downloads look peers up from theirs
+            monkeypatch.setattr(dht_node, '_dht_node', nodes[2])
+            monkeypatch.setattr(dht_node, '_dht_loop', asyncio.get_running_loop())
+            found = []
+            thread = threading.Thread(target=lambda: found.extend(asyncio.run(dht_node.find_peers(info_hash))))
+            thread.start()
+            while thread.is_alive():
+                await asyncio.sleep(0.01)
+            assert found == [('127.0.0.1', 12345)]
+        finally:
+            _close(nodes)
+    asyncio.run(main())
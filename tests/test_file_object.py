@@ -0,0 +1,28 @@
+from RaBit.torrent.torrent_object import Torrent
+from RaBit.download.data_structures import SKIP, LOW, NORMAL, HIGH
+from RaBit.file.file_object import get_piece_priorities, get_unshared_pieces
+
+_PIECE_LENGTH = 100
+
+
+def _torrent(file_lengths) -> Torrent:
+    length = sum(file_lengths)
+    return Torrent(info={b'piece length': _PIECE_LENGTH, b'files': [{b'length': file_length} for file_length in file_lengths]},
+                   info_hash=b'f' * 20, piece_hashes=[b''] * -(-length // _PIECE_LENGTH), multi_file=True,
+                   peer_id=b'i' * 20, length=length)
+
+
+def test_boundary_pieces_are_not_shared():
+    # pieces: 0-1 only the first file, 2 first and second, 3 second and third, 4-5 only the third
+    torrent = _torrent([250, 100, 250])
+    priorities = [NORMAL, SKIP, HIGH]
+    assert get_piece_priorities(torrent, priorities).tolist() == [NORMAL, NORMAL, NORMAL, HIGH, HIGH, HIGH]
+    assert get_unshared_pieces(torrent, priorities).tolist() == [False, False, True, True, False, False]
+
+
+def test_all_pieces_are_shared_without_skipped_files():
+    torrent = _torrent([250, 100, 250])
+    assert not get_unshared_pieces(torrent).any()
+    assert not get_unshared_pieces(torrent, [LOW, NORMAL, HIGH]).any()
+    # an empty skipped file overlaps no piece
+    assert not get_unshared_pieces(_torrent([250, 0, 250]), [NORMAL, SKIP, NORMAL]).any()
@@ -0,0 +1,65 @@
+import asyncio
+import struct
+
+import numpy as np
+import pytest
+
+from RaBit.peer.message_types import Bitfield, Have, Choke, Unchoke, HAVE, CHOKE, UNCHOKE, build_decoder, build_dispatcher
+
+
+def _decode(payload: bytes, pieces_num):
+    return Bitfield.decode(memoryview(struct.pack('>IB', len(payload) + 1, 5) + payload), pieces_num)
+
+
+def test_bitfield_round_trip():
+    bitfield = np.array([True, False, True, True, False, False, False, True, True, False])
+    assert _decode(Bitfield.encode(bitfield)[5:], 10).bitfield.tolist() == bitfield.tolist()
+
+
+def test_bitfield_too_short():
+    with pytest.raises(struct.error):
+        _decode(b'\xff', 10)
+    with pytest.raises(struct.error):
+        _decode(b'', 1)
+
+
+def test_bitfield_spare_bits():
+    with pytest.raises(struct.error):
+        _decode(b'\xff\xe0', 10)  # the 11th bit is set
+    with pytest.raises(struct.error):
+        _decode(b'\xff\xc0\x01', 10)  # a trailing byte sets a bit
+    assert _decode(b'\xff\xc0', 10).bitfield.all()
+
+
+def test_bitfield_exact_length():
+    with pytest.raises(struct.error):
+        _decode(b'\xff\xc0\x00', 10)  # a trailing byte, even a clear one
+    # a bitfield received before the metadata (magnet link) is checked once the number of pieces is known
+    bitfield = _decode(b'\xff\xc0\x00', None).bitfield
+    assert len(bitfield) == 24
+    with pytest.raises(struct.error):
+        Bitfield.trim(bitfield, 10)
+    assert Bitfield.trim(bitfield, 20).tolist() == [True] * 10 + [False] * 10
+
+
+def test_bitfield_unknown_length():
+    # a magnet link keeps all the bits until the metadata arrives
+    assert len(_decode(b'\xff\xe0', None).bitfield) == 16
+
+
+
+def test_dispatch_by_id():
+    handled = []
+
+    async def handle_have(msg):
+        handled.append(('have', msg.piece_index))
+
+    decode = build_decoder((CHOKE, UNCHOKE, HAVE), 10)
+    dispatch = build_dispatcher({HAVE: handle_have, CHOKE: lambda msg: handled.append('choke')})
+
+    async def run():
+        return [await dispatch(decode(memoryview(msg))) for msg in (Have.encode(3), Choke.encode(), Unchoke.encode())] + [await dispatch(None)]
+
+    # no handler for unchoke, and an idle connection has no message
+    assert asyncio.run(run()) == [True, True, False, False]
+    assert handled == [('have', 3), 'choke']
@@ -0,0 +1,57 @@
+from RaBit.torrent.torrent_object import Torrent
+from RaBit.peer.peer_object import Peer, _INITIAL_PIPELINE_SIZE, _MIN_PIPELINE_SIZE
+
+_RATE = 256  # blocks per second the peer uploads, 4 MiB/s
+_RTT = 0.2  # seconds
+
+
+def _peer() -> Peer:
+    torrent = Torrent(info={b'piece length': 2 ** 16}, info_hash=b'l' * 20, piece_hashes=[b''] * 4,
+                      multi_file=False, peer_id=b'i' * 20, length=4 * 2 ** 16)
+    return Peer(None, torrent, ('127.0.0.1', 6881), None)
+
+
+def _receive_blocks(peer: Peer, number: int) -> None:
+    """
+    a full pipeline over a link of _RATE and _RTT: requests beyond the bandwidth-delay product wait in the peer's queue
+    """
+    for _ in range(number):
+        outstanding = int(peer.pipeline_size)
+        peer.pipelined_requests = dict.fromkeys(range(outstanding))
+        peer.update_latency(_RTT + max(outstanding - _RATE * _RTT, 0) / _RATE)
+
+
+def test_pipeline_ramps_up():
+    peer = _peer()
+    assert peer.pipeline_size == _INITIAL_PIPELINE_SIZE
+    # about a round trip of blocks covers the bandwidth-delay product
+    _receive_blocks(peer, 25)
+    assert peer.pipeline_size >= _RATE * _RTT
+
+
+def test_pipeline_converges():
+    peer = _peer()
+    _receive_blocks(peer, 2000)
+    # the queueing target is a round trip, so the pipeline settles at twice the bandwidth-delay product
+    sizes = []
+    for _ in range(200):
+        _receive_blocks(peer, 1)
+        sizes.append(peer.pipeline_size)
+    assert abs(sum(sizes) / len(sizes) - 2 * _RATE * _RTT) < 0.1 * 2 * _RATE * _RTT
+    assert max(sizes) - min(sizes) < 0.1 * 2 * _RATE * _RTT
+    assert abs(peer.latency - 2 * _RTT) < 0.1 * _RTT
+
+
+def test_pipeline_does_not_grow_unfilled():
+    peer = _peer()
+    for _ in range(50):
+        peer.pipelined_requests = {}  # the peer gets fewer requests than its pipeline, e.g. nothing left to request
+        peer.update_latency(_RTT)
+    assert peer.pipeline_size == _INITIAL_PIPELINE_SIZE
+
+
+def test_snub_shrinks_pipeline_to_minimum():
+    peer = _peer()
+    _receive_blocks(peer, 100)
+    peer.snub()
+    assert peer.MAX_PIPELINE_SIZE == peer.pipeline_size == _MIN_PIPELINE_SIZE
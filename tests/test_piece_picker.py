@@ -0,0 +1,183 @@
+import asyncio
+import time
+
+import bitstring
+import numpy as np
+
+from RaBit.bandwidth import RateEstimator
+from RaBit.torrent.torrent_object import Torrent
+from RaBit.download.data_structures import DownloadingPiece, BLOCK_SIZE, SKIP, NORMAL
+from RaBit.download.piece_picker import PiecePicker, AvailabilityIndex, _ENDGAME_REDUNDANCY
+from RaBit.peer.peer_object import Peer
+from RaBit.peer.message_types import Cancel
+
+_PIECE_LENGTH = 2 ** 16
+
+
+class _Writer:
+    def wake(self) -> None:
+        pass
+
+
+class _Session:
+    downloaded = wasted = 0
+
+    def __init__(self) -> None:
+        self.downloading = RateEstimator()
+
+
+def _piece_picker(num_pieces: int) -> PiecePicker:
+    torrent = Torrent(info={b'piece length': _PIECE_LENGTH}, info_hash=b'p' * 20, piece_hashes=[b''] * num_pieces,
+                      multi_file=False, peer_id=b'i' * 20, length=num_pieces * _PIECE_LENGTH)
+    return PiecePicker(torrent, _Session(), bitstring.BitArray(num_pieces))
+
+
+def _check_sorted(availability_index: AvailabilityIndex) -> None:
+    """
+    the pieces are in ascending availability and every bucket holds exactly the pieces of its availability
+    """
+    availability = [int(availability_index.availability[piece]) for piece in availability_index.pieces]
+    assert availability == sorted(availability)
+    start = 0
+    for priority, end in enumerate(availability_index.bucket_ends):
+        assert all(value == priority for value in availability[start:end])
+        start = end
+    assert start == len(availability_index.pieces)
+
+
+def test_seeds_with_empty_priority_indexes():
+    piece_picker = _piece_picker(3)  # all the pieces are NORMAL, the HIGH and LOW indexes are empty
+    seed = np.ones(3, dtype=bool)
+    partial = np.array([True, False, False])
+
+    for _ in range(3):
+        piece_picker.add_peer_bitfield(seed)
+        piece_picker.add_peer_bitfield(seed)
+        piece_picker.add_peer_bitfield(partial)
+        for availability_index in piece_picker.availability_indexes:  # sorts the indexes with the seeds counted
+            availability_index.rarest(seed)
+        piece_picker.remove_peer_bitfield(seed)
+        piece_picker.remove_peer_bitfield(seed)
+        piece_picker.remove_peer_bitfield(partial)
+
+    assert piece_picker.availability.tolist() == [0, 0, 0]
+    for availability_index in piece_picker.availability_indexes:
+        availability_index.rarest(seed)
+        _check_sorted(availability_index)
+
+
+def test_seed_keeps_buckets_sorted():
+    availability_index = AvailabilityIndex(6, range(6))
+    seed = np.ones(6, dtype=bool)
+    availability_index.add_bitfield(np.array([True, True, False, False, False, False]))
+    availability_index.rarest(seed)
+
+    availability_index.add_bitfield(seed)
+    assert availability_index.is_sorted
+    _check_sorted(availability_index)
+    availability_index.subtract_bitfield(seed)
+    assert availability_index.is_sorted
+    _check_sorted(availability_index)
+    assert availability_index.rarest(seed) in range(2, 6)
+
+
+def test_unshared_pieces_are_not_announced():
+    torrent = Torrent(info={b'piece length': _PIECE_LENGTH}, info_hash=b'u' * 20, piece_hashes=[b''] * 4,
+                      multi_file=False, peer_id=b'i' * 20, length=4 * _PIECE_LENGTH)
+    piece_picker = PiecePicker(torrent, _Session(), bitstring.BitArray(bin='1101'),
+                               unshared_pieces=np.array([False, True, False, False]))
+    assert piece_picker.shared_pieces().bin == '1001'
+    assert piece_picker.is_shared(0)
+    assert not piece_picker.is_shared(1)  # had, but overlaps a skipped file
+    assert not piece_picker.is_shared(2)  # not had
+
+
+def test_health_counts_wanted_pieces():
+    torrent = Torrent(info={b'piece length': _PIECE_LENGTH}, info_hash=b'h' * 20, piece_hashes=[b''] * 4,
+                      multi_file=False, peer_id=b'i' * 20, length=4 * _PIECE_LENGTH)
+    piece_picker = PiecePicker(torrent, _Session(), bitstring.BitArray(4),
+                               piece_priorities=np.array([SKIP, SKIP, NORMAL, NORMAL], dtype=np.uint8))
+    assert piece_picker.get_health == 0
+    piece_picker.add_peer_bitfield(np.array([False, False, True, False]))
+    assert piece_picker.get_health == 50  # one of the two wanted pieces, the skipped ones do not count
+    piece_picker.add_peer_bitfield(np.array([False, False, False, True]))
+    assert piece_picker.get_health == 100
+
+
+def test_cancelled_requests_expire():
+    piece_picker = _piece_picker(4)
+    peer = Peer(None, piece_picker.TorrentData, ('127.0.0.1', 6881), None)
+    Peer.peer_instances[piece_picker.TorrentData.info_hash] = [peer]
+    piece = DownloadingPiece(0, _PIECE_LENGTH)
+    piece_picker.downloading[0] = piece
+    completed = DownloadingPiece(1, _PIECE_LENGTH)  # no longer downloading
+    fresh, expired, stale = piece.blocks[0], piece.blocks[1], completed.blocks[0]
+    peer.cancelled_requests[fresh.key] = (fresh, time.time())
+    peer.cancelled_requests[expired.key] = (expired, time.time() - peer.request_timeout - 1)
+    peer.cancelled_requests[stale.key] = (stale, time.time())
+
+    piece_picker.expire_cancelled_requests()
+    assert list(peer.cancelled_requests) == [fresh.key]
+
+    # a late block of a piece that is no longer downloading is wasted, not written
+    asyncio.run(piece_picker.report_block(stale, (b'\xff' * BLOCK_SIZE, peer.address), peer))
+    assert piece_picker.session.wasted == BLOCK_SIZE
+    assert not any(completed.view[:BLOCK_SIZE])
+    Peer.peer_instances.pop(piece_picker.TorrentData.info_hash)
+
+
+def _endgame(num_peers: int):
+    """
+    a single-piece download in endgame mode. the first peer requested every block before endgame started
+    """
+    piece_picker = _piece_picker(1)
+    peers = [Peer(_Writer(), piece_picker.TorrentData, ('127.0.0.1', 6881 + number), None) for number in range(num_peers)]
+    Peer.peer_instances[piece_picker.TorrentData.info_hash] = peers
+    for peer in peers:
+        peer.have_pieces[:] = True
+        peer.is_choked = False
+        piece_picker.add_peer_bitfield(peer.have_pieces)
+
+    async def request_all():
+        while (block := await piece_picker.get_block(peers[0])) is not None:
+            peers[0].pipelined_requests[block.key] = (block, time.time())
+    asyncio.run(request_all())
+    assert piece_picker.is_in_endgame
+    return piece_picker, peers
+
+
+def test_endgame_redundancy_bound():
+    piece_picker, peers = _endgame(4)
+    blocks = [block for block, _ in peers[0].pipelined_requests.values()]
+    for peer in peers[1:]:
+        while (block := piece_picker.get_endgame_block(peer)) is not None:
+            peer.pipelined_requests[block.key] = (block, time.time())
+
+    # every block is requested from _ENDGAME_REDUNDANCY peers, never more
+    assert all(len(piece_picker.endgame_blocks[block.key]) == _ENDGAME_REDUNDANCY for block in blocks)
+    assert sum(len(peer.pipelined_requests) for peer in peers) == len(blocks) * _ENDGAME_REDUNDANCY
+
+    # a dropped request frees a place for another peer
+    block = blocks[0]
+    requester = next(peer for peer in peers[1:] if block.key in peer.pipelined_requests)
+    requester.pipelined_requests.pop(block.key)
+    piece_picker.deselect_block(block, requester)
+    other = next(peer for peer in peers[1:] if peer is not requester and block.key not in peer.pipelined_requests)
+    assert piece_picker.get_endgame_block(other) is block
+    assert piece_picker.get_endgame_block(requester) is None
+    Peer.peer_instances.pop(piece_picker.TorrentData.info_hash)
+
+
+def test_endgame_cancel_on_receipt():
+    piece_picker, (first, second) = _endgame(2)
+    block = piece_picker.get_endgame_block(second)
+    second.pipelined_requests[block.key] = (block, time.time())
+
+    first.pipelined_requests.pop(block.key)
+    asyncio.run(piece_picker.report_block(block, (b'\x00' * block.length, first.address), first))
+    # the duplicate request is cancelled right away, and the block may still arrive from the other peer
+    assert second.outbox.messages == [Cancel.encode(block.index, block.begin, block.length)]
+    assert block.key not in second.pipelined_requests and block.key in second.cancelled_requests
+    assert block.key not in piece_picker.endgame_blocks
+    assert not first.outbox.messages
+    Peer.peer_instances.pop(piece_picker.TorrentData.info_hash)
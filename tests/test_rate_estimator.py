@@ -0,0 +1,88 @@
+import math
+import pickle
+
+import pytest
+
+from RaBit.bandwidth import RateEstimator
+
+_WINDOW = 2.0
+_RATE = 2 ** 20  # bytes per second
+
+
+class _Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _steady(estimator: RateEstimator, clock: _Clock, seconds: float, rate: float = _RATE, interval: float = 0.01) -> None:
+    for _ in range(round(seconds / interval)):
+        clock.now += interval
+        estimator.add(int(rate * interval))
+
+
+@pytest.fixture
+def clock() -> _Clock:
+    return _Clock()
+
+
+def test_steady_traffic(clock):
+    estimator = RateEstimator(_WINDOW, clock)
+    _steady(estimator, clock, 1.0)
+    assert estimator.rate == pytest.approx(_RATE, rel=0.02)  # accurate from the first second
+    _steady(estimator, clock, 10.0)
+    assert estimator.rate == pytest.approx(_RATE, rel=0.01)
+
+
+def test_idle_decay(clock):
+    estimator = RateEstimator(_WINDOW, clock)
+    _steady(estimator, clock, 20.0)
+    rate = estimator.rate
+    for _ in range(3):
+        clock.now += _WINDOW
+        assert estimator.rate == pytest.approx(rate / math.e, rel=1e-3)  # decays by e every window
+        rate = estimator.rate
+    clock.now += 30 * _WINDOW
+    assert estimator.rate < _RATE * 1e-6
+
+
+def test_bursty_traffic(clock):
+    # a second's worth of data at once, every second
+    estimator = RateEstimator(_WINDOW, clock)
+    samples = []
+    for _ in range(30):
+        estimator.add(_RATE)
+        for _ in range(10):
+            clock.now += 0.1
+            samples.append(estimator.rate)
+    samples = samples[-100:]  # the last 10 bursts
+    assert sum(samples) / len(samples) == pytest.approx(_RATE, rel=0.05)
+    # bursts swing the estimate, but stay within the bounds of the decay between them
+    assert 0.7 * _RATE < min(samples) and max(samples) < 1.3 * _RATE
+
+
+def test_idle_then_burst(clock):
+    estimator = RateEstimator(_WINDOW, clock)
+    clock.now += 60.0
+    assert estimator.rate == 0.0
+    _steady(estimator, clock, _WINDOW)
+    assert estimator.rate == pytest.approx(_RATE * (1 - math.exp(-1)), rel=0.02)  # a step response of the decay
+    _steady(estimator, clock, 2 * _WINDOW)
+    assert estimator.rate == pytest.approx(_RATE, rel=0.06)
+
+
+def test_change_of_speed(clock):
+    estimator = RateEstimator(_WINDOW, clock)
+    _steady(estimator, clock, 20.0)
+    _steady(estimator, clock, 4 * _WINDOW, rate=_RATE / 4)
+    assert estimator.rate == pytest.approx(_RATE / 4, rel=0.1)
+
+
+def test_pickle_keeps_only_the_window(clock):
+    estimator = RateEstimator(5.0, clock)
+    _steady(estimator, clock, 1.0)
+    restored = pickle.loads(pickle.dumps(estimator))
+    assert restored.window == 5.0
+    assert restored.rate == 0.0
@@ -0,0 +1,24 @@
+from RaBit.bandwidth import RateLimiter, UPLOAD, DOWNLOAD, set_torrent_rates, remove_torrent_rates
+from RaBit.bandwidth import rate_limiter
+
+_INFO_HASH = b'b' * 20
+
+
+def test_removed_torrent_forgets_its_buckets():
+    set_torrent_rates(2 ** 16, 2 ** 17, _INFO_HASH)
+    limiter = RateLimiter(_INFO_HASH)
+    assert limiter.buckets[UPLOAD][1].rate == 2 ** 16
+    assert limiter.buckets[DOWNLOAD][1].rate == 2 ** 17
+
+    remove_torrent_rates(_INFO_HASH)
+    assert _INFO_HASH not in rate_limiter._torrent_buckets
+    assert _INFO_HASH not in rate_limiter._torrent_overrides
+    # a torrent added again starts from the default rates, and changing them applies to it
+    limiter = RateLimiter(_INFO_HASH)
+    assert limiter.buckets[UPLOAD][1].rate == limiter.buckets[DOWNLOAD][1].rate == 0
+    set_torrent_rates(2 ** 18, 2 ** 18)
+    try:
+        assert limiter.buckets[UPLOAD][1].rate == limiter.buckets[DOWNLOAD][1].rate == 2 ** 18
+    finally:
+        set_torrent_rates(0, 0)
+        remove_torrent_rates(_INFO_HASH)